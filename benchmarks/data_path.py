@@ -0,0 +1,238 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from timeit import default_timer as timer
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from benchmarks import synthetic
+
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+VECTORS_DIMENSION = 100
+EMBEDDING_SIZE = 300
+VOCABULARY_SIZE = 20000  # Words of the synthetic corpora
+
+
+# Each benchmark builds its synthetic data for a given size in tmp_dir and returns (prepare, run, n_items):
+# prepare() returns the argument of run(argument), the timed call, which processes n_items items.
+
+def process_prediction_probs_benchmark(size, tmp_dir):
+    from utils.semisupervised_selection import process_prediction_probs
+    prefix = os.path.join(tmp_dir, 'pool')
+    synthetic.write_parallel_corpus(prefix, size, synthetic.random_words(VOCABULARY_SIZE))
+    probs = synthetic.prediction_probs(size)
+
+    def run(_):
+        process_prediction_probs(probs, size // 10, prefix + '.src', prefix + '.trg')
+    return lambda: None, run, size
+
+
+def _training_files_benchmark(size, tmp_dir, max_instances):
+    from utils.semisupervised_selection import process_files_binary_classification
+    words = synthetic.random_words(VOCABULARY_SIZE)
+    params = {'BINARY_SELECTION': True, 'BILINGUAL_SELECTION': True, 'SRC_LAN': 'src', 'TRG_LAN': 'trg',
+              'POSITIVE_FILENAME': os.path.join(tmp_dir, 'positive'),
+              'NEGATIVE_FILENAME': os.path.join(tmp_dir, 'negative'),
+              'POOL_FILENAME': os.path.join(tmp_dir, 'pool'), 'DEST_ROOT_PATH': tmp_dir,
+              'MAX_TRAINING_INSTANCES_PER_CLASS': max_instances, 'NEW_INSTANCES_WEIGHT': 2.,
+              'VIRTUAL_TRAINING_SET': False, 'USE_LINE_INDEX': False}
+    synthetic.write_parallel_corpus(params['POSITIVE_FILENAME'], size // 2, words, seed=0)
+    synthetic.write_parallel_corpus(params['NEGATIVE_FILENAME'], size - size // 2, words, seed=2)
+
+    def run(run_params):
+        process_files_binary_classification(run_params, i=1)
+    return lambda: dict(params, TEXT_FILES=dict(), CLASS_FILES=dict()), run, size
+
+
+def process_files_binary_classification_benchmark(size, tmp_dir):
+    return _training_files_benchmark(size, tmp_dir, 0)
+
+
+def process_files_binary_classification_sampled_benchmark(size, tmp_dir):
+    # Reservoir sampling of half of each class
+    return _training_files_benchmark(size, tmp_dir, size // 4)
+
+
+def keep_n_captions_benchmark(size, tmp_dir):
+    from data_engine.prepare_data import keep_n_captions
+
+    def run(ds):
+        keep_n_captions(ds, repeat=5, n=1)
+    return lambda: synthetic.CaptionsDataset(size, 5), run, 2 * size
+
+
+def word2vec2npy_benchmark(size, tmp_dir):
+    from utils.preprocess_binary_vectors import word2vec2npy
+    vectors_filename = os.path.join(tmp_dir, 'vectors.bin')
+    synthetic.write_word2vec(vectors_filename, synthetic.random_words(size), VECTORS_DIMENSION)
+
+    def run(_):
+        word2vec2npy(vectors_filename, tmp_dir, 'word2vec')
+    return lambda: None, run, size
+
+
+def glove2npy_benchmark(size, tmp_dir):
+    from utils.preprocess_text_vectors import glove2npy
+    vectors_filename = os.path.join(tmp_dir, 'vectors.txt')
+    synthetic.write_glove(vectors_filename, synthetic.random_words(size), VECTORS_DIMENSION)
+
+    def run(_):
+        glove2npy(vectors_filename, tmp_dir, 'glove')
+    return lambda: None, run, size
+
+
+def embedding_matrix_benchmark(size, tmp_dir):
+    from utils.embeddings import embedding_matrix
+    words = synthetic.random_words(size)
+    vocabulary = synthetic.vocabulary(words)
+    word_vectors = synthetic.word_vectors(words[:int(0.8 * size)], EMBEDDING_SIZE)  # 80% of words are pretrained
+
+    def run(_):
+        embedding_matrix(vocabulary, word_vectors, len(vocabulary['words2idx']), EMBEDDING_SIZE)
+    return lambda: None, run, size
+
+
+BENCHMARKS = [('process_prediction_probs', process_prediction_probs_benchmark),
+              ('process_files_binary_classification', process_files_binary_classification_benchmark),
+              ('process_files_binary_classification_sampled', process_files_binary_classification_sampled_benchmark),
+              ('keep_n_captions', keep_n_captions_benchmark),
+              ('word2vec2npy', word2vec2npy_benchmark),
+              ('glove2npy', glove2npy_benchmark),
+              ('embedding_matrix', embedding_matrix_benchmark)]
+
+
+def _memory_status():
+    """
+        (current RSS, peak RSS) of this process in MB. The current RSS is None where /proc is not available.
+    """
+    if os.path.exists('/proc/self/status'):
+        status = dict(line.split(':', 1) for line in open('/proc/self/status') if ':' in line)
+        return int(status['VmRSS'].split()[0]) / 1024., int(status['VmHWM'].split()[0]) / 1024.
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return None, peak / 1024. ** 2 if sys.platform == 'darwin' else peak / 1024.
+
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def _measure(benchmark, size, repeats, tmp_dir, results):
+    """
+        Runs a benchmark in a new process, so that its memory peak is not hidden by the previous ones.
+    """
+    try:
+        prepare, run, n_items = dict(BENCHMARKS)[benchmark](size, tmp_dir)
+        stdout = sys.stdout
+        times = []
+        peak_rss = 0.
+        rss_before = None
+        for _ in range(repeats):
+            argument = prepare()
+            _reset_peak_rss()
+            rss_before = _memory_status()[0]
+            sys.stdout = open(os.devnull, 'w')  # The functions print their progress
+            try:
+                start_time = timer()
+                run(argument)
+                times.append(timer() - start_time)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            peak_rss = max(peak_rss, _memory_status()[1])
+        results.put({'benchmark': benchmark, 'size': size, 'items': n_items, 'repeats': repeats,
+                     'best_seconds': min(times), 'median_seconds': float(np.median(times)),
+                     'items_per_second': n_items / min(times) if min(times) > 0 else None,
+                     'peak_rss_mb': peak_rss, 'rss_before_mb': rss_before})
+    except ImportError as e:
+        results.put({'benchmark': benchmark, 'size': size, 'skipped': str(e)})
+    except Exception:
+        results.put({'benchmark': benchmark, 'size': size, 'error': traceback.format_exc()})
+
+
+def run_benchmarks(benchmarks, sizes, repeats):
+    """
+        :return: list of results (dicts)
+    """
+    results = []
+    for benchmark in benchmarks:
+        for size in sizes:
+            tmp_dir = tempfile.mkdtemp()
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_measure, args=(benchmark, size, repeats, tmp_dir, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            shutil.rmtree(tmp_dir)
+            results.append(result)
+            if 'skipped' in result:
+                logging.info('%-45s %8d: skipped (%s)' % (benchmark, size, result['skipped']))
+            elif 'error' in result:
+                logging.error('%-45s %8d: failed\n%s' % (benchmark, size, result['error']))
+            else:
+                logging.info('%-45s %8d: %9.4fs %12.1f items/s %9.1f MB peak RSS' %
+                             (benchmark, size, result['best_seconds'], result['items_per_second'] or 0.,
+                              result['peak_rss_mb']))
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'w'),
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'hostname': socket.gethostname(), 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpu_count': multiprocessing.cpu_count(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'commit': commit, 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def compare(results, baseline_results):
+    """
+        Logs the throughput of results relative to baseline_results.
+    """
+    baseline = dict(((result['benchmark'], result['size']), result) for result in baseline_results
+                    if result.get('items_per_second'))
+    for result in results:
+        old = baseline.get((result['benchmark'], result['size']))
+        if old is None or not result.get('items_per_second'):
+            continue
+        logging.info('%-45s %8d: %6.2fx throughput, %+8.1f MB peak RSS' %
+                     (result['benchmark'], result['size'], result['items_per_second'] / old['items_per_second'],
+                      result['peak_rss_mb'] - old['peak_rss_mb']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the data-path utilities on synthetic data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Input sizes (lines, vectors...)')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed runs of each benchmark and size (the best '
+                                                               'time is reported)')
+    parser.add_argument('--only', nargs='+', choices=[name for name, _ in BENCHMARKS], help='Benchmarks to run')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file with the results')
+    parser.add_argument('--compare', help='Results of a previous run to compare with')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.only or [name for name, _ in BENCHMARKS], args.sizes, args.repeats)
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=2, sort_keys=True)
+    logging.info('Results written to %s' % args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
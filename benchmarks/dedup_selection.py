@@ -0,0 +1,110 @@
+"""
+    End-to-end check of the deduplicated selection: runs main.py (semisupervised selection) with DEDUP_POOL for two
+    iterations, with the tiny model of selection_scaling.py, on a small synthetic pool with exact duplicates. Checks
+    that every occurrence of a pair ends in the same partition, and that only the first occurrences are kept without
+    DEDUP_KEEP_DUPLICATES.
+
+        python benchmarks/dedup_selection.py [--pool-size 2000] [--duplicate-fraction 0.3] [--keep]
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from benchmarks.selection_scaling import run_selection
+from utils.corpus_io import open_corpus, resolve_corpus
+from utils.deduplication import hash_pair
+
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+
+N_ITER = 2
+LANGUAGES = ['de', 'en']
+
+
+def read_pairs(prefix):
+    """
+        Hashes of the (src, trg) pairs of a parallel corpus, in order (empty if it does not exist).
+    """
+    if not os.path.exists(resolve_corpus(prefix + '.' + LANGUAGES[0])):
+        return []
+    with open_corpus(prefix + '.' + LANGUAGES[0]) as f_src, open_corpus(prefix + '.' + LANGUAGES[1]) as f_trg:
+        return [hash_pair(line_src, line_trg) for line_src, line_trg in zip(f_src, f_trg)]
+
+
+def check_iteration(data_dir, dest_dir, i, keep_duplicates):
+    """
+        Checks the partition of the pool of iteration i into the new positive, negative and remaining pool lines.
+
+        :return: list of error messages
+    """
+    previous = lambda name: os.path.join(dest_dir, '%s_%d' % (name, i - 1)) if i > 0 else \
+        os.path.join(data_dir, name)
+    pool = read_pairs(previous('pool'))
+    # The positive and negative files of an iteration are those of the previous one plus the new lines
+    n_previous_positive = len(read_pairs(previous('in_domain'))) if i > 0 else 0
+    n_previous_negative = len(read_pairs(previous('negative')))
+    partitions = {'positive': read_pairs(os.path.join(dest_dir, 'in_domain_%d' % i))[n_previous_positive:],
+                  'negative': read_pairs(os.path.join(dest_dir, 'negative_%d' % i))[n_previous_negative:],
+                  'pool': read_pairs(os.path.join(dest_dir, 'pool_%d' % i))}
+
+    errors = []
+    partition_of = dict()
+    for name, pairs in partitions.iteritems():
+        for pair in pairs:
+            if partition_of.setdefault(pair, name) != name:
+                errors.append('Iteration %d: a pair is both in the %s and %s lines' % (i, partition_of[pair], name))
+                break
+    outputs = Counter()
+    for pairs in partitions.values():
+        outputs.update(pairs)
+    if keep_duplicates and outputs != Counter(pool):
+        errors.append('Iteration %d: the partitions do not hold every occurrence of the pool pairs' % i)
+    if not keep_duplicates:
+        selected = Counter(partitions['positive'] + partitions['negative'])
+        if any(count > 1 for count in selected.values()):
+            errors.append('Iteration %d: duplicates were selected without DEDUP_KEEP_DUPLICATES' % i)
+        if set(outputs) != set(pool):
+            errors.append('Iteration %d: pairs of the pool are missing from the partitions' % i)
+    logging.info('Iteration %d: %d pool lines (%d unique) -> %d positive, %d negative, %d left in the pool' %
+                 (i, len(pool), len(set(pool)), len(partitions['positive']), len(partitions['negative']),
+                  len(partitions['pool'])))
+    return errors
+
+
+def check_dedup_selection(work_dir, pool_size, duplicate_fraction, keep_duplicates):
+    run_selection(work_dir, pool_size, pool_size // 10, N_ITER, pool_size // 4, pool_size // 4,
+                  extra_params={'DEDUP_POOL': True, 'DEDUP_KEEP_DUPLICATES': keep_duplicates},
+                  duplicate_fraction=duplicate_fraction)
+    errors = []
+    for i in range(N_ITER):
+        errors += check_iteration(os.path.join(work_dir, 'data'), os.path.join(work_dir, 'dest'), i,
+                                  keep_duplicates)
+    return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='End-to-end check of the deduplicated selection (DEDUP_POOL)')
+    parser.add_argument('--pool-size', type=int, default=2000)
+    parser.add_argument('--duplicate-fraction', type=float, default=0.3)
+    parser.add_argument('--keep', action='store_true', help='Keep the working directories')
+    args = parser.parse_args()
+
+    failed = False
+    for keep_duplicates in [True, False]:
+        work_dir = tempfile.mkdtemp(prefix='dedup_selection_')
+        logging.info('DEDUP_KEEP_DUPLICATES=%s (%s)' % (keep_duplicates, work_dir))
+        try:
+            errors = check_dedup_selection(work_dir, args.pool_size, args.duplicate_fraction, keep_duplicates)
+        finally:
+            if not args.keep:
+                shutil.rmtree(work_dir)
+        for error in errors:
+            logging.error(error)
+        failed = failed or bool(errors)
+    if failed:
+        sys.exit(1)
+    logging.info('The deduplicated selection partitions the pool correctly')
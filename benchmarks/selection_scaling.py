@@ -0,0 +1,200 @@
+import argparse
+import ast
+import itertools
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from benchmarks import synthetic
+from benchmarks.data_path import environment
+
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main.py')
+SUPERLINEAR_EXPONENT = 1.15  # Phases whose time grows faster than size ** this are flagged
+
+# Tiny model and fast settings: the harness measures the data path around the model, not the model itself
+TINY_MODEL_PARAMS = {'MODE': 'semisupervised-selection',
+                     'MODEL_TYPE': 'BLSTM_Classifier',
+                     'SRC_TEXT_EMBEDDING_HIDDEN_SIZE': 16,
+                     'TRG_TEXT_EMBEDDING_HIDDEN_SIZE': 16,
+                     'LSTM_ENCODER_HIDDEN_SIZE': 16,
+                     'DEEP_OUTPUT_LAYERS': [('relu', 16)],
+                     'SRC_PRETRAINED_VECTORS': None,
+                     'TRG_PRETRAINED_VECTORS': None,
+                     'MAX_EPOCH': 1,
+                     'BATCH_SIZE': 256,
+                     'PREDICTION_BATCH_SIZE': 1024,
+                     'PARALLEL_LOADERS': 1,
+                     'PREDICTION_LOADERS': 1,
+                     'MAX_INPUT_TEXT_LEN': 20,
+                     'METRICS': [],
+                     'EVAL_ON_SETS': [],
+                     'EARLY_STOP': False,
+                     'INFERENCE_PROFILE': '',
+                     'VERBOSE': 0,
+                     'POSITIVE_FILENAME': 'in_domain',
+                     'NEGATIVE_FILENAME': 'negative',
+                     'POOL_FILENAME': 'pool',
+                     'TIMING_LOG': 'timing.jsonl'}
+
+
+def run_selection(work_dir, pool_size, instances_to_add, n_iter, in_domain_size, negative_size, extra_params=None,
+                  duplicate_fraction=0.):
+    """
+        Runs main.py (semisupervised selection) with the tiny model on synthetic corpora.
+
+        :return: list of the timing records of the run (see utils/instrumentation.py)
+    """
+    data_dir = os.path.join(work_dir, 'data')
+    dest_dir = os.path.join(work_dir, 'dest')
+    os.makedirs(data_dir)
+    synthetic.write_selection_corpora(data_dir, in_domain_size, negative_size, pool_size, ['de', 'en'],
+                                      duplicate_fraction=duplicate_fraction)
+
+    run_params = dict(TINY_MODEL_PARAMS, SRC_LAN='de', TRG_LAN='en', DATA_ROOT_PATH=data_dir, DEST_ROOT_PATH=dest_dir,
+                      STORE_PATH=os.path.join(work_dir, 'models') + '/', INSTANCES_TO_ADD=instances_to_add,
+                      N_ITER=n_iter)
+    run_params.update(extra_params or {})
+    command = [sys.executable, os.path.abspath(MAIN)] + ['%s=%r' % item for item in sorted(run_params.items())]
+    with open(os.path.join(work_dir, 'run.log'), 'w') as log:
+        if subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, cwd=os.path.dirname(MAIN)) != 0:
+            raise Exception, 'The selection run failed. See %s' % log.name
+    with open(os.path.join(dest_dir, run_params['TIMING_LOG'])) as f:
+        return [json.loads(line) for line in f]
+
+
+def _exponent(sizes, times):
+    """
+        Slope of log(time) against log(size): ~1 for linear growth, > 1 for superlinear growth.
+    """
+    sizes = np.asarray(sizes, dtype='float64')
+    times = np.asarray(times, dtype='float64')
+    valid = (sizes > 0) & (times > 0)
+    if len(np.unique(sizes[valid])) < 2:
+        return None
+    return float(np.polyfit(np.log(sizes[valid]), np.log(times[valid]), 1)[0])
+
+
+def phase_summary(records):
+    """
+        Mean wall time per iteration, peak RSS and RSS increase of each phase of a run.
+    """
+    summary = defaultdict(lambda: {'wall': [], 'peak_rss_mb': 0., 'rss_increase_mb': 0.})
+    last_peak = None
+    for record in records:
+        phase = summary[record['phase']]
+        phase['wall'].append(record['wall'])
+        phase['peak_rss_mb'] = max(phase['peak_rss_mb'], record['peak_rss_mb'])
+        if last_peak is not None:
+            phase['rss_increase_mb'] = max(phase['rss_increase_mb'], record['peak_rss_mb'] - last_peak)
+        last_peak = record['peak_rss_mb']
+    return dict((name, {'mean_wall': float(np.mean(phase['wall'])), 'total_wall': float(np.sum(phase['wall'])),
+                        'first_wall': phase['wall'][0], 'last_wall': phase['wall'][-1],
+                        'peak_rss_mb': phase['peak_rss_mb'], 'rss_increase_mb': phase['rss_increase_mb']})
+                for name, phase in summary.iteritems())
+
+
+def scaling_table(runs, pool_sizes, instances, n_iters):
+    """
+        Growth exponent of the mean per-iteration time of each phase with the pool size and INSTANCES_TO_ADD (the
+        other parameters at their first value), and growth of each phase along the iterations of the longest run.
+
+        :return: list of dicts (one per phase)
+    """
+    def select(pool_size=None, n_instances=None, n_iter=None):
+        return [run for run in runs if (pool_size is None or run['pool_size'] == pool_size) and
+                (n_instances is None or run['instances_to_add'] == n_instances) and
+                (n_iter is None or run['n_iter'] == n_iter)]
+
+    phases = []
+    for run in runs:
+        phases += [phase for phase in run['phases'] if phase not in phases]
+    longest = max(select(pool_size=pool_sizes[0], n_instances=instances[0]), key=lambda run: run['n_iter'])
+    table = []
+    for phase in phases:
+        by_pool = [(run['pool_size'], run['phases'][phase]['mean_wall'])
+                   for run in select(n_instances=instances[0], n_iter=n_iters[0]) if phase in run['phases']]
+        by_instances = [(run['instances_to_add'], run['phases'][phase]['mean_wall'])
+                        for run in select(pool_size=pool_sizes[0], n_iter=n_iters[0]) if phase in run['phases']]
+        by_iterations = [(run['n_iter'], run['phases'][phase]['total_wall'])
+                         for run in select(pool_size=pool_sizes[0], n_instances=instances[0])
+                         if phase in run['phases']]
+        row = {'phase': phase,
+               'pool_exponent': _exponent(*zip(*by_pool)) if by_pool else None,
+               'instances_exponent': _exponent(*zip(*by_instances)) if by_instances else None,
+               'iterations_exponent': _exponent(*zip(*by_iterations)) if by_iterations else None,
+               'last_first_ratio': longest['phases'][phase]['last_wall'] / longest['phases'][phase]['first_wall']
+               if phase in longest['phases'] and longest['phases'][phase]['first_wall'] > 0 else None,
+               'max_rss_increase_mb': max(run['phases'][phase]['rss_increase_mb'] for run in runs
+                                          if phase in run['phases'])}
+        row['superlinear'] = any(row[key] is not None and row[key] > SUPERLINEAR_EXPONENT
+                                 for key in ['pool_exponent', 'instances_exponent', 'iterations_exponent'])
+        table.append(row)
+    return table
+
+
+def format_table(runs, table):
+    def value(v, pattern):
+        return pattern % v if v is not None else '-'
+
+    lines = ['%10s %10s %6s  %-24s %10s %10s %10s' % ('pool', 'instances', 'iters', 'phase', 'mean (s)',
+                                                      'peak MB', '+RSS MB')]
+    for run in runs:
+        for phase, summary in sorted(run['phases'].items(), key=lambda item: -item[1]['mean_wall']):
+            lines.append('%10d %10d %6d  %-24s %10.3f %10.1f %10.1f' %
+                         (run['pool_size'], run['instances_to_add'], run['n_iter'], phase, summary['mean_wall'],
+                          summary['peak_rss_mb'], summary['rss_increase_mb']))
+    lines.append('')
+    lines.append('%-24s %10s %10s %10s %10s %10s' % ('phase', 'exp(pool)', 'exp(r)', 'exp(iters)', 'last/first',
+                                                     '+RSS MB'))
+    for row in table:
+        lines.append('%-24s %10s %10s %10s %10s %10s%s' %
+                     (row['phase'], value(row['pool_exponent'], '%.2f'), value(row['instances_exponent'], '%.2f'),
+                      value(row['iterations_exponent'], '%.2f'), value(row['last_first_ratio'], '%.2f'),
+                      value(row['max_rss_increase_mb'], '%.1f'), '  <- superlinear' if row['superlinear'] else ''))
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Scaling of the semisupervised selection phases on synthetic data')
+    parser.add_argument('--pool-sizes', type=int, nargs='+', default=[10000, 20000, 40000])
+    parser.add_argument('--instances', type=int, nargs='+', default=[1000], help='INSTANCES_TO_ADD values')
+    parser.add_argument('--n-iters', type=int, nargs='+', default=[2], help='N_ITER values')
+    parser.add_argument('--in-domain-size', type=int, default=2000)
+    parser.add_argument('--negative-size', type=int, default=2000)
+    parser.add_argument('--set', nargs='*', default=[], metavar='KEY=VALUE',
+                        help='Extra parameters of the runs (as for main.py), e.g. PIPELINED_SCORING=True')
+    parser.add_argument('--output', default='selection_scaling.json', help='JSON file with the results')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directories')
+    args = parser.parse_args()
+
+    extra_params = dict((arg.split('=', 1)[0], ast.literal_eval(arg.split('=', 1)[1])) for arg in args.set)
+    runs = []
+    for pool_size, instances_to_add, n_iter in itertools.product(args.pool_sizes, args.instances, args.n_iters):
+        work_dir = tempfile.mkdtemp(prefix='selection_scaling_')
+        logging.info('Pool of %d sentences, INSTANCES_TO_ADD=%d, N_ITER=%d (%s)' %
+                     (pool_size, instances_to_add, n_iter, work_dir))
+        try:
+            records = run_selection(work_dir, pool_size, instances_to_add, n_iter, args.in_domain_size,
+                                    args.negative_size, extra_params)
+        finally:
+            if not args.keep:
+                shutil.rmtree(work_dir)
+        runs.append({'pool_size': pool_size, 'instances_to_add': instances_to_add, 'n_iter': n_iter,
+                     'records': records, 'phases': phase_summary(records)})
+
+    table = scaling_table(runs, args.pool_sizes, args.instances, args.n_iters)
+    print format_table(runs, table)
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'parameters': vars(args), 'runs': runs, 'scaling': table}, f,
+                  indent=2, sort_keys=True)
+    logging.info('Results written to %s' % args.output)
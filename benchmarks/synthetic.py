@@ -0,0 +1,146 @@
+import struct
+
+import numpy as np
+
+LETTERS = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+
+
+def random_words(n_words, seed=0, min_len=2, max_len=12):
+    """
+        n_words distinct synthetic words.
+    """
+    rng = np.random.RandomState(seed)
+    words = set()
+    while len(words) < n_words:
+        length = rng.randint(min_len, max_len + 1)
+        words.add(''.join(LETTERS[rng.randint(len(LETTERS), size=length)]))
+    return sorted(words)
+
+
+def random_sentences(n_sentences, words, seed=0, min_len=3, max_len=40):
+    """
+        n_sentences synthetic sentences (without line break) with a Zipfian word distribution, like natural text.
+    """
+    rng = np.random.RandomState(seed)
+    ranks = np.arange(1, len(words) + 1, dtype='float64')
+    frequencies = 1. / ranks
+    frequencies /= frequencies.sum()
+    lengths = rng.randint(min_len, max_len + 1, size=n_sentences)
+    tokens = rng.choice(len(words), size=lengths.sum(), p=frequencies)
+    sentences = []
+    position = 0
+    for length in lengths:
+        sentences.append(' '.join(words[w] for w in tokens[position:position + length]))
+        position += length
+    return sentences
+
+
+def write_corpus(filename, sentences):
+    with open(filename, 'w') as f:
+        for sentence in sentences:
+            f.write(sentence + '\n')
+
+
+def write_parallel_corpus(prefix, n_sentences, words, languages=('src', 'trg'), seed=0):
+    """
+        Writes a synthetic parallel corpus (<prefix>.<language> files).
+    """
+    for k, language in enumerate(languages):
+        write_corpus(prefix + '.' + language, random_sentences(n_sentences, words, seed=seed + k))
+
+
+def prediction_probs(n_sentences, seed=0):
+    """
+        Synthetic (negative, positive) class probabilities, as returned by predictNet.
+    """
+    positive = np.random.RandomState(seed).beta(0.5, 2., size=n_sentences).astype('float32')
+    return np.column_stack([1. - positive, positive])
+
+
+def word_vectors(words, dimension, seed=0):
+    """
+        dict mapping each word to a random float32 vector, as loaded from the *2npy outputs.
+    """
+    vectors = np.random.RandomState(seed).randn(len(words), dimension).astype('float32')
+    return dict((word, vectors[k]) for k, word in enumerate(words))
+
+
+def vocabulary(words):
+    """
+        Dataset-like vocabulary of words (indices 0 and 1 are reserved as in the Dataset).
+    """
+    words2idx = {'<pad>': 0, '<unk>': 1}
+    for word in words:
+        words2idx[word] = len(words2idx)
+    return {'words2idx': words2idx, 'idx2words': dict((index, word) for word, index in words2idx.iteritems())}
+
+
+def write_glove(filename, words, dimension, seed=0):
+    """
+        Writes random vectors in the GloVe/fastText text format (one 'word v1 v2 ...' line per word).
+    """
+    vectors = np.random.RandomState(seed).randn(len(words), dimension)
+    with open(filename, 'w') as f:
+        for k, word in enumerate(words):
+            f.write(word + ' ' + ' '.join('%.5f' % value for value in vectors[k]) + '\n')
+
+
+def write_word2vec(filename, words, dimension, seed=0):
+    """
+        Writes random vectors in the word2vec binary format.
+    """
+    vectors = np.random.RandomState(seed).randn(len(words), dimension).astype('float32')
+    with open(filename, 'wb') as f:
+        f.write('%d %d\n' % (len(words), dimension))
+        for k, word in enumerate(words):
+            f.write(word + ' ')
+            f.write(struct.pack('%df' % dimension, *vectors[k]))
+            f.write('\n')
+
+
+class CaptionsDataset(object):
+    def __init__(self, n_samples, repeat, ids_inputs=('source_text',), ids_outputs=('class',), seed=0):
+        """
+            Object with the Dataset attributes used by keep_n_captions: n_samples samples in the 'val' and 'test' sets,
+            in groups of repeat consecutive samples sharing the same input.
+        """
+        rng = np.random.RandomState(seed)
+        self.ids_inputs = list(ids_inputs)
+        self.ids_outputs = list(ids_outputs)
+        self.optional_inputs = []
+        self.extra_variables = dict()
+        for s in ['val', 'test']:
+            setattr(self, 'len_' + s, n_samples)
+            setattr(self, 'X_' + s, dict((id_in, ['input %d' % (k // repeat) for k in range(n_samples)])
+                                         for id_in in self.ids_inputs))
+            setattr(self, 'Y_' + s, dict((id_out, list(rng.randint(2, size=n_samples)))
+                                         for id_out in self.ids_outputs))
+
+
+def write_selection_corpora(data_dir, in_domain_size, negative_size, pool_size, languages,
+                            in_domain_fraction=0.1, duplicate_fraction=0., n_words=20000, seed=0):
+    """
+        Writes synthetic corpora for a semisupervised selection run in data_dir: 'in_domain', 'negative' and 'pool'
+        parallel corpora (<name>.<language> files). In-domain sentences are drawn from the first half of the
+        vocabulary and out-of-domain ones from the second half. A fraction in_domain_fraction of the pool is
+        in-domain, and a fraction duplicate_fraction of its lines are exact copies of other pool pairs.
+    """
+    words = random_words(n_words, seed=seed)
+    in_domain_words = words[:n_words // 2]
+    out_of_domain_words = words[n_words // 2:]
+    n_pool_in_domain = int(in_domain_fraction * pool_size)
+    rng = np.random.RandomState(seed)
+    pool_order = rng.permutation(pool_size)
+    n_duplicates = int(duplicate_fraction * pool_size)
+    if n_duplicates > 0:
+        pool_order[:n_duplicates] = rng.choice(pool_order[n_duplicates:], size=n_duplicates)
+        rng.shuffle(pool_order)
+    for k, language in enumerate(languages):
+        language_seed = seed + 10 * k
+        write_corpus(data_dir + '/in_domain.' + language,
+                     random_sentences(in_domain_size, in_domain_words, seed=language_seed + 1))
+        write_corpus(data_dir + '/negative.' + language,
+                     random_sentences(negative_size, out_of_domain_words, seed=language_seed + 2))
+        pool = random_sentences(n_pool_in_domain, in_domain_words, seed=language_seed + 3) + \
+            random_sentences(pool_size - n_pool_in_domain, out_of_domain_words, seed=language_seed + 4)
+        write_corpus(data_dir + '/pool.' + language, [pool[position] for position in pool_order])
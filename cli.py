@@ -0,0 +1,170 @@
+"""
+    Command line interface of the selection tools:
+
+        python cli.py train [KEY=Value ...]             Trains a classifier (MODE='training')
+        python cli.py sample [KEY=Value ...]            Applies a trained classifier to the test set (MODE='sampling')
+        python cli.py select [KEY=Value ...]            Semisupervised selection (MODE='semisupervised-selection')
+        python cli.py serve [KEY=Value ...]             Scoring server (MODE='serving')
+        python cli.py calibrate [KEY=Value ...]         Inference calibration (MODE='calibration')
+        python cli.py quantize [KEY=Value ...]          Exports the model with quantized embeddings (MODE='quantization')
+        python cli.py score -o SCORES FILE... [KEY=Value ...]
+                                                        Scores corpora (one file per model input) with a trained model
+                                                        (or with several at once, with SCORING_MODELS=[...])
+        python cli.py sweep (--grid FILE | --trials FILE) [KEY=Value ...]
+                                                        Parallel hyperparameter sweep (see sweep.py)
+        python cli.py convert-vectors {word2vec,glove} VECTORS DEST [--quantization {float16,int8}]
+                                                        Converts pretrained word vectors to a .npy dictionary
+        python cli.py vocab FILE...                     Vocabulary size of corpora
+        python cli.py prepare-corpus POSITIVE NEGATIVE [--val N] [--test N]
+                                                        Shuffles, labels and splits two corpora
+
+    KEY=Value arguments overwrite the parameters of config.py, as for main.py. Keras and Theano are only loaded by the
+    subcommands that need a model.
+"""
+import argparse
+import logging
+import os
+import sys
+
+from config import load_params
+from utils.blas_threads import profile_blas_threads, set_blas_threads
+
+# Subcommands running a MODE of main.py
+MODES = {'train': 'training',
+         'sample': 'sampling',
+         'select': 'semisupervised-selection',
+         'serve': 'serving',
+         'calibrate': 'calibration',
+         'quantize': 'quantization'}
+
+
+def configure_threads(params):
+    """
+        Sets the BLAS/OpenMP threads of the run before numpy and Theano are loaded: those of the INFERENCE_PROFILE for
+        the scoring modes, or SWEEP_TRIAL_THREADS for the sweeps.
+    """
+    if params['MODE'] == 'sweep':
+        set_blas_threads(params['SWEEP_TRIAL_THREADS'])
+    elif params['MODE'] in ['sampling', 'serving', 'scoring']:
+        n_threads = profile_blas_threads(params)
+        if n_threads is not None:
+            set_blas_threads(n_threads)
+
+
+def parse_overrides(overrides):
+    """
+        Loads the parameters overwritten by the key=Value overrides, exiting if they are malformed.
+    """
+    try:
+        return load_params(overrides)
+    except (ValueError, SyntaxError):
+        print 'Overwritten arguments must have the form key=Value'
+        sys.exit(1)
+
+
+def run_mode(args):
+    params = parse_overrides(args.overrides)
+    params['MODE'] = MODES[args.command]
+    configure_threads(params)
+    import main
+    main.run(params)
+
+
+def score(args):
+    filenames = [arg for arg in args.arguments if '=' not in arg]
+    params = parse_overrides([arg for arg in args.arguments if '=' in arg])
+    params['MODE'] = 'scoring'
+    configure_threads(params)
+    import main
+    main.apply_inference_profile(params)
+    stats = main.score_corpus(params, filenames, args.output)
+    logging.info('Scores written to %s (%s)' % (args.output, stats))
+
+
+def run_sweep(args):
+    params = parse_overrides(args.overrides)
+    configure_threads(dict(params, MODE='sweep'))
+    import sweep
+    sweep.run_sweep(params, sweep.load_trials(args.grid, args.trials))
+
+
+def convert_vectors(args):
+    dest = args.dest[:-len('.npy')] if args.dest.endswith('.npy') else args.dest
+    dest_dir = os.path.dirname(os.path.abspath(dest))
+    if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+    if args.format == 'word2vec':
+        from utils.preprocess_binary_vectors import word2vec2npy
+        word2vec2npy(args.vectors, dest_dir, os.path.basename(dest), quantization=args.quantization)
+    else:
+        from utils.preprocess_text_vectors import glove2npy
+        glove2npy(args.vectors, dest_dir, os.path.basename(dest), quantization=args.quantization)
+
+
+def vocab(args):
+    from utils.corpus_tools import vocabulary_size
+    for filename in args.files:
+        print "%s: %d" % (filename, vocabulary_size(filename))
+
+
+def prepare_corpus(args):
+    from utils.corpus_tools import split_labeled_corpora
+    sizes = split_labeled_corpora(args.positive, args.negative, dest_dir=args.dest, n_val=args.val, n_test=args.test,
+                                  seed=args.seed)
+    for name in ['training', 'val', 'test']:
+        if name in sizes:
+            logging.info('%s: %d sentences' % (name, sizes[name]))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Neural data selection tools')
+    subparsers = parser.add_subparsers(dest='command')
+
+    for command, mode in sorted(MODES.items()):
+        subparser = subparsers.add_parser(command, help="Runs MODE='%s'" % mode)
+        subparser.add_argument('overrides', nargs='*', metavar='KEY=Value', help='Parameters overwriting config.py')
+        subparser.set_defaults(function=run_mode)
+
+    subparser = subparsers.add_parser('score', help='Scores corpora with a trained model')
+    subparser.add_argument('-o', '--output', required=True, help='File with the class probabilities of each sentence')
+    subparser.add_argument('arguments', nargs='+', metavar='FILE|KEY=Value',
+                           help='Files to score (one per model input, e.g. pool.de pool.en) and parameters '
+                                'overwriting config.py')
+    subparser.set_defaults(function=score)
+
+    subparser = subparsers.add_parser('sweep', help='Trains a classifier per trial in parallel and collects the results')
+    group = subparser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--grid', help='File with a dict mapping parameters to lists of values')
+    group.add_argument('--trials', help='File with a list of dicts of parameters (one per trial)')
+    subparser.add_argument('overrides', nargs='*', metavar='KEY=Value', help='Parameters overwriting config.py')
+    subparser.set_defaults(function=run_sweep)
+
+    subparser = subparsers.add_parser('convert-vectors', help='Converts word vectors to a .npy dictionary')
+    subparser.add_argument('format', choices=['word2vec', 'glove'],
+                           help='word2vec: binary format. glove: text format (GloVe, fastText)')
+    subparser.add_argument('vectors', help='Vectors file')
+    subparser.add_argument('dest', help='Output file (.npy)')
+    subparser.add_argument('--quantization', choices=['float16', 'int8'], default='',
+                           help='Store the vectors quantized (read by the models in the same way)')
+    subparser.set_defaults(function=convert_vectors)
+
+    subparser = subparsers.add_parser('vocab', help='Vocabulary size of corpora')
+    subparser.add_argument('files', nargs='+')
+    subparser.set_defaults(function=vocab)
+
+    subparser = subparsers.add_parser('prepare-corpus', help='Shuffles, labels and splits a positive and a negative '
+                                                             'corpus into training.sn/.class, val.* and test.*')
+    subparser.add_argument('positive', help='Positive corpus')
+    subparser.add_argument('negative', help='Negative corpus')
+    subparser.add_argument('--val', type=int, default=0, help='Sentences of the validation set')
+    subparser.add_argument('--test', type=int, default=0, help='Sentences of the test set')
+    subparser.add_argument('--dest', help='Output folder (by default, the folder of the positive corpus)')
+    subparser.add_argument('--seed', type=int, default=0)
+    subparser.set_defaults(function=prepare_corpus)
+    return parser
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+    args = build_parser().parse_args()
+    args.function(args)
@@ -1,4 +1,7 @@
 
+import ast
+
+
 def load_parameters():
     '''
     Loads the defined parameters
@@ -9,7 +12,7 @@ def load_parameters():
 
     SRC_LAN = 'de'                                # Input language
     TRG_LAN = 'en'                                # Outputs language
-    MODE = 'semisupervised-selection'             # 'training', 'sampling', 'semisupervised-selection'
+    MODE = 'semisupervised-selection'             # 'training', 'sampling', 'semisupervised-selection', 'serving', 'calibration', 'quantization'
 
     BINARY_SELECTION = True                       # Binary classification problem (currently, 'semisupervised-selection' only supports BINARY_SELECTION)
     BILINGUAL_SELECTION = True                    # Use source and target text for classification
@@ -20,6 +23,49 @@ def load_parameters():
     DEST_ROOT_PATH = ROOT_PATH + 'Selection-Keras/' + SRC_LAN + TRG_LAN  # Path to store results
     DEBUG = False                                                        # If True, it will store temporal files
     INSTANCES_TO_ADD = 50000                                             # 'r' parameter. Number of sentences added at each iteration
+    DEDUP_POOL = False                                                   # Score each unique (normalized) pair of the pool only once
+    DEDUP_KEEP_DUPLICATES = True                                         # Keep every occurrence of the selected pairs in the output corpora
+    INCREMENTAL_RESCORING = False                                        # Reuse the stored scores and rescore only a sample + the sentences near the selection boundaries
+    SCORE_STORE_FILENAME = 'score_store.npz'                             # Score store (in DEST_ROOT_PATH) with the last score of each pool sentence
+    RESCORE_SAMPLE_SIZE = 10000                                          # Random sample rescored for measuring the score drift
+    RESCORE_BOUNDARY_MARGIN = 1.0                                        # Sentences rescored beyond each selection boundary (fraction of INSTANCES_TO_ADD)
+    RESCORE_MAX_DRIFT = 0.05                                             # Rescore the whole pool if the mean score drift on the sample exceeds this value
+    WRITE_FULL_RANKING = False                                           # Write the scores (.scores, float32) and ranking (.ranking, int64) of the whole pool
+    RANKING_SORT_CHUNK = 10000000                                        # Scores sorted in memory. Larger pools are ranked with an external merge sort
+    SELECTION_POLICY = 'top-r'                                           # 'top-r': INSTANCES_TO_ADD top/bottom sentences. 'threshold' or 'quantile': score thresholds
+    POSITIVE_THRESHOLD = 0.9                                             # 'threshold' policy: sentences with in-domain score >= this value are positive
+    NEGATIVE_THRESHOLD = 0.1                                             # 'threshold' policy: sentences with in-domain score <= this value are negative
+    POSITIVE_QUANTILE = 0.99                                             # 'quantile' policy: sentences scoring above this quantile of the pool are positive
+    NEGATIVE_QUANTILE = 0.01                                             # 'quantile' policy: sentences scoring below this quantile of the pool are negative
+    SKETCH_SIZE = 1000                                                   # Size of the streaming quantile sketch (larger is more accurate)
+    SCORE_CHUNK_SIZE = 1000000                                           # Scores processed at once by the selection
+    MAX_TRAINING_INSTANCES_PER_CLASS = 0                                 # Cap on the positive and negative training sentences of each iteration (0: no cap)
+    NEW_INSTANCES_WEIGHT = 2.                                            # Reservoir sampling weight of the sentences selected in the previous iteration
+    VIRTUAL_TRAINING_SET = False                                         # Read the positive/negative corpora directly instead of concatenating them into temporary files
+    USE_LINE_INDEX = False                                               # Keep a line-offset index (<file>.idx) of the corpora for fetching lines without full scans
+    CONVERGENCE_STOP = False                                             # Stop the selection when it converges (see utils/convergence.py). The signals are always logged
+    CONVERGENCE_JACCARD = 0.9                                            # Converged if the overlap between the selected and the previously expected top-r sets is >= this
+    CONVERGENCE_SCORE_SHIFT = 0.01                                       # Converged if the mean score change of the sentences scored in consecutive iterations is <= this
+    CONVERGENCE_MIN_IMPROVEMENT = 0.001                                  # Converged if the validation STOP_METRIC improves less than this (needs EVAL_IN_BACKGROUND)
+    CONVERGENCE_RULE = 'all'                                             # 'all' or 'any' of the available convergence signals
+    CONVERGENCE_PATIENCE = 2                                             # Consecutive converged iterations before stopping
+    TIMING_LOG = 'timing.jsonl'                                          # Per-phase timing records (JSON lines) written to DEST_ROOT_PATH. '' disables them
+    PROFILE = ''                                                         # Profile the phases of the runs: '' (off), 'deterministic' (cProfile) or 'sampling'. Written to DEST_ROOT_PATH/profiles
+    PROFILE_PHASES = ['build_dataset', 'build_model', 'training', 'selection']  # Profiled phases (see PhaseRecorder). [] profiles all of them
+    PROFILE_INTERVAL = 0.005                                             # Seconds between the stack samples of the 'sampling' profiler
+    CORPUS_COMPRESSION = ''                                              # Compression of the corpora written to DEST_ROOT_PATH: '', '.gz', '.bz2' or '.xz'
+    PIPELINED_SCORING = False                                            # Score the pool with overlapped reading, tokenization (process pool), prediction and writing
+    SCORING_WORKERS = 4                                                  # Tokenization processes of the pipelined scoring
+    SCORING_QUEUE_SIZE = 16                                              # Batches buffered between the stages of the pipelined scoring
+    SCORING_MODELS = []                                                  # cli.py score: STORE_PATHs of several models sharing a vocabulary, scored in a single pass (one column per model)
+    SCORING_PROCESSES = 1                                                # > 1: the pipelined scoring (and cli.py score) runs this many processes forked from the one holding the model, which share its weights copy-on-write
+    SERVER_HOST = 'localhost'                                            # 'serving' mode: address of the scoring server
+    SERVER_PORT = 8765                                                   # 'serving' mode: port of the scoring server
+    SERVER_SOCKET = ''                                                   # 'serving' mode: listen on this Unix socket instead of SERVER_HOST:SERVER_PORT
+    SERVER_MAX_LATENCY = 0.01                                            # 'serving' mode: seconds a request waits for others to fill its micro-batch (at most PREDICTION_BATCH_SIZE)
+    MEMORY_BUDGET = 0                                                    # MB of RSS the selection may use (0: no budget). Chunks and buffers are sized to fit in it (see utils/memory_budget.py)
+    MEMORY_CHECK_INTERVAL = 1.                                           # Seconds between the RSS samples of the memory monitor
+    MEMORY_WARNING_FRACTION = 0.8                                        # Above this fraction of MEMORY_BUDGET, the chunks are halved. Above the budget, the run fails
 
     if BINARY_SELECTION:
         POSITIVE_FILENAME = 'EMEA.de-en.clean'                           # In-domain corpus (I)
@@ -45,6 +91,8 @@ def load_parameters():
     START_EVAL_ON_EPOCH = 1                       # First epoch where the model will be evaluated
     EVAL_EACH_EPOCHS = True                       # Select whether evaluate between N epochs or N updates
     EVAL_EACH = 1                                 # Sets the evaluation frequency (epochs or updates)
+    EVAL_IN_BACKGROUND = False                    # Evaluate each epoch in a background process, without stalling the training (needs EVAL_EACH_EPOCHS)
+    EVAL_SUBSAMPLE = 0                            # Background evaluation: sentences of a fixed stratified subsample of each set (0: whole set). Whole sets are evaluated at the end
 
     # Early stop parameters
     EARLY_STOP = True                             # Turns on/off the early stop protocol
@@ -61,6 +109,7 @@ def load_parameters():
 
     # Input text parameters
     INPUT_VOCABULARY_SIZE = 0                    # Size of the input vocabulary. Set to 0 for using all, otherwise will be truncated to these most frequent words.
+    OOV_BUCKETS = 0                              # > 0: the words out of the vocabulary are hashed into this many buckets (with their own embeddings) instead of <unk>
     MIN_OCCURRENCES_VOCAB = 0                    # Minimum number of occurrences allowed for the words in the vocabulay. Set to 0 for using them all.
 
 
@@ -82,6 +131,13 @@ def load_parameters():
 
     HOMOGENEOUS_BATCHES = False                  # Use batches with homogeneous output lengths for every minibatch (Dangerous!)
     PARALLEL_LOADERS = 8                         # Parallel data batch loaders
+    PREDICTION_BATCH_SIZE = None                 # Scoring batch size (overridden by the INFERENCE_PROFILE). None: BATCH_SIZE
+    PREDICTION_LOADERS = None                    # Parallel data batch loaders used for scoring (overridden by the INFERENCE_PROFILE). None: PARALLEL_LOADERS
+    TRAINING_WORKERS = 1                         # Data-parallel training processes (1: regular single-process training)
+    TRAINING_SYNC = 'average'                    # Weight synchronization of the workers: 'average' (model averaging) or 'hogwild'
+    TRAINING_SYNC_EVERY = 10                     # Batches trained by a worker between synchronizations
+    TRAINING_SCALING_REPORT = False              # Measure the training throughput with 1, 2, 4, ..., TRAINING_WORKERS workers first
+    TRAINING_SCALING_BATCHES = 200               # Batches trained for each worker count of the scaling report
     EPOCHS_FOR_SAVE = 1                          # Number of epochs between model saves
     WRITE_VALID_SAMPLES = True                   # Write valid samples in file
     DATA_AUGMENTATION = False                    # Apply data augmentation on input data (still unimplemented for text inputs)
@@ -156,6 +212,22 @@ def load_parameters():
     STORE_PATH = 'trained_models/' + MODEL_NAME + '/'  # Models and evaluation results will be stored here
     DATASET_STORE_PATH = 'datasets/'                   # Dataset instance will be stored here
 
+    # Inference calibration (MODE = 'calibration')
+    INFERENCE_PROFILE = None                           # Best scoring settings, applied by the scoring modes if it exists. None: STORE_PATH + 'inference_profile.json'
+    CALIBRATION_SENTENCES = 20000                      # Sentences scored with each setting (taken from the pool, or synthetic)
+    CALIBRATION_BATCH_SIZES = [64, 128, 256, 512, 1024, 2048]  # Scoring batch sizes tried
+    CALIBRATION_BLAS_THREADS = [1, 2, 4, 8]            # BLAS/OpenMP thread counts tried (each one in a new process)
+    CALIBRATION_LOADERS = [1, 2, 4, 8]                 # Data loaders (or SCORING_WORKERS if PIPELINED_SCORING) tried
+
+    # Quantized embeddings for scoring (MODE = 'quantization' exports the model to STORE_PATH[:-1] + '_' + EMBEDDING_QUANTIZATION)
+    EMBEDDING_QUANTIZATION = ''                        # '' (float32), 'float16' or 'int8' (per-row scaled). The scoring modes load the exported model if set
+    QUANTIZATION_REPORT_SENTENCES = 20000              # Pool sentences scored with both models to measure the selection overlap
+
+    # Hyperparameter sweeps (sweep.py, cli.py sweep)
+    SWEEP_PATH = 'sweeps/'                             # Models of the trials (trial_<k>/), datasets and results table
+    SWEEP_WORKERS = 2                                  # Trials trained at the same time
+    SWEEP_TRIAL_THREADS = 1                            # BLAS/OpenMP threads of each trial
+
     SAMPLING_SAVE_MODE = 'numpy'                       # 'list', 'numpy', 'vqa'
     VERBOSE = 1                                        # Verbosity level
     RELOAD = 0                                         # If 0 start training from scratch, otherwise the model
@@ -169,3 +241,29 @@ def load_parameters():
     # ============================================
     parameters = locals().copy()
     return parameters
+
+
+def load_params(arguments):
+    '''
+    Loads the defined parameters, overwritten by the key=Value arguments
+    '''
+    params = load_parameters()
+    params['EXPLICIT_PARAMS'] = []  # Keys set by the arguments, which keep their value over derived ones
+    for arg in arguments:
+        k, v = arg.split('=')
+        params[k] = ast.literal_eval(v)
+        params['EXPLICIT_PARAMS'].append(k)
+    return derive_params(params)
+
+
+def derive_params(params):
+    '''
+    Sets the parameters left to None to the value derived from the (final) value of others
+    '''
+    if params['PREDICTION_BATCH_SIZE'] is None:
+        params['PREDICTION_BATCH_SIZE'] = params['BATCH_SIZE']
+    if params['PREDICTION_LOADERS'] is None:
+        params['PREDICTION_LOADERS'] = params['PARALLEL_LOADERS']
+    if params['INFERENCE_PROFILE'] is None:
+        params['INFERENCE_PROFILE'] = params['STORE_PATH'] + 'inference_profile.json'
+    return params
@@ -0,0 +1,85 @@
+import numpy as np
+
+from utils.corpus_io import is_compressed, open_corpus
+from utils.line_index import LineIndex
+
+
+class LabeledSources(object):
+    def __init__(self, sources, extensions, persistent_index=False):
+        """
+            Several labeled corpora presented as a single training split, without copying them into a temporary file.
+            Labels are given by the line ranges of each source and lines are accessed through their offsets.
+
+            :param sources: list of (prefix, label) or (prefix, label, positions) tuples. The files of a source are
+                            prefix + '.' + extension. If positions (sorted line numbers) is given, only those lines of
+                            the source are used
+            :param extensions: extensions of the files of each source, one per dataset input (e.g. ['de', 'en'])
+            :param persistent_index: store the line indexes of the sources on disk (see utils.line_index)
+        """
+        self.sources = [tuple(source) + (None,) * (3 - len(source)) for source in sources]
+        self.extensions = extensions
+        self.persistent_index = persistent_index
+        self._indexes = dict()
+        self.counts = [len(positions) if positions is not None else self._count_lines(prefix, extensions[0])
+                       for prefix, _, positions in self.sources]
+        self.cumulative_counts = np.cumsum(self.counts).tolist()
+
+    def __len__(self):
+        return self.cumulative_counts[-1] if self.cumulative_counts else 0
+
+    def __repr__(self):
+        return 'LabeledSources(%s)' % ', '.join('%s: %d lines, label %s' % (prefix, count, label)
+                                                for (prefix, label, _), count in zip(self.sources, self.counts))
+
+    def __getstate__(self):
+        obj_dict = self.__dict__.copy()
+        obj_dict['_indexes'] = dict()
+        return obj_dict
+
+    def index(self, prefix, extension):
+        """
+            LineIndex of a source file. Random access is only available for uncompressed sources.
+        """
+        filename = prefix + '.' + extension
+        if filename not in self._indexes:
+            if is_compressed(filename):
+                raise IOError('Cannot access the lines of the compressed corpus %s by position' % filename)
+            self._indexes[filename] = LineIndex(filename, persistent=self.persistent_index)
+        return self._indexes[filename]
+
+    def _count_lines(self, prefix, extension):
+        if is_compressed(prefix + '.' + extension):
+            with open_corpus(prefix + '.' + extension) as f:
+                return sum(1 for _ in f)
+        return len(self.index(prefix, extension))
+
+    def labels(self):
+        """
+            Labels of the whole split, built from the line counts of the sources.
+        """
+        labels = []
+        for (_, label, _), count in zip(self.sources, self.counts):
+            labels += [label] * count
+        return labels
+
+    def sentences(self, input_index):
+        """
+            Sentences of one input (language) of the split. The sampled lines of the sources are fetched through
+            their line indexes.
+
+            :param input_index: position of the input in extensions
+            :return: list of sentences
+        """
+        extension = self.extensions[input_index]
+        sentences = []
+        for prefix, _, positions in self.sources:
+            if positions is None:
+                with open_corpus(prefix + '.' + extension) as f:
+                    sentences += [line.rstrip('\n') for line in f]
+            elif is_compressed(prefix + '.' + extension):
+                selected = set(positions)
+                with open_corpus(prefix + '.' + extension) as f:
+                    sentences += [line.rstrip('\n') for j, line in enumerate(f) if j in selected]
+            else:
+                sentences += [line.rstrip('\n') for line in self.index(prefix, extension).get_lines(positions)]
+        return sentences
@@ -2,9 +2,55 @@ import logging
 
 from keras_wrapper.dataset import Dataset, saveDataset, loadDataset
 
+from data_engine.labeled_sources import LabeledSources
+from utils.corpus_io import is_compressed, open_corpus
+from utils.oov_buckets import bucketed_vocabulary, map_oov, n_oov_buckets
+
 logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
 
 
+def text_input(filename):
+    """
+        Text input for Dataset.setInput: the file itself, or its sentences if it is compressed (the Dataset only reads
+        plain text files).
+    """
+    if is_compressed(filename):
+        with open_corpus(filename) as f:
+            return [line.rstrip('\n') for line in f]
+    return filename
+
+
+def _sentences(text):
+    """
+        Sentences of a text input (file or list of sentences).
+    """
+    if isinstance(text, list):
+        return text
+    with open_corpus(text) as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def bucketed_text_input(ds, text, vocabulary, params, tokenized=None):
+    """
+        Text input for Dataset.setInput with the words out of the vocabulary replaced by their OOV bucket tokens, if
+        the vocabulary has buckets (see utils/oov_buckets.py). The sentences are tokenized here, and their tokens are
+        joined by spaces (the tokenization methods leave them unchanged).
+
+        :param ds: Dataset (its tokenization method is used)
+        :param text: text input (file or list of sentences)
+        :param vocabulary: vocabulary of the input
+        :param params: configuration parameters
+        :param tokenized: lists of tokens of the sentences, if they are already tokenized
+    """
+    n_buckets = n_oov_buckets(vocabulary)
+    if n_buckets == 0:
+        return text
+    if tokenized is None:
+        tokenize = getattr(ds, params['TOKENIZATION_METHOD'])
+        tokenized = (tokenize(sentence).split() for sentence in _sentences(text))
+    return [' '.join(map_oov(tokens, vocabulary['words2idx'], n_buckets)) for tokens in tokenized]
+
+
 def build_dataset(params):
     if params['REBUILD_DATASET']:  # We build a new dataset instance
         if (params['VERBOSE'] > 0):
@@ -21,20 +67,41 @@ def build_dataset(params):
         #    the files include a sentence per line.
         print params['CLASS_FILES']
         for split in params['CLASS_FILES'].keys():
-            ds.setOutput(params['CLASS_FILES'][split],
+            class_files = params['CLASS_FILES'][split]
+            ds.setOutput(class_files.labels() if isinstance(class_files, LabeledSources) else class_files,
                          split,
                          type='categorical',
                          id=params['OUTPUTS_IDS_DATASET'][0],
                          sample_weights=params['SAMPLE_WEIGHTS'])
 
+        # Vocabularies of the INPUT_VOCABULARY_SIZE most frequent words, plus OOV_BUCKETS hashed buckets for the rest
+        tokenized_train = dict()
+        if params['OOV_BUCKETS'] > 0:
+            tokenize = getattr(ds, params['TOKENIZATION_METHOD'])
+            text_files = params['TEXT_FILES']['train']
+            for i, id_in in enumerate(params['INPUTS_IDS_DATASET']):
+                sentences = text_files.sentences(i) if isinstance(text_files, LabeledSources) \
+                    else _sentences(text_input(text_files[i]))
+                tokenized_train[i] = [tokenize(sentence).split() for sentence in sentences]
+                ds.vocabulary[id_in] = bucketed_vocabulary(tokenized_train[i], params['INPUT_VOCABULARY_SIZE'],
+                                                           params['MIN_OCCURRENCES_VOCAB'], params['OOV_BUCKETS'])
+                ds.vocabulary_len[id_in] = len(ds.vocabulary[id_in]['words2idx'])
+                logging.info('Vocabulary of %s: %d words and %d OOV buckets' %
+                             (id_in, ds.vocabulary_len[id_in] - params['OOV_BUCKETS'], params['OOV_BUCKETS']))
+
         # INPUT DATA
         for split in params['TEXT_FILES'].keys():
             if split == 'train':
-                build_vocabulary = True
+                build_vocabulary = params['OOV_BUCKETS'] == 0
             else:
                 build_vocabulary = False
+            text_files = params['TEXT_FILES'][split]
             for i in range(len(params['INPUTS_IDS_DATASET'])):
-                ds.setInput(params['TEXT_FILES'][split][i],
+                text = text_files.sentences(i) if isinstance(text_files, LabeledSources) else text_input(text_files[i])
+                if params['OOV_BUCKETS'] > 0:
+                    text = bucketed_text_input(ds, text, ds.vocabulary[params['INPUTS_IDS_DATASET'][i]], params,
+                                               tokenized=tokenized_train.pop(i) if split == 'train' else None)
+                ds.setInput(text,
                             split,
                             type='text',
                             id=params['INPUTS_IDS_DATASET'][i],
@@ -47,8 +114,10 @@ def build_dataset(params):
                             min_occ=params['MIN_OCCURRENCES_VOCAB'])
 
         for i in range(len(params['INPUTS_IDS_DATASET'])):
-            if 'semisupervised' in params['MODE']:
-                ds.setInput(params['POOL_FILENAME'][i],
+            # The pipelined scorer reads the pool by itself
+            if 'semisupervised' in params['MODE'] and not params['PIPELINED_SCORING']:
+                ds.setInput(bucketed_text_input(ds, text_input(params['POOL_FILENAME'][i]),
+                                                ds.vocabulary[params['INPUTS_IDS_DATASET'][i]], params),
                             'test',
                             type='text',
                             id=params['INPUTS_IDS_DATASET'][i],
@@ -72,6 +141,36 @@ def build_dataset(params):
     return ds
 
 
+def build_pool_dataset(params, vocabularies, pool_filenames, split='test'):
+    """
+        Builds a Dataset holding only the text inputs of a pool, so that it can be scored with an already trained model
+        without rebuilding the training data.
+
+        :param params: configuration parameters
+        :param vocabularies: vocabularies used for indexing the pool, by input id (e.g. the vocabulary of the training
+                             Dataset or of the stored model)
+        :param pool_filenames: pool files, one per input in params['INPUTS_IDS_DATASET']
+        :param split: split where the pool is loaded
+        :return: Dataset instance
+    """
+    ds = Dataset(params['DATASET_NAME'] + '_pool', params['DATA_ROOT_PATH'] + '/', silence=params['VERBOSE'] == 0)
+    for i, id_in in enumerate(params['INPUTS_IDS_DATASET']):
+        ds.vocabulary[id_in] = vocabularies[id_in]
+        ds.vocabulary_len[id_in] = len(vocabularies[id_in]['words2idx'])
+        ds.setInput(bucketed_text_input(ds, text_input(pool_filenames[i]), vocabularies[id_in], params),
+                    split,
+                    type='text',
+                    id=id_in,
+                    pad_on_batch=params['PAD_ON_BATCH'],
+                    tokenization=params['TOKENIZATION_METHOD'],
+                    build_vocabulary=False,
+                    fill=params['FILL'],
+                    max_text_len=params['MAX_INPUT_TEXT_LEN'],
+                    max_words=params['INPUT_VOCABULARY_SIZE'],
+                    min_occ=params['MIN_OCCURRENCES_VOCAB'])
+    return ds
+
+
 def keep_n_captions(ds, repeat, n=1, set_names=['val', 'test']):
     ''' Keeps only n captions per image and stores the rest in dictionaries for a later evaluation
     '''
@@ -1,65 +1,72 @@
-import ast
+import json
 import logging
+import os
+import shutil
 import sys
-from shutil import copyfile
+import tempfile
 from timeit import default_timer as timer
 
-from config import load_parameters
-from data_engine.prepare_data import build_dataset
-from keras_wrapper.cnn_model import loadModel
-from keras_wrapper.extra import evaluation, read_write
-from keras_wrapper.extra.callbacks import PrintPerformanceMetricOnEpochEndOrEachNUpdates
-from model_zoo import Text_Classification_Model
+import numpy as np
+from config import load_params
+from utils.blas_threads import BLAS_THREADS_VARIABLES, set_blas_threads
+from utils.calibration import calibrate, calibration_sentences, load_inference_profile
+from utils.convergence import ConvergenceMonitor
+from utils.corpus_io import copy_corpus, open_corpus
+from utils.deduplication import DedupIndex, hash_pool
+from utils.instrumentation import phase_recorder
+from utils.line_index import corpus_line_index
+from utils.memory_budget import MemoryBudgetExceeded, corpus_memory_mb, memory_budget
+from utils.multi_model_scoring import StackedModels
+from utils.parallel_training import parallel_train, scaling_report
+from utils.pipelined_scoring import pipelined_scoring
+from utils.ranking import SORT_BYTES, write_full_ranking
+from utils.score_store import ScoreStore, select_rescoring_subset, score_drift
+from utils.scoring_server import serve
+from utils.shared_scoring import forked_scoring
 from utils.semisupervised_selection import process_prediction_probs, update_config_params, \
-    process_files_binary_classification
+    process_files_binary_classification, pool_input_files, extract_lines, selection_thresholds, selection_decisions, \
+    write_partitions, score_sketch, POSITIVE, NEGATIVE, NEUTRAL, SCORE_BYTES
 
 logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
 logger = logging.getLogger(__name__)
 
+# Keras, keras_wrapper and model_zoo (Theano) are imported by the functions that need a model or a Dataset, so that
+# importing this module (e.g. from cli.py) is fast.
+
 
 def train_model(params):
     """
         Main function
     """
+    from data_engine.prepare_data import build_dataset
+    from keras_wrapper.cnn_model import loadModel
 
     if params['RELOAD'] > 0:
         logging.info('Resuming training.')
 
     check_params(params)
+    recorder = phase_recorder(params)
 
     ########### Load data
+    recorder.start('build_dataset')
     if params['BINARY_SELECTION']:
         params['POSITIVE_FILENAME'] = params['DATA_ROOT_PATH'] + '/' + params['POSITIVE_FILENAME']
         params['NEGATIVE_FILENAME'] = params['DATA_ROOT_PATH'] + '/' + params['NEGATIVE_FILENAME']
     params = process_files_binary_classification(params)
     dataset = build_dataset(params)
     params['INPUT_VOCABULARY_SIZE'] = dataset.vocabulary_len[params['INPUTS_IDS_DATASET'][0]]
+    recorder.end('build_dataset', lines=dataset.len_train)
     ###########
 
     ########### Build model
+    recorder.start('build_model')
     if params['RELOAD'] == 0:  # build new model
-        text_class_model = Text_Classification_Model(params, type=params['MODEL_TYPE'], verbose=params['VERBOSE'],
-                                                     model_name=params['MODEL_NAME'], vocabularies=dataset.vocabulary,
-                                                     store_path=params['STORE_PATH'])
-
-        # Define the inputs and outputs mapping from our Dataset instance to our model
-        inputMapping = dict()
-        for i, id_in in enumerate(params['INPUTS_IDS_DATASET']):
-            pos_source = dataset.ids_inputs.index(id_in)
-            id_dest = text_class_model.ids_inputs[i]
-            inputMapping[id_dest] = pos_source
-        text_class_model.setInputsMapping(inputMapping)
-
-        outputMapping = dict()
-        for i, id_out in enumerate(params['OUTPUTS_IDS_DATASET']):
-            pos_target = dataset.ids_outputs.index(id_out)
-            id_dest = text_class_model.ids_outputs[i]
-            outputMapping[id_dest] = pos_target
-        text_class_model.setOutputsMapping(outputMapping)
+        text_class_model = build_classifier(params, dataset)
 
     else:  # resume from previously trained model
         text_class_model = loadModel(params['STORE_PATH'], params['RELOAD'])
         text_class_model.setOptimizer()
+    recorder.end('build_model')
     ###########
 
 
@@ -70,6 +77,7 @@ def train_model(params):
 
     ########### Training
     total_start_time = timer()
+    recorder.start('training')
 
     logger.debug('Starting training!')
     training_params = {'n_epochs': params['MAX_EPOCH'],
@@ -83,7 +91,9 @@ def train_model(params):
                        'extra_callbacks': callbacks,
                        'reload_epoch': params['RELOAD'],
                        'data_augmentation': params.get('DATA_AUGMENTATION', False)}
-    text_class_model.trainNet(dataset, training_params)
+    train_classifier(params, text_class_model, dataset, training_params)
+    recorder.end('training', lines=dataset.len_train)
+    recorder.close()
 
     total_end_time = timer()
     time_difference = total_end_time - total_start_time
@@ -91,10 +101,59 @@ def train_model(params):
     ###########
 
 
+def build_classifier(params, dataset):
+    """
+        Builds a new Text_Classification_Model for the vocabularies of dataset, with its inputs/outputs mappings set.
+    """
+    from model_zoo import Text_Classification_Model
+
+    params['INPUT_SRC_VOCABULARY_SIZE'] = dataset.vocabulary_len[params['INPUTS_IDS_DATASET'][0]]
+    if params['BILINGUAL_SELECTION']:
+        params['INPUT_TRG_VOCABULARY_SIZE'] = dataset.vocabulary_len[params['INPUTS_IDS_DATASET'][1]]
+    text_class_model = Text_Classification_Model(params,
+                                                 type=params['MODEL_TYPE'],
+                                                 model_name=params['MODEL_NAME'],
+                                                 vocabularies=dataset.vocabulary,
+                                                 store_path=params['STORE_PATH'],
+                                                 verbose=params['VERBOSE'])
+
+    # Define the inputs and outputs mapping from our Dataset instance to our model
+    inputMapping = dict()
+    for k, id_in in enumerate(params['INPUTS_IDS_DATASET']):
+        pos_source = dataset.ids_inputs.index(id_in)
+        id_dest = text_class_model.ids_inputs[k]
+        inputMapping[id_dest] = pos_source
+    text_class_model.setInputsMapping(inputMapping)
+
+    outputMapping = dict()
+    for k, id_out in enumerate(params['OUTPUTS_IDS_DATASET']):
+        pos_target = dataset.ids_outputs.index(id_out)
+        id_dest = text_class_model.ids_outputs[k]
+        outputMapping[id_dest] = pos_target
+    text_class_model.setOutputsMapping(outputMapping)
+    return text_class_model
+
+
+def train_classifier(params, text_class_model, dataset, training_params):
+    """
+        Trains the model with trainNet or, if TRAINING_WORKERS > 1, with data-parallel worker processes.
+    """
+    if params['TRAINING_WORKERS'] > 1:
+        if params['TRAINING_SCALING_REPORT']:
+            scaling_report(text_class_model, dataset, params)
+            params['TRAINING_SCALING_REPORT'] = False  # Reported only once
+        parallel_train(text_class_model, dataset, params, callbacks=training_params['extra_callbacks'])
+    else:
+        text_class_model.trainNet(dataset, training_params)
+
+
 def apply_Clas_model(params):
     """
         Function for using a previously trained model for sampling.
     """
+    from data_engine.prepare_data import build_dataset
+    from keras_wrapper.cnn_model import loadModel
+    from keras_wrapper.extra import evaluation, read_write
 
     ########### Load data
     dataset = build_dataset(params)
@@ -115,8 +174,8 @@ def apply_Clas_model(params):
     for s in params["EVAL_ON_SETS"]:
 
         # Apply model predictions
-        params_prediction = {'batch_size': params['BATCH_SIZE'],
-                             'n_parallel_loaders': params['PARALLEL_LOADERS'], 'predict_on_sets': [s]}
+        params_prediction = {'batch_size': params['PREDICTION_BATCH_SIZE'],
+                             'n_parallel_loaders': params['PREDICTION_LOADERS'], 'predict_on_sets': [s]}
 
         predictions = text_class_model.predictNet(dataset, params_prediction)[s]
 
@@ -126,6 +185,10 @@ def apply_Clas_model(params):
             read_write.list2file(filepath, predictions)
         else:
             raise Exception, 'Only "list" is allowed in "SAMPLING_SAVE_MODE"'
+        if params['WRITE_FULL_RANKING']:
+            write_full_ranking(np.array(predictions, dtype='float32').reshape(-1, 2)[:, 1],
+                               text_class_model.model_path + '/' + s,
+                               sort_chunk_size=params['RANKING_SORT_CHUNK'])
 
         # Evaluate if any metric in params['METRICS']
         for metric in params['METRICS']:
@@ -154,181 +217,489 @@ def apply_Clas_model(params):
             logging.info('Done evaluating on metric ' + metric)
 
 
-def semisupervised_selection(params):
-    check_params(params)
-    initial_pos_filename = params['POSITIVE_FILENAME']
-    initial_neg_filename = params['NEGATIVE_FILENAME']
-    initial_pool_filename = params['POOL_FILENAME']
+def quantized_store_path(params):
+    return params['STORE_PATH'].rstrip('/') + '_' + params['EMBEDDING_QUANTIZATION'] + '/'
 
-    pos_filename = params['DATA_ROOT_PATH'] + '/' + initial_pos_filename
-    in_domain_file_src = open(pos_filename + '.' + params['SRC_LAN'], 'r')
-    in_domain_src = in_domain_file_src.readlines()
-    in_domain_file_src.close()
-    if params['BILINGUAL_SELECTION']:
-        in_domain_file_trg = open(pos_filename + '.' + params['TRG_LAN'], 'r')
-        in_domain_trg = in_domain_file_trg.readlines()
-        in_domain_file_trg.close()
 
-    neg_filename = params['DATA_ROOT_PATH'] + '/' + initial_neg_filename
-
-    pool_filename = params['DATA_ROOT_PATH'] + '/' + initial_pool_filename
+def load_scoring_model(params):
+    """
+        Loads the stored model used for scoring: the one exported with quantized embeddings if EMBEDDING_QUANTIZATION is
+        set (see quantize_Clas_model).
+    """
+    from keras_wrapper.cnn_model import loadModel
 
-    for i in range(params['N_ITER']):
-        print "------------------ Starting iteration", i, "------------------"
-        new_pos_filename = params['DEST_ROOT_PATH'] + '/' + initial_pos_filename + '_' + str(i)
-        new_pos_filename_tmp = params['DEST_ROOT_PATH'] + '/' + initial_pos_filename + '_' + 'temp'
-        if params['DEBUG']:
-            new_neg_filename_tmp = params['DEST_ROOT_PATH'] + '/' + initial_neg_filename + '_' + 'temp'
-        new_neg_filename = params['DEST_ROOT_PATH'] + '/' + initial_neg_filename + '_' + str(i)
+    if params['EMBEDDING_QUANTIZATION']:
+        from utils.quantized_embedding import QuantizedEmbedding
+        return loadModel(quantized_store_path(params), params['RELOAD'],
+                         custom_objects={'QuantizedEmbedding': QuantizedEmbedding})
+    return loadModel(params['STORE_PATH'], params['RELOAD'])
 
-        new_pool_filename = params['DEST_ROOT_PATH'] + '/' + initial_pool_filename + '_' + str(i)
 
-        if i > 0:
-            copyfile(pos_filename + '.' + params['SRC_LAN'], new_pos_filename_tmp + '.' + params['SRC_LAN'])
-            copyfile(pos_filename + '.' + params['SRC_LAN'], new_pos_filename + '.' + params['SRC_LAN'])
-            copyfile(pos_filename + '.' + params['TRG_LAN'], new_pos_filename + '.' + params['TRG_LAN'])
-            if params['BILINGUAL_SELECTION']:
-                copyfile(pos_filename + '.' + params['TRG_LAN'], new_pos_filename_tmp + '.' + params['TRG_LAN'])
+def quantize_Clas_model(params):
+    """
+        Exports the stored model with EMBEDDING_QUANTIZATION embeddings for scoring, and reports how much the selection
+        changes on QUANTIZATION_REPORT_SENTENCES sentences of the pool (written to quantization_report.json).
+    """
+    from keras_wrapper.cnn_model import loadModel, saveModel
+    from utils.quantized_embedding import quantize_model, quantization_report
 
-        with open(new_pos_filename_tmp + '.' + params['SRC_LAN'], "a") as f:
-            for line in in_domain_src:
-                f.write(line)
+    if not params['EMBEDDING_QUANTIZATION']:
+        raise AttributeError, 'Set EMBEDDING_QUANTIZATION to float16 or int8'
+    text_class_model = loadModel(params['STORE_PATH'], params['RELOAD'])
+    vocabularies = [text_class_model.vocabularies[id_in] for id_in in params['INPUTS_IDS_DATASET']]
+    quantized_model, original_bytes, quantized_bytes = quantize_model(text_class_model,
+                                                                      params['EMBEDDING_QUANTIZATION'])
+    logging.info('Embeddings: %.1f MB -> %.1f MB (%s)' % (original_bytes / 1024. ** 2, quantized_bytes / 1024. ** 2,
+                                                        params['EMBEDDING_QUANTIZATION']))
 
-        if params['BILINGUAL_SELECTION']:
-            with open(new_pos_filename_tmp + '.' + params['TRG_LAN'], "a") as f:
-                for line in in_domain_trg:
-                    f.write(line)
-
-        copyfile(neg_filename + '.' + params['SRC_LAN'], new_neg_filename + '.' + params['SRC_LAN'])
-        if params['BILINGUAL_SELECTION'] or params['DEBUG']:
-            copyfile(neg_filename + '.' + params['TRG_LAN'], new_neg_filename + '.' + params['TRG_LAN'])
-        copyfile(pool_filename + '.' + params['SRC_LAN'], new_pool_filename + '.' + params['SRC_LAN'])
-        copyfile(pool_filename + '.' + params['TRG_LAN'], new_pool_filename + '.' + params['TRG_LAN'])
-
-        params = update_config_params(params,
-                                      new_pos_filename_tmp,
-                                      new_neg_filename,
-                                      new_pool_filename)
-
-        params = process_files_binary_classification(params, i=i)
-        ########### Load data
-        dataset = build_dataset(params)
-        params['INPUT_SRC_VOCABULARY_SIZE'] = dataset.vocabulary_len[params['INPUTS_IDS_DATASET'][0]]
-        if params['BILINGUAL_SELECTION']:
-            params['INPUT_TRG_VOCABULARY_SIZE'] = dataset.vocabulary_len[params['INPUTS_IDS_DATASET'][1]]
-        ###########
-
-        ########### Build model
-        text_class_model = Text_Classification_Model(params,
-                                                     type=params['MODEL_TYPE'],
-                                                     model_name=params['MODEL_NAME'],
-                                                     vocabularies=dataset.vocabulary,
-                                                     store_path=params['STORE_PATH'],
-                                                     verbose=params['VERBOSE'])
-
-        # Define the inputs and outputs mapping from our Dataset instance to our model
-        inputMapping = dict()
-        for i, id_in in enumerate(params['INPUTS_IDS_DATASET']):
-            pos_source = dataset.ids_inputs.index(id_in)
-            id_dest = text_class_model.ids_inputs[i]
-            inputMapping[id_dest] = pos_source
-        text_class_model.setInputsMapping(inputMapping)
-
-        outputMapping = dict()
-        for i, id_out in enumerate(params['OUTPUTS_IDS_DATASET']):
-            pos_target = dataset.ids_outputs.index(id_out)
-            id_dest = text_class_model.ids_outputs[i]
-            outputMapping[id_dest] = pos_target
-        text_class_model.setOutputsMapping(outputMapping)
-
-        ########### Callbacks
-        callbacks = buildCallbacks(params, text_class_model, dataset)
-        ###########
-
-        ########### Training
-        total_start_time = timer()
-
-        logger.debug('Starting training!')
-        training_params = {'n_epochs': params['MAX_EPOCH'], 'batch_size': params['BATCH_SIZE'],
-                           'homogeneous_batches': params['HOMOGENEOUS_BATCHES'],
-                           'shuffle': False if 'train' in params['EVAL_ON_SETS'] else True,
-                           'epochs_for_save': params['EPOCHS_FOR_SAVE'],
-                           'verbose': params['VERBOSE'],
-                           'eval_on_sets': params['EVAL_ON_SETS_KERAS'],
-                           'n_parallel_loaders': params['PARALLEL_LOADERS'],
-                           'extra_callbacks': callbacks, 'reload_epoch': params['RELOAD'],
-                           'data_augmentation': params['DATA_AUGMENTATION']}
-        text_class_model.trainNet(dataset, training_params)
-        total_end_time = timer()
-        time_difference = total_end_time - total_start_time
-        logging.info('In total is {0:.2f}s = {1:.2f}m'.format(time_difference, time_difference / 60.0))
-        ###########
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filenames = []
+        sentences = calibration_sentences(params, vocabularies, params['QUANTIZATION_REPORT_SENTENCES'])
+        for k, input_sentences in enumerate(sentences):
+            filenames.append(os.path.join(tmp_dir, 'sentences.%d' % k))
+            with open(filenames[-1], 'w') as f:
+                f.writelines(sentence + '\n' for sentence in input_sentences)
+        report = quantization_report(text_class_model, quantized_model, vocabularies, filenames, params,
+                                     min(params['INSTANCES_TO_ADD'], len(sentences[0]) // 10))
+    finally:
+        shutil.rmtree(tmp_dir)
+    report.update({'quantization': params['EMBEDDING_QUANTIZATION'], 'embedding_bytes': original_bytes,
+                   'quantized_embedding_bytes': quantized_bytes})
+
+    quantized_model.model_path = quantized_store_path(params)
+    if not os.path.isdir(quantized_model.model_path):
+        os.makedirs(quantized_model.model_path)
+    saveModel(quantized_model, params['RELOAD'])
+    with open(quantized_model.model_path + 'quantization_report.json', 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+def serve_Clas_model(params):
+    """
+        Loads a trained model once and scores the sentences sent to the scoring server (see utils/scoring_server.py).
+        The vocabularies are taken from the stored model, so the dataset is not rebuilt.
+    """
+    text_class_model = load_scoring_model(params)
+    vocabularies = [text_class_model.vocabularies[id_in] for id_in in params['INPUTS_IDS_DATASET']]
+    serve(text_class_model, vocabularies, params)
 
-        # Apply model predictions
-        params_prediction = {'batch_size': params['BATCH_SIZE'],
-                             'n_parallel_loaders': params['PARALLEL_LOADERS'],
-                             'predict_on_sets': ['test']}
 
-        prediction_probs = text_class_model.predictNet(dataset, params_prediction)['test']
-        positive_lines_src, positive_lines_trg, negative_lines_src, negative_lines_trg, neutral_lines_src, neutral_lines_trg = \
-            process_prediction_probs(prediction_probs, params['INSTANCES_TO_ADD'],
-                                     pool_filename + '.' + params['SRC_LAN'],
-                                     pool_filename + '.' + params['TRG_LAN'],
-                                     verbose=params['VERBOSE'])
+def score_corpus(params, filenames, dest_filename):
+    """
+        Scores the sentences of filenames (one file per model input) with a trained model and writes the class
+        probabilities of each sentence to dest_filename. Uses the pipelined scoring, without building a Dataset.
 
-        print "Adding", len(positive_lines_src), "positive lines"
-        print "Positive sample:", positive_lines_src[0], "---", positive_lines_trg[0]
-        print "Adding", len(negative_lines_trg), "negative lines"
-        print "Negative sample:", negative_lines_src[0], "---", negative_lines_trg[0]
+        If SCORING_MODELS lists several model folders (instead of STORE_PATH), the corpus is read and tokenized once for
+        all of them, and dest_filename holds one column per model, with its in-domain probability.
+    """
+    if params['SCORING_MODELS']:
+        models = [load_scoring_model(dict(params, STORE_PATH=store_path)) for store_path in params['SCORING_MODELS']]
+        text_class_model = StackedModels(models)
+        logging.info('Scoring with %d models: %s' % (len(models), ', '.join(params['SCORING_MODELS'])))
+    else:
+        text_class_model = load_scoring_model(params)
+    vocabularies = [text_class_model.vocabularies[id_in] for id_in in params['INPUTS_IDS_DATASET']]
+    if len(filenames) != len(vocabularies):
+        raise AttributeError, 'The model has %d inputs but %d files were given' % (len(vocabularies), len(filenames))
+    _, stats = score_files(text_class_model, vocabularies, filenames, params, dest_filename=dest_filename)
+    return stats
+
+
+def score_files(model, vocabularies, filenames, params, dest_filename=None, budget=None, sketch=None):
+    """
+        Scores corpus files without a Dataset: with SCORING_PROCESSES forked processes sharing the model if it is > 1,
+        or with the pipelined scoring otherwise. If a MemoryBudget is given, the scoring (and the memory of its forked
+        processes) is kept within it. If a QuantileSketch is given, it is fed with the in-domain probabilities while
+        scoring (one sketch per forked process, merged at the end).
 
-        print "Adding", len(neutral_lines_src), "neutral lines"
-        print "Neutral sample:", neutral_lines_src[0], "---", neutral_lines_trg[0]
+        :return: (class probabilities array, statistics)
+    """
+    if params['SCORING_PROCESSES'] > 1:
+        return forked_scoring(model, vocabularies, filenames, params, dest_filename=dest_filename, budget=budget,
+                              sketch=sketch)
+    return pipelined_scoring(model, vocabularies, filenames, params, dest_filename=dest_filename, budget=budget,
+                             sketch=sketch)
 
-        new_pos_file_src = open(new_pos_filename + '.' + params['SRC_LAN'], 'a')
-        new_pos_file_trg = open(new_pos_filename + '.' + params['TRG_LAN'], 'a')
 
-        new_neg_file_src = open(new_neg_filename + '.' + params['SRC_LAN'], 'a')
-        new_neg_file_trg = open(new_neg_filename + '.' + params['TRG_LAN'], 'a')
+def semisupervised_selection(params):
+    from data_engine.prepare_data import build_dataset, build_pool_dataset
 
-        new_pool_file_src = open(new_pool_filename + '.' + params['SRC_LAN'], 'w')
-        new_pool_file_trg = open(new_pool_filename + '.' + params['TRG_LAN'], 'w')
+    check_params(params)
+    initial_pos_filename = params['POSITIVE_FILENAME']
+    initial_neg_filename = params['NEGATIVE_FILENAME']
+    initial_pool_filename = params['POOL_FILENAME']
 
-        for line in positive_lines_src:
-            new_pos_file_src.write(line)
-        for line in positive_lines_trg:
-            new_pos_file_trg.write(line)
+    pos_filename = params['DATA_ROOT_PATH'] + '/' + initial_pos_filename
+    # Without VIRTUAL_TRAINING_SET, the in-domain corpus is appended to the selected positive sentences of each
+    # iteration in a temporary file
+    in_domain_filename = pos_filename
+    if not params['VIRTUAL_TRAINING_SET']:
+        in_domain_file_src = open_corpus(pos_filename + '.' + params['SRC_LAN'])
+        in_domain_src = in_domain_file_src.readlines()
+        in_domain_file_src.close()
+        if params['BILINGUAL_SELECTION']:
+            in_domain_file_trg = open_corpus(pos_filename + '.' + params['TRG_LAN'])
+            in_domain_trg = in_domain_file_trg.readlines()
+            in_domain_file_trg.close()
 
-        for line in negative_lines_src:
-            new_neg_file_src.write(line)
-        for line in negative_lines_trg:
-            new_neg_file_trg.write(line)
-        for line in neutral_lines_src:
-            new_pool_file_src.write(line)
-        for line in neutral_lines_trg:
-            new_pool_file_trg.write(line)
+    neg_filename = params['DATA_ROOT_PATH'] + '/' + initial_neg_filename
 
-        new_pos_file_src.close()
-        new_pos_file_trg.close()
+    # Line ranges of the sentences selected in the previous iteration, within the training positive/negative files
+    params['NEW_INSTANCES_RANGES'] = dict()
+    n_positive_selected = 0
+    n_negative_lines = 0
+    if params['MAX_TRAINING_INSTANCES_PER_CLASS'] > 0:
+        with open_corpus(neg_filename + '.' + params['SRC_LAN']) as f:
+            n_negative_lines = sum(1 for _ in f)
 
-        new_neg_file_src.close()
-        new_neg_file_trg.close()
+    pool_filename = params['DATA_ROOT_PATH'] + '/' + initial_pool_filename
 
-        new_pool_file_src.close()
-        new_pool_file_trg.close()
+    # Compression extension of the corpora written to DEST_ROOT_PATH
+    compression = params['CORPUS_COMPRESSION']
 
-        pos_filename = new_pos_filename
-        neg_filename = new_neg_filename
-        pool_filename = new_pool_filename
+    if params['INCREMENTAL_RESCORING']:
+        score_store = ScoreStore(params['DEST_ROOT_PATH'] + '/' + params['SCORE_STORE_FILENAME'])
 
-        if len(neutral_lines_src) < 2 * params['INSTANCES_TO_ADD']:
-            logger.warning("We got out of neutral sentences (from the pool) to classify!. Stopping the process.")
-            break
+    convergence = ConvergenceMonitor(params)
+    recorder = phase_recorder(params)
+    budget = memory_budget(params)
+    budget.start()
+    try:
+        for i in range(params['N_ITER']):
+            print "------------------ Starting iteration", i, "------------------"
+            new_pos_filename = params['DEST_ROOT_PATH'] + '/' + initial_pos_filename + '_' + str(i)
+            new_pos_filename_tmp = params['DEST_ROOT_PATH'] + '/' + initial_pos_filename + '_' + 'temp'
+            if params['DEBUG']:
+                new_neg_filename_tmp = params['DEST_ROOT_PATH'] + '/' + initial_neg_filename + '_' + 'temp'
+            new_neg_filename = params['DEST_ROOT_PATH'] + '/' + initial_neg_filename + '_' + str(i)
+
+            new_pool_filename = params['DEST_ROOT_PATH'] + '/' + initial_pool_filename + '_' + str(i)
+
+            recorder.start('copy_files', i)
+            if params['VIRTUAL_TRAINING_SET']:
+                # The selected positive sentences and the in-domain corpus are read in place (see LabeledSources)
+                training_pos_filename = ([pos_filename] if i > 0 else []) + [in_domain_filename]
+            else:
+                training_pos_filename = new_pos_filename_tmp
+                if i > 0:
+                    copy_corpus(pos_filename + '.' + params['SRC_LAN'], new_pos_filename_tmp + '.' + params['SRC_LAN'])
+                    if params['BILINGUAL_SELECTION']:
+                        copy_corpus(pos_filename + '.' + params['TRG_LAN'],
+                                    new_pos_filename_tmp + '.' + params['TRG_LAN'])
+
+                with open(new_pos_filename_tmp + '.' + params['SRC_LAN'], "a") as f:
+                    for line in in_domain_src:
+                        f.write(line)
+
+                if params['BILINGUAL_SELECTION']:
+                    with open(new_pos_filename_tmp + '.' + params['TRG_LAN'], "a") as f:
+                        for line in in_domain_trg:
+                            f.write(line)
+            if i > 0:
+                copy_corpus(pos_filename + '.' + params['SRC_LAN'],
+                            new_pos_filename + '.' + params['SRC_LAN'] + compression)
+                copy_corpus(pos_filename + '.' + params['TRG_LAN'],
+                            new_pos_filename + '.' + params['TRG_LAN'] + compression)
+
+            copy_corpus(neg_filename + '.' + params['SRC_LAN'],
+                        new_neg_filename + '.' + params['SRC_LAN'] + compression)
+            if params['BILINGUAL_SELECTION'] or params['DEBUG']:
+                copy_corpus(neg_filename + '.' + params['TRG_LAN'],
+                            new_neg_filename + '.' + params['TRG_LAN'] + compression)
+            copy_corpus(pool_filename + '.' + params['SRC_LAN'],
+                        new_pool_filename + '.' + params['SRC_LAN'] + compression)
+            copy_corpus(pool_filename + '.' + params['TRG_LAN'],
+                        new_pool_filename + '.' + params['TRG_LAN'] + compression)
+            recorder.end('copy_files')
+
+            # Score each unique pair of the pool only once
+            recorder.start('dedup', i)
+            if params['DEDUP_POOL']:
+                dedup_index = DedupIndex(pool_filename + '.' + params['SRC_LAN'],
+                                         pool_filename + '.' + params['TRG_LAN'],
+                                         verbose=params['VERBOSE'])
+                scored_pool_filename = new_pool_filename + '_unique'
+                dedup_index.write_unique(scored_pool_filename + '.' + params['SRC_LAN'],
+                                         scored_pool_filename + '.' + params['TRG_LAN'])
+                dedup_index.report()
+            else:
+                dedup_index = None
+                scored_pool_filename = new_pool_filename
+            recorder.end('dedup', lines=len(dedup_index.hashes) if dedup_index is not None else None)
+
+            # Rescore only a sample and the sentences near the selection boundaries
+            recorder.start('rescoring_setup', i)
+            dataset_pool_filename = scored_pool_filename
+            rescore_positions = None
+            if params['INCREMENTAL_RESCORING']:
+                pool_keys = dedup_index.hashes if dedup_index is not None else \
+                    hash_pool(scored_pool_filename + '.' + params['SRC_LAN'],
+                              scored_pool_filename + '.' + params['TRG_LAN'])
+                previous_scores, _, found = score_store.lookup(pool_keys)
+                if i > 0 and len(pool_keys) > 0 and found.all():
+                    rescore_positions, sample_positions = \
+                        select_rescoring_subset(previous_scores,
+                                                params['INSTANCES_TO_ADD'],
+                                                params['RESCORE_SAMPLE_SIZE'],
+                                                int(params['RESCORE_BOUNDARY_MARGIN'] * params['INSTANCES_TO_ADD']),
+                                                seed=i)
+                    dataset_pool_filename = new_pool_filename + '_rescore'
+                    for lang in [params['SRC_LAN'], params['TRG_LAN']]:
+                        extract_lines(scored_pool_filename + '.' + lang, dataset_pool_filename + '.' + lang,
+                                      rescore_positions,
+                                      line_index=corpus_line_index(scored_pool_filename + '.' + lang,
+                                                                   enabled=params['USE_LINE_INDEX']))
+                    logging.info('Incremental rescoring: %d of %d pool sentences will be rescored.' %
+                                 (len(rescore_positions), len(pool_keys)))
+            recorder.end('rescoring_setup')
+
+            params = update_config_params(params,
+                                          training_pos_filename,
+                                          new_neg_filename,
+                                          dataset_pool_filename)
+
+            recorder.start('prepare_training_files', i)
+            params = process_files_binary_classification(params, i=i, budget=budget)
+            recorder.end('prepare_training_files')
+            ########### Load data
+            # The pipelined scorer reads the pool by itself, instead of loading it into the Dataset
+            if budget.enabled and not params['PIPELINED_SCORING'] and \
+                    not budget.fits(corpus_memory_mb(pool_input_files(params, dataset_pool_filename)),
+                                    'loading the pool into the Dataset'):
+                logging.info('Scoring the pool with the pipelined scorer from now on (PIPELINED_SCORING).')
+                params['PIPELINED_SCORING'] = True
+            budget.check('build_dataset')
+            recorder.start('build_dataset', i)
+            dataset = build_dataset(params)
+            params['INPUT_SRC_VOCABULARY_SIZE'] = dataset.vocabulary_len[params['INPUTS_IDS_DATASET'][0]]
+            if params['BILINGUAL_SELECTION']:
+                params['INPUT_TRG_VOCABULARY_SIZE'] = dataset.vocabulary_len[params['INPUTS_IDS_DATASET'][1]]
+            recorder.end('build_dataset', lines=dataset.len_train)
+            ###########
+
+            ########### Build model
+            recorder.start('build_model', i)
+            text_class_model = build_classifier(params, dataset)
+            recorder.end('build_model')
+
+            ########### Callbacks
+            callbacks = buildCallbacks(params, text_class_model, dataset)
+            ###########
+
+            ########### Training
+            budget.check('training')
+            total_start_time = timer()
+            recorder.start('training', i)
+
+            logger.debug('Starting training!')
+            training_params = {'n_epochs': params['MAX_EPOCH'], 'batch_size': params['BATCH_SIZE'],
+                               'homogeneous_batches': params['HOMOGENEOUS_BATCHES'],
+                               'shuffle': False if 'train' in params['EVAL_ON_SETS'] else True,
+                               'epochs_for_save': params['EPOCHS_FOR_SAVE'],
+                               'verbose': params['VERBOSE'],
+                               'eval_on_sets': params['EVAL_ON_SETS_KERAS'],
+                               'n_parallel_loaders': params['PARALLEL_LOADERS'],
+                               'extra_callbacks': callbacks, 'reload_epoch': params['RELOAD'],
+                               'data_augmentation': params['DATA_AUGMENTATION']}
+            train_classifier(params, text_class_model, dataset, training_params)
+            recorder.end('training', lines=dataset.len_train)
+            total_end_time = timer()
+            time_difference = total_end_time - total_start_time
+            logging.info('In total is {0:.2f}s = {1:.2f}m'.format(time_difference, time_difference / 60.0))
+            ###########
+
+            # Apply model predictions
+            budget.check('prediction')
+            recorder.start('prediction', i)
+            params_prediction = {'batch_size': params['PREDICTION_BATCH_SIZE'],
+                                 'n_parallel_loaders': params['PREDICTION_LOADERS'],
+                                 'predict_on_sets': ['test']}
+
+            vocabularies = [dataset.vocabulary[id_in] for id_in in params['INPUTS_IDS_DATASET']]
+            # Sketch of the scores for the 'quantile' policy, fed while scoring the pool
+            sketch = None
+            if params['PIPELINED_SCORING']:
+                sketch = score_sketch(params)
+                prediction_probs, _ = score_files(text_class_model, vocabularies,
+                                                  pool_input_files(params, dataset_pool_filename), params,
+                                                  budget=budget, sketch=sketch)
+            else:
+                prediction_probs = text_class_model.predictNet(dataset, params_prediction)['test']
+            if params['INCREMENTAL_RESCORING']:
+                prediction_probs = np.array(prediction_probs, dtype='float32').reshape(-1, 2)
+                if rescore_positions is not None:
+                    drift = score_drift(previous_scores[sample_positions],
+                                        prediction_probs[np.searchsorted(rescore_positions, sample_positions)])
+                    logging.info('Score drift on the rescoring sample: %.4f' % drift)
+                    if drift > params['RESCORE_MAX_DRIFT']:
+                        logging.info('Score drift above %.4f. Rescoring the whole pool.' % params['RESCORE_MAX_DRIFT'])
+                        if params['PIPELINED_SCORING']:
+                            sketch = score_sketch(params)
+                            prediction_probs, _ = score_files(text_class_model, vocabularies,
+                                                              pool_input_files(params, scored_pool_filename), params,
+                                                              budget=budget, sketch=sketch)
+                        else:
+                            pool_dataset = build_pool_dataset(params, dataset.vocabulary,
+                                                              pool_input_files(params, scored_pool_filename))
+                            prediction_probs = text_class_model.predictNet(pool_dataset, params_prediction)['test']
+                        prediction_probs = np.array(prediction_probs, dtype='float32').reshape(-1, 2)
+                        score_store.update(pool_keys, prediction_probs, i)
+                    else:
+                        score_store.update(pool_keys[rescore_positions], prediction_probs, i)
+                        rescored_probs = prediction_probs
+                        sketch = None  # Only the rescored sentences were sketched
+                        prediction_probs = previous_scores
+                        prediction_probs[rescore_positions] = rescored_probs
+                else:
+                    score_store.update(pool_keys, prediction_probs, i)
+                score_store.save()
+            recorder.end('prediction', lines=len(prediction_probs))
+
+            if params['WRITE_FULL_RANKING']:
+                pool_scores = np.array(prediction_probs, dtype='float32').reshape(-1, 2)[:, 1]
+                # Named after the pool it ranks (that of the previous iteration): its line numbers index that file
+                write_full_ranking(dedup_index.expand(pool_scores) if dedup_index is not None else pool_scores,
+                                   params['DEST_ROOT_PATH'] + '/' + os.path.basename(pool_filename) + '_ranking',
+                                   sort_chunk_size=budget.chunk_size(params['RANKING_SORT_CHUNK'], SORT_BYTES))
+
+            budget.check('selection')
+            recorder.start('selection', i)
+            score_chunk_size = budget.chunk_size(params['SCORE_CHUNK_SIZE'], SCORE_BYTES)
+            thresholds = None
+            if params['SELECTION_POLICY'] != 'top-r':
+                thresholds = selection_thresholds(np.array(prediction_probs, dtype='float32').reshape(-1, 2)[:, 1],
+                                                  dict(params, SCORE_CHUNK_SIZE=score_chunk_size), sketch=sketch)
+                logging.info('Selection thresholds: positive >= %.4f, negative <= %.4f' % thresholds)
+            line_indexes = [corpus_line_index(pool_filename + '.' + lang, enabled=params['USE_LINE_INDEX'])
+                            for lang in [params['SRC_LAN'], params['TRG_LAN']]]
+            line_indexes = line_indexes if None not in line_indexes else None
+            selection = selection_decisions(prediction_probs, params['INSTANCES_TO_ADD'],
+                                            dedup_index=dedup_index,
+                                            keep_duplicates=params['DEDUP_KEEP_DUPLICATES'],
+                                            thresholds=thresholds,
+                                            chunk_size=score_chunk_size)
+            # The partitioned lines are written while reading the pool if they do not fit in the memory budget
+            pool_files = [pool_filename + '.' + params['SRC_LAN'], pool_filename + '.' + params['TRG_LAN']]
+            stream_partitions = budget.enabled and \
+                not budget.fits(corpus_memory_mb(pool_files, len(selection)), 'the partitioned pool lines')
+            if not stream_partitions:
+                positive_lines_src, positive_lines_trg, negative_lines_src, negative_lines_trg, neutral_lines_src, neutral_lines_trg = \
+                    process_prediction_probs(prediction_probs, params['INSTANCES_TO_ADD'],
+                                             pool_files[0],
+                                             pool_files[1],
+                                             verbose=params['VERBOSE'],
+                                             dedup_index=dedup_index,
+                                             keep_duplicates=params['DEDUP_KEEP_DUPLICATES'],
+                                             thresholds=thresholds,
+                                             chunk_size=score_chunk_size,
+                                             line_indexes=line_indexes,
+                                             selection=selection)
+
+            pool_scores = np.array(prediction_probs, dtype='float32').reshape(-1, 2)[:, 1]
+            val_metrics = [callback.final_metrics for callback in callbacks if getattr(callback, 'final_metrics', None)]
+            convergence.update(i, dedup_index.expand(pool_scores) if dedup_index is not None else pool_scores,
+                               selection, val_metric=val_metrics[0].get(params['STOP_METRIC']) if val_metrics else None)
+
+            recorder.end('selection', lines=len(selection))
+
+            recorder.start('write', i)
+            new_pos_file_src = open_corpus(new_pos_filename + '.' + params['SRC_LAN'] + compression, 'a')
+            new_pos_file_trg = open_corpus(new_pos_filename + '.' + params['TRG_LAN'] + compression, 'a')
+
+            new_neg_file_src = open_corpus(new_neg_filename + '.' + params['SRC_LAN'] + compression, 'a')
+            new_neg_file_trg = open_corpus(new_neg_filename + '.' + params['TRG_LAN'] + compression, 'a')
+
+            new_pool_file_src = open_corpus(new_pool_filename + '.' + params['SRC_LAN'] + compression, 'w')
+            new_pool_file_trg = open_corpus(new_pool_filename + '.' + params['TRG_LAN'] + compression, 'w')
+
+            if stream_partitions:
+                counts, samples = write_partitions(selection, pool_files[0], pool_files[1],
+                                                   {POSITIVE: (new_pos_file_src, new_pos_file_trg),
+                                                    NEGATIVE: (new_neg_file_src, new_neg_file_trg),
+                                                    NEUTRAL: (new_pool_file_src, new_pool_file_trg)})
+                n_positive, n_negative, n_neutral = counts[POSITIVE], counts[NEGATIVE], counts[NEUTRAL]
+            else:
+                for line in positive_lines_src:
+                    new_pos_file_src.write(line)
+                for line in positive_lines_trg:
+                    new_pos_file_trg.write(line)
+
+                for line in negative_lines_src:
+                    new_neg_file_src.write(line)
+                for line in negative_lines_trg:
+                    new_neg_file_trg.write(line)
+                for line in neutral_lines_src:
+                    new_pool_file_src.write(line)
+                for line in neutral_lines_trg:
+                    new_pool_file_trg.write(line)
+                n_positive, n_negative, n_neutral = \
+                    len(positive_lines_src), len(negative_lines_src), len(neutral_lines_src)
+                samples = dict((decision, (lines_src[0], lines_trg[0])) for decision, lines_src, lines_trg in
+                               [(POSITIVE, positive_lines_src, positive_lines_trg),
+                                (NEGATIVE, negative_lines_src, negative_lines_trg),
+                                (NEUTRAL, neutral_lines_src, neutral_lines_trg)] if lines_src)
+                del positive_lines_src, positive_lines_trg, negative_lines_src, negative_lines_trg, neutral_lines_src, \
+                    neutral_lines_trg
+
+            new_pos_file_src.close()
+            new_pos_file_trg.close()
+
+            new_neg_file_src.close()
+            new_neg_file_trg.close()
+
+            new_pool_file_src.close()
+            new_pool_file_trg.close()
+            recorder.end('write', lines=n_positive + n_negative + n_neutral)
+
+            print "Adding", n_positive, "positive lines"
+            if POSITIVE in samples:
+                print "Positive sample:", samples[POSITIVE][0], "---", samples[POSITIVE][1]
+            print "Adding", n_negative, "negative lines"
+            if NEGATIVE in samples:
+                print "Negative sample:", samples[NEGATIVE][0], "---", samples[NEGATIVE][1]
+
+            print "Adding", n_neutral, "neutral lines"
+            if NEUTRAL in samples:
+                print "Neutral sample:", samples[NEUTRAL][0], "---", samples[NEUTRAL][1]
+
+            pos_filename = new_pos_filename
+            neg_filename = new_neg_filename
+            pool_filename = new_pool_filename
+
+            params['NEW_INSTANCES_RANGES'] = {
+                'positive': (n_positive_selected, n_positive_selected + n_positive),
+                'negative': (n_negative_lines, n_negative_lines + n_negative)}
+            n_positive_selected += n_positive
+            n_negative_lines += n_negative
+
+            if n_neutral < 2 * params['INSTANCES_TO_ADD'] and params['SELECTION_POLICY'] == 'top-r' or n_neutral == 0:
+                logger.warning("We got out of neutral sentences (from the pool) to classify!. Stopping the process.")
+                break
+            if n_positive == 0 and n_negative == 0:
+                logger.warning("No sentence passed the selection thresholds. Stopping the process.")
+                break
+            if convergence.should_stop():
+                logger.warning("The selection converged for %d iterations. Stopping the process." %
+                               params['CONVERGENCE_PATIENCE'])
+                break
+    except KeyboardInterrupt:
+        # Raised in this thread by the memory monitor once the budget is exceeded
+        if budget.exceeded is not None:
+            raise MemoryBudgetExceeded, budget.exceeded
+        raise
+    finally:
+        budget.stop()
+        recorder.close()
 
 
 def buildCallbacks(params, model, dataset):
     """
         Builds the selected set of callbacks run during the training of the model
     """
+    from keras_wrapper.extra.callbacks import PrintPerformanceMetricOnEpochEndOrEachNUpdates
+    from utils.background_evaluation import BackgroundEvaluation
 
     callbacks = []
 
@@ -341,7 +712,9 @@ def buildCallbacks(params, model, dataset):
             if dataset.dic_classes.get(params['OUTPUTS_IDS_DATASET'][0]):
                 extra_vars['n_classes'] = len(dataset.dic_classes[params['OUTPUTS_IDS_DATASET'][0]])
 
-        if params['EVAL_EACH_EPOCHS']:
+        if params['EVAL_IN_BACKGROUND']:
+            callback_metric = BackgroundEvaluation(model, dataset, params, extra_vars)
+        elif params['EVAL_EACH_EPOCHS']:
             callback_metric = PrintPerformanceMetricOnEpochEndOrEachNUpdates(model,
                                                                              dataset,
                                                                              gt_id=params['OUTPUTS_IDS_DATASET'][0],
@@ -369,19 +742,33 @@ def check_params(params):
                        "We'll train WITHOUT pretrained embeddings!")
     if params['MODE'] == 'semisupervised-selection' and not params['BINARY_SELECTION']:
         raise AttributeError, 'When MODE = %s, BINARY_SELECTION must be set to True'
+    if params['EVAL_IN_BACKGROUND'] and not params['EVAL_EACH_EPOCHS']:
+        raise AttributeError, 'EVAL_IN_BACKGROUND evaluates every EVAL_EACH epochs: it cannot be used with ' \
+                              'EVAL_EACH_EPOCHS = False (evaluation every EVAL_EACH updates)'
 
 
-if __name__ == "__main__":
+def apply_inference_profile(params):
+    """
+        Applies the INFERENCE_PROFILE (if any) to a scoring run. Its BLAS threads can only be set before numpy is loaded
+        (cli.py does it), so a warning is logged if the process uses others.
+    """
+    inference_profile = load_inference_profile(params)
+    # The BLAS threads are shared with the training in the semisupervised selection
+    if inference_profile is not None and params['MODE'] != 'semisupervised-selection' and \
+            not set_blas_threads(inference_profile['blas_threads']):
+        logging.warning('The inference profile uses %d BLAS threads, which must be set before loading numpy: run '
+                        'it with cli.py, or set %s' % (inference_profile['blas_threads'],
+                                                       '/'.join(BLAS_THREADS_VARIABLES)))
 
-    params = load_parameters()
 
-    try:
-        for arg in sys.argv[1:]:
-            k, v = arg.split('=')
-            params[k] = ast.literal_eval(v)
-    except:
-        print 'Overwritten arguments must have the form key=Value'
-        exit(1)
+def run(params):
+    """
+        Runs the MODE of params.
+    """
+    from keras_wrapper.extra import read_write
+
+    if params['MODE'] in ['sampling', 'serving', 'semisupervised-selection']:
+        apply_inference_profile(params)
     read_write.clean_dir(params['DEST_ROOT_PATH'])
     if params['MODE'] == 'training':
         logging.info('Running training.')
@@ -392,5 +779,24 @@ if __name__ == "__main__":
     elif params['MODE'] == 'semisupervised-selection':
         logging.info('Running semisupervised selection.')
         semisupervised_selection(params)
+    elif params['MODE'] == 'calibration':
+        logging.info('Running inference calibration.')
+        calibrate(params)
+    elif params['MODE'] == 'serving':
+        logging.info('Running scoring server.')
+        serve_Clas_model(params)
+    elif params['MODE'] == 'quantization':
+        logging.info('Running embedding quantization.')
+        quantize_Clas_model(params)
 
     logging.info('Done!')
+
+
+if __name__ == "__main__":
+
+    try:
+        params = load_params(sys.argv[1:])
+    except:
+        print 'Overwritten arguments must have the form key=Value'
+        exit(1)
+    run(params)
@@ -7,6 +7,8 @@ from keras.regularizers import l2
 from keras_wrapper.cnn_model import CNN_Model
 from keras_wrapper.extra.regularize import Regularize
 
+from utils.embeddings import embedding_matrix, load_word_vectors
+
 
 class Text_Classification_Model(CNN_Model):
     def __init__(self, params, type='Basic_Text_Classification_Model', verbose=1, structure_path=None,
@@ -49,7 +51,7 @@ class Text_Classification_Model(CNN_Model):
             if self.verbose > 0:
                 logging.info(
                     "<<< Loading pretrained word vectors from file " + params['SRC_PRETRAINED_VECTORS'] + " >>>")
-            self.word_vectors_src = np.load(os.path.join(params['SRC_PRETRAINED_VECTORS'])).item()
+            self.word_vectors_src = load_word_vectors(os.path.join(params['SRC_PRETRAINED_VECTORS']))
         else:
             self.word_vectors_src = dict()
 
@@ -58,7 +60,7 @@ class Text_Classification_Model(CNN_Model):
             if self.verbose > 0:
                 logging.info(
                     "<<< Loading pretrained word vectors from file " + params['TRG_PRETRAINED_VECTORS'] + " >>>")
-            self.word_vectors_trg = np.load(os.path.join(params['TRG_PRETRAINED_VECTORS'])).item()
+            self.word_vectors_trg = load_word_vectors(os.path.join(params['TRG_PRETRAINED_VECTORS']))
         else:
             self.word_vectors_trg = dict()
 
@@ -130,11 +132,9 @@ class Text_Classification_Model(CNN_Model):
         self.ids_outputs = params['OUTPUTS_IDS_MODEL']
 
         # Prepare GLOVE vectors for text embedding initialization
-        embedding_weights = np.random.rand(params['INPUT_SRC_VOCABULARY_SIZE'],
-                                           params['SRC_TEXT_EMBEDDING_HIDDEN_SIZE'])
-        for word, index in self.vocabularies[self.ids_inputs[0]]['words2idx'].iteritems():
-            if self.word_vectors_src.get(word) is not None:
-                embedding_weights[index, :] = self.word_vectors_src[word]
+        embedding_weights = embedding_matrix(self.vocabularies[self.ids_inputs[0]], self.word_vectors_src,
+                                             params['INPUT_SRC_VOCABULARY_SIZE'],
+                                             params['SRC_TEXT_EMBEDDING_HIDDEN_SIZE'])
         self.word_vectors_src = {}
 
         # Source text
@@ -190,11 +190,9 @@ class Text_Classification_Model(CNN_Model):
         self.ids_outputs = params['OUTPUTS_IDS_MODEL']
 
         # Prepare GLOVE vectors for text embedding initialization
-        embedding_weights = np.random.rand(params['INPUT_SRC_VOCABULARY_SIZE'],
-                                           params['SRC_TEXT_EMBEDDING_HIDDEN_SIZE'])
-        for word, index in self.vocabularies[self.ids_inputs[0]]['words2idx'].iteritems():
-            if self.word_vectors_src.get(word) is not None:
-                embedding_weights[index, :] = self.word_vectors_src[word]
+        embedding_weights = embedding_matrix(self.vocabularies[self.ids_inputs[0]], self.word_vectors_src,
+                                             params['INPUT_SRC_VOCABULARY_SIZE'],
+                                             params['SRC_TEXT_EMBEDDING_HIDDEN_SIZE'])
         self.word_vectors_src = {}
 
         # Source text
@@ -248,11 +246,9 @@ class Text_Classification_Model(CNN_Model):
         self.ids_outputs = params['OUTPUTS_IDS_MODEL']
 
         # Prepare GLOVE vectors for text embedding initialization
-        embedding_weights = np.random.rand(params['INPUT_SRC_VOCABULARY_SIZE'],
-                                           params['SRC_TEXT_EMBEDDING_HIDDEN_SIZE'])
-        for word, index in self.vocabularies[self.ids_inputs[0]]['words2idx'].iteritems():
-            if self.word_vectors_src.get(word) is not None:
-                embedding_weights[index, :] = self.word_vectors_src[word]
+        embedding_weights = embedding_matrix(self.vocabularies[self.ids_inputs[0]], self.word_vectors_src,
+                                             params['INPUT_SRC_VOCABULARY_SIZE'],
+                                             params['SRC_TEXT_EMBEDDING_HIDDEN_SIZE'])
         self.word_vectors_src = {}
 
         # Source text model
@@ -303,11 +299,9 @@ class Text_Classification_Model(CNN_Model):
 
         # Target text model
         # Prepare GLOVE vectors for text embedding initialization
-        embedding_weights = np.random.rand(params['INPUT_TRG_VOCABULARY_SIZE'],
-                                           params['TRG_TEXT_EMBEDDING_HIDDEN_SIZE'])
-        for word, index in self.vocabularies[self.ids_inputs[1]]['words2idx'].iteritems():
-            if self.word_vectors_trg.get(word) is not None:
-                embedding_weights[index, :] = self.word_vectors_trg[word]
+        embedding_weights = embedding_matrix(self.vocabularies[self.ids_inputs[1]], self.word_vectors_trg,
+                                             params['INPUT_TRG_VOCABULARY_SIZE'],
+                                             params['TRG_TEXT_EMBEDDING_HIDDEN_SIZE'])
         self.word_vectors_trg = {}
 
         # Target text
@@ -372,11 +366,9 @@ class Text_Classification_Model(CNN_Model):
         self.ids_outputs = params['OUTPUTS_IDS_MODEL']
 
         # Prepare GLOVE vectors for text embedding initialization
-        embedding_weights = np.random.rand(params['INPUT_SRC_VOCABULARY_SIZE'],
-                                           params['SRC_TEXT_EMBEDDING_HIDDEN_SIZE'])
-        for word, index in self.vocabularies[self.ids_inputs[0]]['words2idx'].iteritems():
-            if self.word_vectors_src.get(word) is not None:
-                embedding_weights[index, :] = self.word_vectors_src[word]
+        embedding_weights = embedding_matrix(self.vocabularies[self.ids_inputs[0]], self.word_vectors_src,
+                                             params['INPUT_SRC_VOCABULARY_SIZE'],
+                                             params['SRC_TEXT_EMBEDDING_HIDDEN_SIZE'])
         self.word_vectors_src = {}
 
         # Source text model
@@ -418,11 +410,9 @@ class Text_Classification_Model(CNN_Model):
             src_out_layer = Regularize(src_out_layer, params, name=activation + '_%d_src' % i)
 
         # Prepare GLOVE vectors for text embedding initialization
-        embedding_weights = np.random.rand(params['INPUT_TRG_VOCABULARY_SIZE'],
-                                           params['TRG_TEXT_EMBEDDING_HIDDEN_SIZE'])
-        for word, index in self.vocabularies[self.ids_inputs[1]]['words2idx'].iteritems():
-            if self.word_vectors_trg.get(word) is not None:
-                embedding_weights[index, :] = self.word_vectors_trg[word]
+        embedding_weights = embedding_matrix(self.vocabularies[self.ids_inputs[1]], self.word_vectors_trg,
+                                             params['INPUT_TRG_VOCABULARY_SIZE'],
+                                             params['TRG_TEXT_EMBEDDING_HIDDEN_SIZE'])
         self.word_vectors_trg = {}
 
         # Target text
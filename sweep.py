@@ -0,0 +1,285 @@
+"""
+    Hyperparameter sweeps: trains one classifier per trial (a set of parameters overwriting the configuration) in
+    parallel worker processes, and collects their metrics and timings in a single table.
+
+        python sweep.py --grid grid.txt [KEY=Value ...]
+        python sweep.py --trials trials.txt [KEY=Value ...]
+
+    grid.txt holds a Python dict mapping parameters to lists of values (all their combinations are trained), and
+    trials.txt a Python list of dicts (one per trial).
+
+    The training data is read and tokenized once per distinct value of the DATASET_PARAMS, and the pretrained word
+    vectors and embedding matrices are loaded once, before starting the workers: the trials are forked from the
+    process holding them and share them. The data files themselves (POSITIVE_FILENAME, TEXT_FILES...) cannot vary
+    among the trials of a sweep.
+"""
+import argparse
+import ast
+import copy
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import traceback
+from Queue import Empty
+from timeit import default_timer as timer
+
+from config import derive_params
+from main import build_classifier, buildCallbacks, check_params, load_params, train_classifier
+from utils.blas_threads import BLAS_THREADS_VARIABLES, set_blas_threads
+from utils.embeddings import preload_embeddings
+from utils.semisupervised_selection import process_files_binary_classification
+
+logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+
+# Parameters used for building the Dataset. Trials that differ in any of them use different Dataset instances
+DATASET_PARAMS = ['PAD_ON_BATCH', 'FILL', 'MAX_INPUT_TEXT_LEN', 'TOKENIZATION_METHOD', 'INPUT_VOCABULARY_SIZE',
+                  'MIN_OCCURRENCES_VOCAB', 'OOV_BUCKETS', 'SAMPLE_WEIGHTS']
+
+# Datasets of the sweep, by their DATASET_PARAMS values. Set before forking the trials, which inherit them
+_datasets = dict()
+
+
+def sweep_trials(grid=None, trials=None):
+    """
+        Overrides of each trial: all the combinations of the values of grid, or the given list of trials.
+
+        :param grid: dict mapping parameters to lists of values
+        :param trials: list of dicts
+        :return: list of dicts
+    """
+    if trials is not None:
+        return [dict(trial) for trial in trials]
+    keys = sorted(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[key] for key in keys])]
+
+
+def trial_parameters(params, overrides, k):
+    """
+        Parameters of the k-th trial of a sweep. The parameters derived from MODEL_TYPE in config.py are derived again
+        if it is overridden (unless they are overridden too), as well as those derived in config.derive_params.
+    """
+    trial_params = copy.deepcopy(params)
+    if 'MODEL_TYPE' in overrides:
+        trial_params['PAD_ON_BATCH'] = 'CNN' not in overrides['MODEL_TYPE']
+        trial_params['FILL'] = 'end' if 'CNN' not in overrides['MODEL_TYPE'] else 'center'
+    for name, source in [('PREDICTION_BATCH_SIZE', 'BATCH_SIZE'), ('PREDICTION_LOADERS', 'PARALLEL_LOADERS')]:
+        if source in overrides and name not in overrides and name not in params.get('EXPLICIT_PARAMS', []):
+            trial_params[name] = None
+    trial_params.update(overrides)
+    trial_params['MODEL_NAME'] = 'trial_%d' % k
+    trial_params['STORE_PATH'] = os.path.join(params['SWEEP_PATH'], 'trial_%d' % k) + '/'
+    return derive_params(trial_params)
+
+
+def _dataset_key(params):
+    return tuple(repr(params[name]) for name in DATASET_PARAMS)
+
+
+def prepare_sweep_data(params, trials_params):
+    """
+        Builds the Datasets needed by the trials and preloads their embeddings.
+
+        :return: training files parameters (TEXT_FILES, CLASS_FILES...) shared by all the trials
+    """
+    from data_engine.prepare_data import build_dataset
+
+    if params['BINARY_SELECTION']:
+        params['POSITIVE_FILENAME'] = params['DATA_ROOT_PATH'] + '/' + params['POSITIVE_FILENAME']
+        params['NEGATIVE_FILENAME'] = params['DATA_ROOT_PATH'] + '/' + params['NEGATIVE_FILENAME']
+    params = process_files_binary_classification(params)
+    files_params = dict((name, params[name]) for name in ['POSITIVE_FILENAME', 'NEGATIVE_FILENAME', 'TEXT_FILES',
+                                                            'CLASS_FILES'])
+    for trial_params in trials_params:
+        trial_params.update(files_params)
+        key = _dataset_key(trial_params)
+        if key not in _datasets:
+            logging.info('Building the dataset %d of the sweep' % len(_datasets))
+            trial_params = dict(trial_params,
+                                DATASET_STORE_PATH=os.path.join(params['SWEEP_PATH'], 'datasets', str(len(_datasets))))
+            _datasets[key] = build_dataset(trial_params)
+        preload_embeddings(trial_params, _datasets[key])
+    return files_params
+
+
+def _evaluate(params, model, dataset):
+    """
+        Metrics of the trained model on each of the EVAL_ON_SETS.
+    """
+    from keras_wrapper.extra import evaluation
+
+    results = dict()
+    extra_vars = {'n_parallel_loaders': params['PREDICTION_LOADERS']}
+    if dataset.dic_classes.get(params['OUTPUTS_IDS_DATASET'][0]):
+        extra_vars['n_classes'] = len(dataset.dic_classes[params['OUTPUTS_IDS_DATASET'][0]])
+    for s in params['EVAL_ON_SETS']:
+        predictions = model.predictNet(dataset, {'batch_size': params['PREDICTION_BATCH_SIZE'],
+                                                 'n_parallel_loaders': params['PREDICTION_LOADERS'],
+                                                 'predict_on_sets': [s]})[s]
+        extra_vars[s] = {'references': dataset.extra_variables[s][params['OUTPUTS_IDS_DATASET'][0]]}
+        results[s] = dict()
+        for metric in params['METRICS']:
+            results[s].update(evaluation.select[metric](pred_list=predictions, verbose=0, extra_vars=extra_vars,
+                                                        split=s))
+    return results
+
+
+def _run_trial(k, overrides, params, results):
+    """
+        Trains and evaluates a trial in a worker process. Puts its result in the results queue.
+    """
+    result = {'trial': k, 'overrides': overrides, 'status': 'ok', 'metrics': dict(), 'timings': dict()}
+    try:
+        dataset = _datasets[_dataset_key(params)]
+        start_time = timer()
+        model = build_classifier(params, dataset)
+        result['timings']['build_model'] = timer() - start_time
+
+        start_time = timer()
+        training_params = {'n_epochs': params['MAX_EPOCH'],
+                           'batch_size': params['BATCH_SIZE'],
+                           'homogeneous_batches': params['HOMOGENEOUS_BATCHES'],
+                           'shuffle': True,
+                           'epochs_for_save': params['EPOCHS_FOR_SAVE'],
+                           'verbose': params['VERBOSE'],
+                           'eval_on_sets': params['EVAL_ON_SETS_KERAS'],
+                           'n_parallel_loaders': params['PARALLEL_LOADERS'],
+                           'extra_callbacks': buildCallbacks(params, model, dataset),
+                           'reload_epoch': 0,
+                           'data_augmentation': params.get('DATA_AUGMENTATION', False)}
+        train_classifier(params, model, dataset, training_params)
+        result['timings']['training'] = timer() - start_time
+
+        start_time = timer()
+        result['metrics'] = _evaluate(params, model, dataset)
+        result['timings']['evaluation'] = timer() - start_time
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    # Includes the memory shared with the parent process (datasets, embeddings)
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    results.put(result)
+
+
+def _stop_set(params):
+    return 'val' if 'val' in params['EVAL_ON_SETS'] else (params['EVAL_ON_SETS'] or [None])[0]
+
+
+def results_table(results, params):
+    """
+        Tab-separated table of the results, sorted by the STOP_METRIC of the trials (on the 'val' set, or on the first
+        evaluated set).
+    """
+    keys = sorted(set(key for result in results for key in result['overrides']))
+    stop_set = _stop_set(params)
+
+    def stop_value(result):
+        return result['metrics'].get(stop_set, dict()).get(params['STOP_METRIC'])
+
+    def value(v):
+        return '%.4f' % v if isinstance(v, float) else '-' if v is None else str(v)
+
+    lines = ['\t'.join(['trial', 'status'] + keys + ['%s (%s)' % (params['STOP_METRIC'], stop_set), 'build_model (s)',
+                                                    'training (s)', 'evaluation (s)', 'peak RSS (MB)'])]
+    for result in sorted(results, key=lambda result: (stop_value(result) is None, -(stop_value(result) or 0.))):
+        lines.append('\t'.join([str(result['trial']), result['status']] +
+                               [value(result['overrides'].get(key)) for key in keys] +
+                               [value(stop_value(result))] +
+                               [value(result['timings'].get(phase)) for phase in ['build_model', 'training',
+                                                                                  'evaluation']] +
+                               [value(result['peak_rss_mb'])]))
+    return '\n'.join(lines)
+
+
+def run_sweep(params, trials):
+    """
+        Runs the trials, at most SWEEP_WORKERS at a time, with SWEEP_TRIAL_THREADS BLAS/OpenMP threads each. Writes
+        the results to SWEEP_PATH/results.json and SWEEP_PATH/results.tsv.
+
+        :param params: configuration parameters
+        :param trials: overrides of each trial (see sweep_trials)
+        :return: list of results (dicts)
+    """
+    # The trials inherit the threads settings of this process, which cli.py sets before loading numpy
+    if not set_blas_threads(params['SWEEP_TRIAL_THREADS']):
+        logging.warning('The trials will not use SWEEP_TRIAL_THREADS=%d BLAS threads, which must be set before loading '
+                        'numpy: run the sweep with cli.py, or set %s' % (params['SWEEP_TRIAL_THREADS'],
+                                                                        '/'.join(BLAS_THREADS_VARIABLES)))
+    check_params(params)
+    if not os.path.isdir(params['SWEEP_PATH']):
+        os.makedirs(params['SWEEP_PATH'])
+
+    trials_params = [trial_parameters(params, overrides, k) for k, overrides in enumerate(trials)]
+    start_time = timer()
+    prepare_sweep_data(params, trials_params)
+    preparation_time = timer() - start_time
+    logging.info('%d trials, %d datasets prepared in %.2fs' % (len(trials), len(_datasets), preparation_time))
+
+    # Trials run in regular (non-daemonic) processes, since they may start their own processes (TRAINING_WORKERS,
+    # EVAL_IN_BACKGROUND...)
+    queue = multiprocessing.Queue()
+    pending = list(enumerate(trials_params))
+    running = dict()
+    results = []
+    while pending or running:
+        while pending and len(running) < params['SWEEP_WORKERS']:
+            k, trial_params = pending.pop(0)
+            logging.info('Starting trial %d: %s' % (k, trials[k]))
+            running[k] = multiprocessing.Process(target=_run_trial, args=(k, trials[k], trial_params, queue))
+            running[k].start()
+        try:
+            result = queue.get(timeout=5)
+        except Empty:
+            for k, process in running.items():
+                if not process.is_alive() and process.exitcode != 0:
+                    del running[k]
+                    results.append({'trial': k, 'overrides': trials[k], 'status': 'died', 'metrics': dict(),
+                                    'timings': dict(), 'peak_rss_mb': None,
+                                    'error': 'Exit code %s' % process.exitcode})
+                    logging.error('Trial %d died (exit code %s)' % (k, process.exitcode))
+            continue
+        running.pop(result['trial']).join()
+        results.append(result)
+        if result['status'] == 'ok':
+            logging.info('Trial %d done in %.2fs: %s' % (result['trial'], sum(result['timings'].values()),
+                                                           result['metrics']))
+        else:
+            logging.error('Trial %d failed:\n%s' % (result['trial'], result['error']))
+
+    results.sort(key=lambda result: result['trial'])
+    with open(os.path.join(params['SWEEP_PATH'], 'results.json'), 'w') as f:
+        json.dump({'preparation_seconds': preparation_time, 'results': results}, f, indent=2, sort_keys=True)
+    table = results_table(results, params)
+    with open(os.path.join(params['SWEEP_PATH'], 'results.tsv'), 'w') as f:
+        f.write(table + '\n')
+    logging.info('Results written to %s/results.json and results.tsv\n%s' % (params['SWEEP_PATH'], table))
+    return results
+
+
+def load_trials(grid_filename=None, trials_filename=None):
+    """
+        Trials of a --grid or --trials file (Python literals).
+    """
+    if grid_filename is not None:
+        with open(grid_filename) as f:
+            return sweep_trials(grid=ast.literal_eval(f.read()))
+    with open(trials_filename) as f:
+        return sweep_trials(trials=ast.literal_eval(f.read()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Parallel hyperparameter sweep of the classifier')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--grid', help='File with a dict mapping parameters to lists of values')
+    group.add_argument('--trials', help='File with a list of dicts of parameters (one per trial)')
+    parser.add_argument('overrides', nargs='*', metavar='KEY=Value', help='Parameters overwriting config.py')
+    args = parser.parse_args()
+    try:
+        params = load_params(args.overrides)
+    except (ValueError, SyntaxError):
+        print 'Overwritten arguments must have the form key=Value'
+        sys.exit(1)
+    run_sweep(params, load_trials(args.grid, args.trials))
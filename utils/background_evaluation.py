@@ -0,0 +1,197 @@
+import logging
+import multiprocessing
+import traceback
+from Queue import Empty
+
+import numpy as np
+from keras.callbacks import Callback
+from keras_wrapper.extra import evaluation
+
+from utils.parallel_training import flat_weights, mapped_batch, set_flat_weights
+
+MAX_PENDING_EVALUATIONS = 2  # Epochs are not evaluated while this many evaluations are waiting
+
+
+def stratified_subsample(labels, n_samples, seed=0):
+    """
+        Fixed subsample of n_samples positions keeping the proportion of each label.
+
+        :param labels: label of each sample
+        :param n_samples: size of the subsample. If <= 0 or larger than the set, all the positions are returned
+        :return: sorted array of positions
+    """
+    labels = np.asarray(labels)
+    if n_samples <= 0 or n_samples >= len(labels):
+        return np.arange(len(labels))
+    rng = np.random.RandomState(seed)
+    selected = []
+    for label in np.unique(labels):
+        positions = np.flatnonzero(labels == label)
+        n_label = min(max(1, int(round(n_samples * len(positions) / float(len(labels))))), len(positions))
+        selected.append(rng.choice(positions, n_label, replace=False))
+    return np.sort(np.concatenate(selected))
+
+
+class BackgroundEvaluation(Callback):
+    def __init__(self, model, dataset, params, extra_vars):
+        """
+            Per-epoch evaluation that does not stall the training: at the end of each evaluated epoch the weights are
+            copied to shared memory and a forked process scores the evaluation sets with them while the training goes
+            on.
+            Each epoch is evaluated on a fixed stratified subsample of EVAL_SUBSAMPLE sentences of each set (the whole
+            set if EVAL_SUBSAMPLE is 0). The whole sets are evaluated with the final weights when the training ends.
+
+            If EARLY_STOP is set, the training is stopped once STOP_METRIC (on the 'val' set, or on the first evaluated
+            set) has not improved for PATIENCE evaluations. Since evaluations run in the background, the stop may
+            happen a few epochs after the last evaluated one.
+
+            Without EVAL_ON_SETS there is nothing to evaluate: the callback does nothing, and neither early stopping
+            nor the validation signal of the convergence monitor (final_metrics) are available.
+
+            :param model: Model_Wrapper being trained
+            :param dataset: Dataset with the evaluation sets
+            :param params: configuration parameters
+            :param extra_vars: extra variables for the evaluation metrics (as for PrintPerformanceMetric...)
+        """
+        super(BackgroundEvaluation, self).__init__()
+        self.model_wrapper = model
+        self.dataset = dataset
+        self.params = params
+        self.extra_vars = extra_vars
+        self.gt_id = params['OUTPUTS_IDS_DATASET'][0]
+        self.set_names = params['EVAL_ON_SETS']
+        self.stop_set = 'val' if 'val' in self.set_names else (self.set_names or [None])[0]
+        if self.stop_set is None:
+            logging.warning('EVAL_IN_BACKGROUND without EVAL_ON_SETS: no set will be evaluated%s, and the convergence '
+                            'of the selection is only judged on the pool scores' %
+                            (', EARLY_STOP is ignored' if params['EARLY_STOP'] else ''))
+        self.subsamples = dict()
+        for s in self.set_names:
+            references = dataset.extra_variables[s][self.gt_id]
+            labels = [str(references[i][0]) for i in range(len(references))]
+            self.subsamples[s] = stratified_subsample(labels, params['EVAL_SUBSAMPLE'], seed=len(self.subsamples))
+
+        self.best_value = None
+        self.best_epoch = None
+        self.wait = 0
+        self.last_epoch = 0
+        self.final_metrics = None  # Metrics of the full evaluation at the end of the training (on the stop set)
+        self.n_pending = 0
+        self.n_submitted = 0
+        self._process = None
+
+    def on_train_begin(self, logs=None):
+        if self.stop_set is None:
+            return
+        self._shapes = [w.shape for w in self.model_wrapper.model.get_weights()]
+        size = sum(int(np.prod(shape)) for shape in self._shapes)
+        # One slot of weights per evaluation that may be pending, shared with the forked process instead of pickled
+        self._slots = [multiprocessing.RawArray('f', size) for _ in range(MAX_PENDING_EVALUATIONS)]
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=self._work)
+        self._process.daemon = True
+        self._process.start()
+
+    def _evaluate(self, s, positions):
+        keras_model = self.model_wrapper.model
+        batch_size = self.params['PREDICTION_BATCH_SIZE']
+        predictions = []
+        for start in range(0, len(positions), batch_size):
+            x, _ = mapped_batch(self.model_wrapper, self.dataset, s, positions[start:start + batch_size])
+            predictions.append(keras_model.predict_on_batch(x))
+        predictions = np.concatenate(predictions)
+
+        references = self.dataset.extra_variables[s][self.gt_id]
+        extra_vars = dict(self.extra_vars)
+        extra_vars[s] = {'references': dict((k, references[i]) for k, i in enumerate(positions))}
+        metrics = dict()
+        for metric in self.params['METRICS']:
+            metrics.update(evaluation.select[metric](pred_list=list(predictions), verbose=0, extra_vars=extra_vars,
+                                                     split=s))
+        return metrics
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            epoch, slot, full = task
+            try:
+                set_flat_weights(self.model_wrapper.model, np.frombuffer(self._slots[slot], dtype='float32'),
+                                 self._shapes)
+                results = dict()
+                for s in self.set_names:
+                    positions = np.arange(len(self.dataset.extra_variables[s][self.gt_id])) if full \
+                        else self.subsamples[s]
+                    results[s] = self._evaluate(s, positions)
+                self._results.put((epoch, full, results, None))
+            except Exception:
+                self._results.put((epoch, full, None, traceback.format_exc()))
+
+    def _collect(self, block=False):
+        """
+            Processes the finished evaluations and updates the early stopping state.
+        """
+        while self.n_pending > 0:
+            try:
+                epoch, full, results, error = self._results.get(timeout=5 if block else 0.)
+            except Empty:
+                if block and self._process.is_alive():
+                    continue
+                if block:
+                    raise Exception, 'The background evaluation process died'
+                return
+            self.n_pending -= 1
+            if error is not None:
+                logging.error('Background evaluation of epoch %d failed:\n%s' % (epoch, error))
+                continue
+            for s in self.set_names:
+                logging.info('Epoch %d, %s set (%s): %s' %
+                             (epoch, s, 'full' if full else '%d sentences' % len(self.subsamples[s]),
+                              ', '.join('%s: %.4f' % (metric, value) for metric, value in sorted(results[s].items())
+                                        if isinstance(value, (int, float, np.number)))))
+            if full:
+                self.final_metrics = results[self.stop_set]
+                continue
+            value = results[self.stop_set].get(self.params['STOP_METRIC'])
+            if value is None:
+                continue
+            if self.best_value is None or value > self.best_value:
+                self.best_value, self.best_epoch, self.wait = value, epoch, 0
+            else:
+                self.wait += 1
+                if self.params['EARLY_STOP'] and self.wait >= self.params['PATIENCE'] and not self.model.stop_training:
+                    logging.info('Early stop: %s has not improved since epoch %d (%.4f)' %
+                                 (self.params['STOP_METRIC'], self.best_epoch, self.best_value))
+                    self.model.stop_training = True
+
+    def _submit(self, epoch, full=False):
+        # The evaluations run in order and fewer than MAX_PENDING_EVALUATIONS are pending, so the slot is not in use
+        slot = self.n_submitted % MAX_PENDING_EVALUATIONS
+        np.frombuffer(self._slots[slot], dtype='float32')[:] = flat_weights(self.model_wrapper.model)
+        self._tasks.put((epoch, slot, full))
+        self.n_submitted += 1
+        self.n_pending += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.stop_set is None:
+            return
+        epoch += 1 + self.params['RELOAD']
+        self.last_epoch = epoch
+        self._collect()
+        if epoch < self.params['START_EVAL_ON_EPOCH'] or epoch % self.params['EVAL_EACH'] != 0:
+            return
+        if self.n_pending >= MAX_PENDING_EVALUATIONS:
+            logging.info('Skipping the evaluation of epoch %d: %d evaluations pending' % (epoch, self.n_pending))
+            return
+        self._submit(epoch)
+
+    def on_train_end(self, logs=None):
+        if self.stop_set is None:
+            return
+        self._collect(block=True)
+        self._submit(self.last_epoch, full=True)
+        self._collect(block=True)
+        self._tasks.put(None)
+        self._process.join()
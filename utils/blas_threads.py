@@ -0,0 +1,36 @@
+import json
+import logging
+import os
+import sys
+
+# Environment variables setting the number of threads of the BLAS/OpenMP libraries. They are read when the libraries
+# are loaded, so the thread count of a running process cannot be changed.
+BLAS_THREADS_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+# This module does not import numpy, so that the entry points (cli.py) can set the threads before loading it
+
+
+def set_blas_threads(n_threads):
+    """
+        Sets n_threads BLAS/OpenMP threads for this process and the processes it starts. It only has an effect before
+        numpy (and Theano) are imported.
+
+        :return: whether the process uses n_threads threads
+    """
+    if all(os.environ.get(variable) == str(n_threads) for variable in BLAS_THREADS_VARIABLES):
+        return True
+    if 'numpy' in sys.modules:
+        return False
+    os.environ.update((variable, str(n_threads)) for variable in BLAS_THREADS_VARIABLES)
+    logging.info('Using %d BLAS threads' % n_threads)
+    return True
+
+
+def profile_blas_threads(params):
+    """
+        BLAS threads of the INFERENCE_PROFILE, or None if there is no profile.
+    """
+    if not params['INFERENCE_PROFILE'] or not os.path.isfile(params['INFERENCE_PROFILE']):
+        return None
+    with open(params['INFERENCE_PROFILE']) as f:
+        return json.load(f)['blas_threads']
@@ -0,0 +1,181 @@
+import cPickle as pk
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.blas_threads import BLAS_THREADS_VARIABLES
+from utils.corpus_io import open_corpus, resolve_corpus
+from utils.semisupervised_selection import pool_input_files
+
+
+def calibration_sentences(params, vocabularies, n_sentences, seed=0):
+    """
+        Sentences for the calibration: the first n_sentences of the pool if it is available, or random sequences of
+        vocabulary words otherwise.
+
+        :return: list of sentences per model input
+    """
+    pool_filename = params['DATA_ROOT_PATH'] + '/' + str(params.get('POOL_FILENAME'))
+    filenames = pool_input_files(params, pool_filename)
+    if all(os.path.exists(resolve_corpus(filename)) for filename in filenames):
+        files = [open_corpus(filename) for filename in filenames]
+        sentences = [[] for _ in filenames]
+        for lines in zip(*files):
+            for k, line in enumerate(lines):
+                sentences[k].append(line.rstrip('\n'))
+            if len(sentences[0]) >= n_sentences:
+                break
+        for f in files:
+            f.close()
+        if sentences[0]:
+            return sentences
+
+    logging.info('No pool found in %s. Calibrating on synthetic sentences.' % pool_filename)
+    rng = np.random.RandomState(seed)
+    sentences = []
+    for vocabulary in vocabularies:
+        words = [word for word in vocabulary['words2idx'] if not word.startswith('<')]
+        lengths = rng.randint(1, params['MAX_INPUT_TEXT_LEN'] + 1, size=n_sentences)
+        sentences.append([' '.join(words[w] for w in rng.randint(len(words), size=length)) for length in lengths])
+    return sentences
+
+
+def sweep(params):
+    """
+        Measures the scoring throughput (sentences/s) of the stored model for every combination of
+        CALIBRATION_BATCH_SIZES and CALIBRATION_LOADERS, with the BLAS thread count of the current process.
+
+        :return: list of results (dicts)
+    """
+    from keras_wrapper.cnn_model import loadModel
+    from data_engine.prepare_data import build_pool_dataset
+    from utils.pipelined_scoring import pipelined_scoring
+
+    model = loadModel(params['STORE_PATH'], params['RELOAD'])
+    vocabularies = [model.vocabularies[id_in] for id_in in params['INPUTS_IDS_DATASET']]
+    sentences = calibration_sentences(params, vocabularies, params['CALIBRATION_SENTENCES'])
+    n_sentences = len(sentences[0])
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filenames = []
+        for k, input_sentences in enumerate(sentences):
+            filenames.append(os.path.join(tmp_dir, 'calibration.%d' % k))
+            with open(filenames[-1], 'w') as f:
+                f.writelines(sentence + '\n' for sentence in input_sentences)
+        dataset = None
+        if not params['PIPELINED_SCORING']:
+            dataset = build_pool_dataset(params, model.vocabularies, filenames)
+
+        def score(batch_size, loaders):
+            if params['PIPELINED_SCORING']:
+                run_params = dict(params, PREDICTION_BATCH_SIZE=batch_size, SCORING_WORKERS=loaders, VERBOSE=0)
+                pipelined_scoring(model, vocabularies, filenames, run_params)
+            else:
+                model.predictNet(dataset, {'batch_size': batch_size, 'n_parallel_loaders': loaders,
+                                           'predict_on_sets': ['test']})
+
+        blas_threads = int(os.environ.get(BLAS_THREADS_VARIABLES[0], multiprocessing.cpu_count()))
+        results = []
+        for batch_size in params['CALIBRATION_BATCH_SIZES']:
+            for loaders in params['CALIBRATION_LOADERS']:
+                score(batch_size, loaders)  # Warm-up (function compilation, caches)
+                start_time = timer()
+                score(batch_size, loaders)
+                elapsed = timer() - start_time
+                results.append({'batch_size': batch_size, 'loaders': loaders, 'blas_threads': blas_threads,
+                                'sentences_per_second': n_sentences / elapsed})
+                logging.info('Calibration: batch size %5d, %2d loaders, %2d BLAS threads: %.1f sentences/s' %
+                             (batch_size, loaders, blas_threads, results[-1]['sentences_per_second']))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def calibrate(params):
+    """
+        Finds the fastest scoring settings for the stored model on this host and writes them to INFERENCE_PROFILE.
+        Each BLAS thread count of CALIBRATION_BLAS_THREADS is measured in a new process.
+
+        :return: the profile (dict)
+    """
+    tmp_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        params_filename = os.path.join(tmp_dir, 'params.pkl')
+        with open(params_filename, 'wb') as f:
+            pk.dump(params, f, protocol=pk.HIGHEST_PROTOCOL)
+        for blas_threads in params['CALIBRATION_BLAS_THREADS']:
+            results_filename = os.path.join(tmp_dir, 'results_%d.json' % blas_threads)
+            env = dict(os.environ)
+            env.update((variable, str(blas_threads)) for variable in BLAS_THREADS_VARIABLES)
+            command = [sys.executable, os.path.abspath(__file__), params_filename, results_filename]
+            if subprocess.call(command, env=env) != 0:
+                logging.warning('Calibration with %d BLAS threads failed' % blas_threads)
+                continue
+            with open(results_filename) as f:
+                results += json.load(f)
+    finally:
+        shutil.rmtree(tmp_dir)
+    if not results:
+        raise Exception, 'The calibration did not produce any result'
+
+    best = max(results, key=lambda result: result['sentences_per_second'])
+    profile = dict(best)
+    profile.update({'pipelined_scoring': params['PIPELINED_SCORING'],
+                    'model_type': params['MODEL_TYPE'],
+                    'hostname': socket.gethostname(),
+                    'cpu_count': multiprocessing.cpu_count(),
+                    'results': results})
+    with open(params['INFERENCE_PROFILE'], 'w') as f:
+        json.dump(profile, f, indent=2, sort_keys=True)
+    logging.info('Best scoring settings: batch size %d, %d loaders, %d BLAS threads (%.1f sentences/s). '
+                 'Stored in %s' % (best['batch_size'], best['loaders'], best['blas_threads'],
+                                   best['sentences_per_second'], params['INFERENCE_PROFILE']))
+    return profile
+
+
+def load_inference_profile(params):
+    """
+        Applies the scoring settings of INFERENCE_PROFILE (if it exists) to params, except those set explicitly
+        (EXPLICIT_PARAMS).
+
+        :return: the profile (dict), or None
+    """
+    if not params['INFERENCE_PROFILE'] or not os.path.isfile(params['INFERENCE_PROFILE']):
+        return None
+    with open(params['INFERENCE_PROFILE']) as f:
+        profile = json.load(f)
+    if profile['hostname'] != socket.gethostname():
+        logging.warning('The inference profile %s was calibrated on %s' % (params['INFERENCE_PROFILE'],
+                                                                         profile['hostname']))
+    settings = {'PREDICTION_BATCH_SIZE': profile['batch_size'],
+                'SCORING_WORKERS' if profile['pipelined_scoring'] else 'PREDICTION_LOADERS': profile['loaders']}
+    for key, value in sorted(settings.iteritems()):
+        if key in params.get('EXPLICIT_PARAMS', []):
+            logging.info('Keeping %s=%s instead of the inference profile value %s' % (key, params[key], value))
+        else:
+            params[key] = value
+    logging.info('Using the inference profile %s: batch size %d, %d loaders, %d BLAS threads' %
+                 (params['INFERENCE_PROFILE'], profile['batch_size'], profile['loaders'], profile['blas_threads']))
+    return profile
+
+
+if __name__ == "__main__":
+    # Calibration process spawned by calibrate(): python calibration.py params.pkl results.json
+    logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+    with open(sys.argv[1], 'rb') as f:
+        params = pk.load(f)
+    results = sweep(params)
+    with open(sys.argv[2], 'w') as f:
+        json.dump(results, f)
@@ -0,0 +1,100 @@
+import logging
+
+import numpy as np
+
+from utils.semisupervised_selection import POSITIVE, NEUTRAL
+
+
+def jaccard(a, b):
+    """
+        Jaccard overlap of two sets of positions.
+    """
+    a = np.unique(a)
+    b = np.unique(b)
+    union = len(np.union1d(a, b))
+    return len(np.intersect1d(a, b, assume_unique=True)) / float(union) if union else 1.
+
+
+def ks_distance(a, b):
+    """
+        Kolmogorov-Smirnov distance (largest difference between the empirical CDFs) of two samples.
+    """
+    if len(a) == 0 or len(b) == 0:
+        return 0.
+    a = np.sort(a)
+    b = np.sort(b)
+    values = np.concatenate([a, b])
+    return float(np.max(np.abs(np.searchsorted(a, values, side='right') / float(len(a)) -
+                               np.searchsorted(b, values, side='right') / float(len(b)))))
+
+
+class ConvergenceMonitor(object):
+    def __init__(self, params):
+        """
+            Tracks whether further iterations of the semisupervised selection still change the selection.
+            Signals computed at each iteration:
+                'jaccard': overlap between the positive sentences selected now and those the previous model would have
+                           selected next (its best-scored neutral sentences, in the same number)
+                'score_shift': mean absolute change of the scores of the sentences scored in both iterations
+                'score_ks': Kolmogorov-Smirnov distance between both score distributions of those sentences
+                'val_improvement': improvement of the validation STOP_METRIC over the best previous iteration
+            An iteration is converged when the signals satisfy CONVERGENCE_RULE ('all' or 'any') of:
+                jaccard >= CONVERGENCE_JACCARD, score_shift <= CONVERGENCE_SCORE_SHIFT,
+                val_improvement < CONVERGENCE_MIN_IMPROVEMENT (signals that are not available are ignored).
+            The run stops after CONVERGENCE_PATIENCE consecutive converged iterations.
+        """
+        self.params = params
+        self.expected_positions = None  # Positions in the next pool of the sentences the last model would select
+        self.carried_scores = None  # Last scores of the sentences of the next pool
+        self.best_val = None
+        self.n_converged = 0
+        self.history = []
+
+    def update(self, iteration, scores, selection, val_metric=None):
+        """
+            :param iteration: iteration number
+            :param scores: in-domain score of each line of the current pool
+            :param selection: decision of each line of the pool (see selection_decisions)
+            :param val_metric: validation metric of the model of this iteration, if available
+            :return: dict with the signals of the iteration
+        """
+        scores = np.asarray(scores, dtype='float32')
+        positive_positions = np.flatnonzero(selection == POSITIVE)
+        neutral_positions = np.flatnonzero(selection == NEUTRAL)
+        signals = {'iteration': iteration, 'jaccard': None, 'score_shift': None, 'score_ks': None,
+                   'val_metric': val_metric, 'val_improvement': None}
+
+        if self.expected_positions is not None and len(self.carried_scores) == len(scores):
+            signals['jaccard'] = jaccard(positive_positions, self.expected_positions)
+            signals['score_shift'] = float(np.mean(np.abs(scores - self.carried_scores))) if len(scores) else 0.
+            signals['score_ks'] = ks_distance(scores, self.carried_scores)
+        if val_metric is not None:
+            if self.best_val is not None:
+                signals['val_improvement'] = val_metric - self.best_val
+            self.best_val = val_metric if self.best_val is None else max(self.best_val, val_metric)
+
+        # The neutral sentences form the next pool, in the same order
+        neutral_scores = scores[neutral_positions]
+        n_expected = min(len(positive_positions), len(neutral_positions))
+        self.expected_positions = np.argpartition(-neutral_scores, n_expected - 1)[:n_expected] \
+            if n_expected > 0 else np.zeros(0, dtype='int64')
+        self.carried_scores = neutral_scores
+
+        checks = []
+        if signals['jaccard'] is not None:
+            checks.append(signals['jaccard'] >= self.params['CONVERGENCE_JACCARD'])
+            checks.append(signals['score_shift'] <= self.params['CONVERGENCE_SCORE_SHIFT'])
+        if signals['val_improvement'] is not None:
+            checks.append(signals['val_improvement'] < self.params['CONVERGENCE_MIN_IMPROVEMENT'])
+        converged = bool(checks) and (all(checks) if self.params['CONVERGENCE_RULE'] == 'all' else any(checks))
+        self.n_converged = self.n_converged + 1 if converged else 0
+        signals['converged'] = converged
+        self.history.append(signals)
+
+        logging.info('Convergence (iteration %d): %s' % (iteration, ', '.join(
+            '%s: %s' % (name, '%.4f' % signals[name] if isinstance(signals[name], float) else signals[name])
+            for name in ['jaccard', 'score_shift', 'score_ks', 'val_metric', 'val_improvement', 'converged'])))
+        return signals
+
+    def should_stop(self):
+        return self.params['CONVERGENCE_STOP'] and self.n_converged >= self.params['CONVERGENCE_PATIENCE']
@@ -0,0 +1,259 @@
+import bz2
+import os
+import shutil
+import subprocess
+import threading
+import zlib
+from Queue import Queue
+
+COMPRESSED_EXTENSIONS = ['.gz', '.bz2', '.xz']
+BUFFER_SIZE = 1 << 22  # Bytes read/written at once
+QUEUE_BLOCKS = 8  # Decompressed blocks buffered ahead by the reader thread
+
+
+def compression_extension(filename):
+    """
+        Compression extension of a corpus file ('.gz', '.bz2', '.xz'), or '' for plain text files.
+    """
+    for extension in COMPRESSED_EXTENSIONS:
+        if filename.endswith(extension):
+            return extension
+    return ''
+
+
+def resolve_corpus(filename):
+    """
+        Returns filename if it exists. Otherwise, returns its compressed version (filename + '.gz', '.bz2' or '.xz')
+        if there is one. This allows referring to the corpora without their compression extension.
+    """
+    if os.path.exists(filename) or compression_extension(filename):
+        return filename
+    for extension in COMPRESSED_EXTENSIONS:
+        if os.path.exists(filename + extension):
+            return filename + extension
+    return filename
+
+
+def is_compressed(filename):
+    return compression_extension(resolve_corpus(filename)) != ''
+
+
+def open_corpus(filename, mode='r', buffer_size=BUFFER_SIZE):
+    """
+        Opens a (possibly compressed) corpus file. The compression is given by the file extension. Compressed files are
+        read through a background thread (or an xz process) that decompresses ahead of the consumer.
+
+        :param filename: corpus file. When reading, the compression extension can be omitted (see resolve_corpus)
+        :param mode: 'r', 'w' or 'a'
+        :param buffer_size: bytes read/written at once
+        :return: file-like object
+    """
+    mode = mode.replace('b', '')
+    if mode == 'r':
+        filename = resolve_corpus(filename)
+    extension = compression_extension(filename)
+    if not extension:
+        return open(filename, mode, buffer_size)
+    if mode == 'r':
+        return ThreadedReader(filename, extension, buffer_size=buffer_size)
+    return CompressedWriter(filename, extension, mode=mode, buffer_size=buffer_size)
+
+
+def copy_corpus(src_filename, dest_filename, buffer_size=BUFFER_SIZE):
+    """
+        Copies a corpus. If both files use the same compression, compressed bytes are copied as they are.
+    """
+    src_filename = resolve_corpus(src_filename)
+    if compression_extension(src_filename) == compression_extension(dest_filename):
+        shutil.copyfile(src_filename, dest_filename)
+        return
+    with open_corpus(src_filename, buffer_size=buffer_size) as src_file, \
+            open_corpus(dest_filename, 'w', buffer_size=buffer_size) as dest_file:
+        while True:
+            block = src_file.read(buffer_size)
+            if not block:
+                break
+            dest_file.write(block)
+
+
+def _decompressed_blocks(filename, extension, buffer_size):
+    """
+        Yields decompressed blocks of a file. Multi-member gzip and multi-stream bzip2 files (e.g. written in append
+        mode) are supported.
+    """
+    if extension == '.xz':
+        process = subprocess.Popen(['xz', '-dc', filename], stdout=subprocess.PIPE, bufsize=buffer_size)
+        try:
+            for block in iter(lambda: process.stdout.read(buffer_size), ''):
+                yield block
+            if process.wait() != 0:
+                raise IOError('xz failed to decompress %s' % filename)
+        finally:
+            # Also when the generator is closed early: do not leave the xz process blocked on a full pipe
+            process.stdout.close()
+            if process.poll() is None:
+                process.terminate()
+            process.wait()
+        return
+
+    new_decompressor = (lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)) if extension == '.gz' else bz2.BZ2Decompressor
+    decompressor = new_decompressor()
+    with open(filename, 'rb') as f:
+        for data in iter(lambda: f.read(buffer_size), ''):
+            while data:
+                try:
+                    block = decompressor.decompress(data)
+                except EOFError:  # bz2: the previous stream ended exactly at the end of the last read
+                    decompressor = new_decompressor()
+                    continue
+                if block:
+                    yield block
+                data = decompressor.unused_data
+                if data:
+                    decompressor = new_decompressor()
+
+
+class ThreadedReader(object):
+    def __init__(self, filename, extension, buffer_size=BUFFER_SIZE):
+        """
+            Line reader of a compressed file, decompressed by a background thread so that decompression overlaps with
+            the processing of the lines (zlib and bz2 release the GIL while decompressing).
+        """
+        self.name = filename
+        self._queue = Queue(maxsize=QUEUE_BLOCKS)
+        self._pending = ''
+        self._finished = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._produce, args=(filename, extension, buffer_size))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _produce(self, filename, extension, buffer_size):
+        blocks = _decompressed_blocks(filename, extension, buffer_size)
+        try:
+            for block in blocks:
+                self._queue.put(block)
+                if self._closed:
+                    return
+            self._queue.put(None)
+        except Exception as e:
+            self._queue.put(e)
+        finally:
+            blocks.close()  # Releases the file or the xz process when the reader is closed early
+
+    def _next_block(self):
+        if self._finished:
+            return ''
+        block = self._queue.get()
+        if isinstance(block, Exception):
+            raise block
+        if block is None:
+            self._finished = True
+            return ''
+        return block
+
+    def read(self, size=-1):
+        while size < 0 or len(self._pending) < size:
+            block = self._next_block()
+            if not block:
+                break
+            self._pending += block
+        if size < 0:
+            data, self._pending = self._pending, ''
+        else:
+            data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def __iter__(self):
+        while True:
+            lines = self._pending.split('\n')
+            self._pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+            block = self._next_block()
+            if not block:
+                break
+            self._pending += block
+        if self._pending:
+            line, self._pending = self._pending, ''
+            yield line
+
+    def readline(self):
+        while '\n' not in self._pending:
+            block = self._next_block()
+            if not block:
+                line, self._pending = self._pending, ''
+                return line
+            self._pending += block
+        line, self._pending = self._pending.split('\n', 1)
+        return line + '\n'
+
+    def readlines(self):
+        return list(self)
+
+    def close(self):
+        self._closed = True
+        # Unblock the producer if it is waiting on a full queue
+        while not self._queue.empty():
+            self._queue.get()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CompressedWriter(object):
+    def __init__(self, filename, extension, mode='w', buffer_size=BUFFER_SIZE):
+        """
+            Writer of a compressed file. In append mode a new gzip member / bzip2 or xz stream is appended.
+        """
+        self.name = filename
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+        self._file = open(filename, mode + 'b')
+        self._process = None
+        if extension == '.xz':
+            self._process = subprocess.Popen(['xz', '-c'], stdin=subprocess.PIPE, stdout=self._file)
+            self._compressor = None
+        elif extension == '.gz':
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        else:
+            self._compressor = bz2.BZ2Compressor()
+
+    def _flush_buffer(self):
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if self._process is not None:
+            self._process.stdin.write(data)
+        else:
+            self._file.write(self._compressor.compress(data))
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.buffer_size:
+            self._flush_buffer()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def close(self):
+        self._flush_buffer()
+        if self._process is not None:
+            self._process.stdin.close()
+            if self._process.wait() != 0:
+                raise IOError('xz failed to compress %s' % self.name)
+        else:
+            self._file.write(self._compressor.flush())
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
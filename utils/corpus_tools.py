@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+
+from utils.corpus_io import open_corpus
+
+
+def vocabulary_size(filename):
+    """
+        Number of distinct (whitespace-separated) tokens of a corpus.
+    """
+    vocabulary = set()
+    with open_corpus(filename) as f:
+        for line in f:
+            vocabulary.update(line.split())
+    return len(vocabulary)
+
+
+def split_labeled_corpora(positive_filename, negative_filename, dest_dir=None, n_val=0, n_test=0, seed=0):
+    """
+        Shuffles and labels (1: positive, 0: negative) two corpora and splits them into training, validation and test
+        sets with balanced classes. Writes <dest_dir>/training.sn and training.class, and the val.* and test.* files
+        if n_val or n_test are given.
+
+        :param dest_dir: output folder (by default, the folder of positive_filename)
+        :param n_val: sentences of the validation set (half of each class)
+        :param n_test: sentences of the test set (half of each class)
+        :return: dict with the number of sentences of each written split
+    """
+    dest_dir = dest_dir if dest_dir is not None else os.path.dirname(os.path.abspath(positive_filename))
+    rng = np.random.RandomState(seed)
+    splits = {'training': [], 'val': [], 'test': []}
+    for filename, label in [(positive_filename, '1'), (negative_filename, '0')]:
+        with open_corpus(filename) as f:
+            lines = [line if line.endswith('\n') else line + '\n' for line in f]
+        lines = [lines[k] for k in rng.permutation(len(lines))]
+        n_val_class = n_val // 2
+        n_test_class = n_test // 2
+        splits['val'] += [(line, label) for line in lines[:n_val_class]]
+        splits['test'] += [(line, label) for line in lines[n_val_class:n_val_class + n_test_class]]
+        splits['training'] += [(line, label) for line in lines[n_val_class + n_test_class:]]
+
+    sizes = dict()
+    for name, samples in splits.iteritems():
+        if not samples:
+            continue
+        with open(os.path.join(dest_dir, name + '.sn'), 'w') as sentences_file, \
+                open(os.path.join(dest_dir, name + '.class'), 'w') as classes_file:
+            for k in rng.permutation(len(samples)):
+                sentences_file.write(samples[k][0])
+                classes_file.write(samples[k][1] + '\n')
+        sizes[name] = len(samples)
+    return sizes
@@ -0,0 +1,120 @@
+import hashlib
+import logging
+import struct
+
+import numpy as np
+
+from utils.corpus_io import open_corpus
+
+
+def normalize_sentence(sentence):
+    """
+        Normalizes a sentence before hashing it: surrounding whitespace is stripped and inner whitespace collapsed.
+    """
+    return ' '.join(sentence.split())
+
+
+def hash_pair(line_src, line_trg):
+    """
+        Computes a 64-bit fingerprint of a normalized (src, trg) sentence pair.
+
+        :param line_src: source sentence
+        :param line_trg: target sentence
+        :return: signed 64-bit integer
+    """
+    digest = hashlib.md5(normalize_sentence(line_src) + '\t' + normalize_sentence(line_trg)).digest()
+    return struct.unpack('<q', digest[:8])[0]
+
+
+def hash_pool(pool_src, pool_trg):
+    """
+        Fingerprints every (src, trg) pair of a parallel pool.
+
+        :return: int64 array with one hash per pool line
+    """
+    with open_corpus(pool_src) as pool_file_src, open_corpus(pool_trg) as pool_file_trg:
+        return np.array([hash_pair(line_src, line_trg) for line_src, line_trg in zip(pool_file_src, pool_file_trg)],
+                        dtype='int64')
+
+
+class DedupIndex(object):
+    def __init__(self, pool_src, pool_trg, verbose=0):
+        """
+            Index of the exact (normalized) duplicates of a parallel pool.
+
+            Unique pairs are numbered in order of first occurrence, so the u-th line of the file written by
+            write_unique() holds the u-th unique pair.
+
+            :param pool_src: path to the source side of the pool
+            :param pool_trg: path to the target side of the pool
+            :param verbose: print progress information
+        """
+        self.pool_src = pool_src
+        self.pool_trg = pool_trg
+
+        seen = dict()
+        inverse = []
+        first_occurrence = []
+        hashes = []
+        with open_corpus(pool_src) as pool_file_src, open_corpus(pool_trg) as pool_file_trg:
+            for i, (line_src, line_trg) in enumerate(zip(pool_file_src, pool_file_trg)):
+                if verbose and i % 100000 == 0:
+                    print "Hashed %d sentences \r" % i,
+                h = hash_pair(line_src, line_trg)
+                u = seen.get(h)
+                if u is None:
+                    u = len(first_occurrence)
+                    seen[h] = u
+                    first_occurrence.append(i)
+                    hashes.append(h)
+                inverse.append(u)
+
+        self.inverse = np.array(inverse, dtype='int64')                    # Unique pair id of each pool line
+        self.first_occurrence = np.array(first_occurrence, dtype='int64')  # Pool line of each unique pair
+        self.hashes = np.array(hashes, dtype='int64')                      # Fingerprint of each unique pair
+
+    @property
+    def n_lines(self):
+        return len(self.inverse)
+
+    @property
+    def n_unique(self):
+        return len(self.first_occurrence)
+
+    def is_first_occurrence(self):
+        """
+            Boolean mask over the pool lines, True for the first occurrence of each pair.
+        """
+        mask = np.zeros(self.n_lines, dtype='bool')
+        mask[self.first_occurrence] = True
+        return mask
+
+    def expand(self, values):
+        """
+            Maps per-unique-pair values (scores, selection decisions...) back to every pool line.
+        """
+        return np.asarray(values)[self.inverse]
+
+    def write_unique(self, dest_src, dest_trg):
+        """
+            Writes the unique pairs of the pool, in order of first occurrence.
+        """
+        first = self.is_first_occurrence()
+        with open_corpus(self.pool_src) as pool_file_src, open_corpus(self.pool_trg) as pool_file_trg, \
+                open(dest_src, 'w') as dest_file_src, open(dest_trg, 'w') as dest_file_trg:
+            for i, (line_src, line_trg) in enumerate(zip(pool_file_src, pool_file_trg)):
+                if first[i]:
+                    dest_file_src.write(line_src)
+                    dest_file_trg.write(line_trg)
+
+    def saved_fraction(self):
+        """
+            Fraction of the scoring work (tokenization and prediction) avoided by scoring unique pairs only.
+        """
+        if self.n_lines == 0:
+            return 0.
+        return 1. - float(self.n_unique) / self.n_lines
+
+    def report(self):
+        logging.info('Pool deduplication: %d lines, %d unique pairs. Scoring %d sentences less (%.2f%% saved).' %
+                     (self.n_lines, self.n_unique, self.n_lines - self.n_unique, 100. * self.saved_fraction()))
@@ -0,0 +1,151 @@
+import numpy as np
+
+from utils.oov_buckets import OOV_BUCKET_PREFIX, n_oov_buckets, oov_bucket_index
+
+# Word vectors and embedding matrices shared by several models built in the same process (or in processes forked from
+# it), see preload_embeddings
+_preloaded_vectors = dict()
+_preloaded_matrices = dict()
+
+
+def embedding_matrix(vocabulary, word_vectors, vocabulary_size, embedding_size):
+    """
+        Initial weights of an embedding layer: the pretrained vector of each word of the vocabulary that has one, and
+        uniform random values in [0, 1) otherwise. The row of each OOV bucket of the vocabulary (see
+        utils/oov_buckets.py) is the mean of the pretrained vectors of the words out of the vocabulary hashed into it.
+
+        :param vocabulary: Dataset vocabulary (with 'words2idx')
+        :param word_vectors: dict mapping words to their pretrained vectors
+        :param vocabulary_size: number of rows of the matrix
+        :param embedding_size: number of columns of the matrix
+        :return: (vocabulary_size, embedding_size) array
+    """
+    preloaded = any(word_vectors is vectors for vectors in _preloaded_vectors.itervalues())
+    key = (id(vocabulary), id(word_vectors), vocabulary_size, embedding_size)
+    if preloaded and key in _preloaded_matrices:
+        return _preloaded_matrices[key]
+    embedding_weights = np.random.rand(vocabulary_size, embedding_size)
+    for word, index in vocabulary['words2idx'].iteritems():
+        if word_vectors.get(word) is not None:
+            embedding_weights[index, :] = word_vectors[word]
+    n_buckets = n_oov_buckets(vocabulary)
+    if n_buckets > 0 and len(word_vectors) > 0:
+        sums = np.zeros((n_buckets, embedding_size))
+        counts = np.zeros(n_buckets, dtype='int64')
+        for word in word_vectors:
+            if word not in vocabulary['words2idx']:
+                bucket = oov_bucket_index(word, n_buckets)
+                sums[bucket] += word_vectors[word]
+                counts[bucket] += 1
+        for bucket in np.flatnonzero(counts):
+            index = vocabulary['words2idx'][OOV_BUCKET_PREFIX + str(bucket)]
+            embedding_weights[index, :] = sums[bucket] / counts[bucket]
+    if preloaded:
+        _preloaded_matrices[key] = embedding_weights
+    return embedding_weights
+
+
+def preload_embeddings(params, dataset):
+    """
+        Loads the pretrained vectors of params and builds the embedding matrices for the vocabularies of dataset, so
+        that the models built afterwards with the same vectors, vocabularies and sizes (in this process or in forked
+        ones) reuse them instead of loading and building them again. The random rows of the words without a
+        pretrained vector are then the same for all those models.
+    """
+    inputs = [('SRC', params['INPUTS_IDS_DATASET'][0])]
+    if params['BILINGUAL_SELECTION']:
+        inputs.append(('TRG', params['INPUTS_IDS_DATASET'][1]))
+    for side, input_id in inputs:
+        filename = params[side + '_PRETRAINED_VECTORS']
+        if filename is None:
+            continue
+        if filename not in _preloaded_vectors:
+            _preloaded_vectors[filename] = load_word_vectors(filename)
+        embedding_matrix(dataset.vocabulary[input_id], _preloaded_vectors[filename], dataset.vocabulary_len[input_id],
+                         params[side + '_TEXT_EMBEDDING_HIDDEN_SIZE'])
+
+
+# Compact storage of embedding matrices: 'float16', or 'int8' with one float32 scale per row
+QUANTIZATIONS = ['float16', 'int8']
+
+
+def quantize(matrix, quantization):
+    """
+        Quantizes an embedding matrix.
+
+        :param matrix: (rows, dimension) float array
+        :param quantization: 'float16' or 'int8' (symmetric, scaled by the largest absolute value of each row)
+        :return: (quantized matrix, scales). scales is None for float16
+    """
+    matrix = np.asarray(matrix, dtype='float32')
+    if quantization == 'float16':
+        return matrix.astype('float16'), None
+    elif quantization == 'int8':
+        scales = np.abs(matrix).max(axis=1) / 127.
+        scales[scales == 0] = 1.
+        quantized = np.round(matrix / scales[:, None]).astype('int8')
+        return quantized, scales.astype('float32')
+    raise AttributeError('Unknown quantization "%s"' % quantization)
+
+
+def dequantize(quantized, scales, rows=None):
+    """
+        float32 values of the given rows (all of them if rows is None) of a quantized matrix.
+    """
+    if rows is not None:
+        quantized = quantized[rows]
+        scales = scales[rows] if scales is not None else None
+    values = quantized.astype('float32')
+    if scales is not None:
+        values *= scales[..., None]
+    return values
+
+
+def quantize_word_vectors(word_vectors, quantization):
+    """
+        Compact version of a dict of word vectors (as stored by the *2npy converters), to be saved with np.save
+        and loaded with load_word_vectors.
+    """
+    words = list(word_vectors)
+    quantized, scales = quantize(np.array([word_vectors[word] for word in words]), quantization)
+    return {'__quantization__': quantization, 'words': words, 'vectors': quantized, 'scales': scales}
+
+
+class QuantizedVectors(object):
+    def __init__(self, stored):
+        """
+            Read-only dict-like view of quantized word vectors: each vector is dequantized when it is accessed.
+        """
+        self.quantization = stored['__quantization__']
+        self.vectors = stored['vectors']
+        self.scales = stored['scales']
+        self.rows = dict((word, row) for row, word in enumerate(stored['words']))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, word):
+        return word in self.rows
+
+    def __getitem__(self, word):
+        return dequantize(self.vectors, self.scales, self.rows[word])
+
+    def get(self, word, default=None):
+        return self[word] if word in self.rows else default
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+def load_word_vectors(filename):
+    """
+        Loads the word vectors stored by the *2npy converters, quantized or not.
+
+        :return: dict (or QuantizedVectors) mapping words to their float32 vectors
+    """
+    if filename in _preloaded_vectors:
+        return _preloaded_vectors[filename]
+    stored = np.load(filename).item()
+    if '__quantization__' in stored:
+        return QuantizedVectors(stored)
+    return stored
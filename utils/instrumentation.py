@@ -0,0 +1,216 @@
+import cProfile
+import json
+import logging
+import marshal
+import os
+import pstats
+import resource
+import sys
+import thread
+import threading
+import time
+from collections import defaultdict
+from timeit import default_timer as timer
+
+
+def _cpu_time():
+    usage = os.times()
+    return usage[0] + usage[1] + usage[2] + usage[3]  # User + system time, including finished child processes
+
+
+def _peak_rss_mb():
+    # ru_maxrss is given in kilobytes on Linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.
+
+
+def _frame_name(func):
+    filename, line, name = func
+    return '%s (%s:%d)' % (name, os.path.basename(filename), line) if filename != '~' else name
+
+
+def collapsed_from_stats(stats, max_depth=64, min_time=1e-6):
+    """
+        Approximate collapsed stacks from a cProfile call graph. cProfile only keeps caller -> callee edges, so the time
+        of a function is split among the paths that reach it in proportion to the time of each incoming edge.
+
+        :param stats: pstats stats dict
+        :return: dict mapping each stack (tuple of functions, outermost first) to its self time in seconds
+    """
+    children = defaultdict(dict)
+    for func, (_, _, _, _, callers) in stats.iteritems():
+        for caller, edge in callers.iteritems():
+            children[caller][func] = edge[3]  # Cumulative time of func when called from caller
+    stacks = defaultdict(float)
+    pending = [((func,), 1.) for func, entry in stats.iteritems() if not entry[4]]
+    while pending:
+        path, fraction = pending.pop()
+        func = path[-1]
+        stacks[path] += stats[func][2] * fraction
+        if len(path) >= max_depth:
+            continue
+        for child, edge_time in children[func].iteritems():
+            child_time = stats[child][3]
+            if child in path or child_time <= 0 or edge_time * fraction < min_time:
+                continue
+            pending.append((path + (child,), fraction * edge_time / child_time))
+    return stacks
+
+
+class SamplingProfiler(object):
+    def __init__(self, interval):
+        """
+            Samples the stack of the calling thread every interval seconds from a background thread. Only Python
+            frames are seen: time spent in native code is attributed to the Python function that called it.
+        """
+        self.interval = interval
+        self.samples = defaultdict(int)
+        self._thread_id = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def enable(self):
+        self._thread_id = thread.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def disable(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.samples[tuple(reversed(stack))] += 1
+
+    def stats(self):
+        """
+            The samples in the pstats format (times are samples * interval, call counts are sample counts).
+        """
+        stats = dict()
+        for stack, count in self.samples.iteritems():
+            seconds = count * self.interval
+            seen = set()
+            for depth, func in enumerate(stack):
+                cc, nc, tt, ct, callers = stats.get(func, (0, 0, 0., 0., {}))
+                leaf = depth == len(stack) - 1
+                if func not in seen:
+                    cc, nc, ct = cc + count, nc + count, ct + seconds
+                    seen.add(func)
+                if leaf:
+                    tt += seconds
+                if depth > 0:
+                    e_cc, e_nc, e_tt, e_ct = callers.get(stack[depth - 1], (0, 0, 0., 0.))
+                    callers[stack[depth - 1]] = (e_cc + count, e_nc + count, e_tt + (seconds if leaf else 0.),
+                                                 e_ct + seconds)
+                stats[func] = (cc, nc, tt, ct, callers)
+        return stats
+
+
+class PhaseRecorder(object):
+    def __init__(self, filename=None, profile='', profile_phases=None, profile_dir=None, profile_interval=0.005):
+        """
+            Writes one JSON record per timed phase to filename (JSON lines). Each record holds the run, phase,
+            iteration, wall time, CPU time (including child processes), peak RSS, lines processed and throughput.
+            Phases are delimited with start(name) and end(name). With filename None, nothing is recorded.
+
+            Phases can also be profiled:
+                profile: '' (no profiling), 'deterministic' (cProfile) or 'sampling' (stack samples every
+                         profile_interval seconds, lower overhead)
+                profile_phases: names of the profiled phases (all if empty)
+            Each profiled phase writes <profile_dir>/<phase>_<iteration>.pstats (readable with pstats, snakeviz...)
+            and <phase>_<iteration>.collapsed (collapsed stacks for flamegraph.pl, speedscope...; sample counts, or
+            microseconds for the deterministic profiler). Only the calling process is profiled: the work done in
+            worker processes (TRAINING_WORKERS, SCORING_WORKERS...) is not seen.
+        """
+        self.filename = filename
+        if filename and os.path.dirname(filename) and not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        self.run_id = time.strftime('%Y%m%d-%H%M%S') + '-%d' % os.getpid()
+        self._file = open(filename, 'a') if filename else None
+        self._open_phases = dict()
+
+        if profile not in ['', 'deterministic', 'sampling']:
+            raise Exception, 'Unknown profiler: ' + str(profile)
+        self.profile = profile
+        self.profile_phases = profile_phases or []
+        self.profile_dir = profile_dir
+        self.profile_interval = profile_interval
+        self._profiled_phase = None
+        self._profiler = None
+        if profile and not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+
+    def start(self, name, iteration=None):
+        if self._file is not None:
+            self._open_phases[name] = (iteration, time.time(), timer(), _cpu_time())
+        if self.profile and self._profiled_phase is None and (not self.profile_phases or name in self.profile_phases):
+            self._profiled_phase = (name, iteration)
+            self._profiler = cProfile.Profile() if self.profile == 'deterministic' \
+                else SamplingProfiler(self.profile_interval)
+            self._profiler.enable()
+
+    def end(self, name, lines=None):
+        """
+            Ends a phase and writes its record.
+
+            :param name: phase name, as given to start
+            :param lines: number of lines (sentences) processed by the phase, if meaningful
+        """
+        if self._profiled_phase is not None and self._profiled_phase[0] == name:
+            self._profiler.disable()
+            self._write_profile()
+        if self._file is None or name not in self._open_phases:
+            return
+        iteration, start, start_time, start_cpu = self._open_phases.pop(name)
+        wall = timer() - start_time
+        record = {'run': self.run_id, 'phase': name, 'iteration': iteration, 'start': start, 'wall': wall,
+                  'cpu': _cpu_time() - start_cpu, 'peak_rss_mb': _peak_rss_mb(), 'lines': lines,
+                  'lines_per_second': lines / wall if lines is not None and wall > 0 else None}
+        self._file.write(json.dumps(record, sort_keys=True) + '\n')
+        self._file.flush()
+
+    def _write_profile(self):
+        name, iteration = self._profiled_phase
+        if self.profile == 'deterministic':
+            stats = pstats.Stats(self._profiler).stats
+            stacks = dict((stack, int(round(seconds * 1e6))) for stack, seconds in
+                          collapsed_from_stats(stats).iteritems())
+        else:
+            stats = self._profiler.stats()
+            stacks = self._profiler.samples
+        self._profiled_phase = None
+        self._profiler = None
+
+        prefix = os.path.join(self.profile_dir, name if iteration is None else '%s_%s' % (name, iteration))
+        with open(prefix + '.pstats', 'wb') as f:
+            marshal.dump(stats, f)
+        with open(prefix + '.collapsed', 'w') as f:
+            for stack, value in sorted(stacks.iteritems()):
+                if value > 0:
+                    f.write('%s %d\n' % (';'.join(_frame_name(func) for func in stack), value))
+        logging.info('Profile of the %s phase written to %s.pstats and %s.collapsed' % (name, prefix, prefix))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def phase_recorder(params):
+    """
+        PhaseRecorder configured with the TIMING_LOG and PROFILE* parameters.
+    """
+    return PhaseRecorder(params['DEST_ROOT_PATH'] + '/' + params['TIMING_LOG'] if params['TIMING_LOG'] else None,
+                         profile=params['PROFILE'],
+                         profile_phases=params['PROFILE_PHASES'],
+                         profile_dir=params['DEST_ROOT_PATH'] + '/profiles',
+                         profile_interval=params['PROFILE_INTERVAL'])
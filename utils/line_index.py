@@ -0,0 +1,132 @@
+import logging
+import os
+
+import numpy as np
+
+from utils.corpus_io import is_compressed
+
+INDEX_VERSION = 1
+HEADER_LENGTH = 3  # [INDEX_VERSION, file size, file mtime (ns)]
+BLOCK_LINES = 100000  # Maximum number of consecutive lines read at once
+
+
+def line_offsets(filename, buffer_size=1 << 24):
+    """
+        Computes the byte offset where each line of a file starts.
+
+        :param filename: text file
+        :param buffer_size: bytes read at once
+        :return: int64 array with one offset per line
+    """
+    offsets = [np.zeros(1, dtype='int64')]
+    position = 0
+    with open(filename, 'rb') as f:
+        while True:
+            buffer_ = f.read(buffer_size)
+            if not buffer_:
+                break
+            offsets.append(np.flatnonzero(np.frombuffer(buffer_, dtype='uint8') == 10).astype('int64') + position + 1)
+            position += len(buffer_)
+    offsets = np.concatenate(offsets)
+    # The offset after a trailing newline (or the single offset of an empty file) does not start a line
+    if offsets[-1] == position:
+        offsets = offsets[:-1]
+    return offsets
+
+
+def _file_signature(filename):
+    stat = os.stat(filename)
+    return stat.st_size, int(stat.st_mtime * 1e9)
+
+
+def corpus_line_index(filename, enabled=True):
+    """
+        LineIndex of a corpus, or None if line indexes are disabled or the corpus is compressed (not seekable).
+    """
+    if not enabled or is_compressed(filename):
+        return None
+    return LineIndex(filename)
+
+
+class LineIndex(object):
+    def __init__(self, filename, persistent=True):
+        """
+            Line-offset index of a text file, for fetching arbitrary lines without scanning the file.
+
+            The index is stored as an int64 array in filename + '.idx' and memory-mapped. It is rebuilt whenever the
+            size or the modification time of the file change.
+
+            :param filename: indexed text file
+            :param persistent: store the index next to the file. If False (or if the index cannot be written), it is
+                               kept in memory only
+        """
+        self.filename = filename
+        self.index_filename = filename + '.idx'
+        self.size, mtime = _file_signature(filename)
+
+        if persistent and os.path.isfile(self.index_filename):
+            index = np.memmap(self.index_filename, dtype='int64', mode='r')
+            if len(index) >= HEADER_LENGTH and list(index[:HEADER_LENGTH]) == [INDEX_VERSION, self.size, mtime]:
+                self.offsets = index[HEADER_LENGTH:]
+                return
+            del index
+
+        self.offsets = line_offsets(filename)
+        if persistent:
+            try:
+                tmp_filename = self.index_filename + '.%d.tmp' % os.getpid()
+                np.concatenate([np.array([INDEX_VERSION, self.size, mtime], dtype='int64'),
+                                self.offsets]).tofile(tmp_filename)
+                os.rename(tmp_filename, self.index_filename)
+                self.offsets = np.memmap(self.index_filename, dtype='int64', mode='r')[HEADER_LENGTH:]
+            except (IOError, OSError) as e:
+                logging.warning('Cannot store the line index of %s (%s). Keeping it in memory.' % (filename, str(e)))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _end_offset(self, line):
+        """
+            Byte offset right after the given line.
+        """
+        return self.offsets[line + 1] if line + 1 < len(self.offsets) else self.size
+
+    def get_lines(self, positions):
+        """
+            Fetches a set of lines, in the order given by positions. Runs of consecutive lines are read as single blocks
+            and the rest with sorted seeks.
+
+            :param positions: line numbers (0-based)
+            :return: list of lines (including their trailing newline)
+        """
+        positions = np.asarray(positions, dtype='int64')
+        if len(positions) == 0:
+            return []
+        order = np.argsort(positions, kind='mergesort')
+        sorted_positions = positions[order]
+        breaks = np.flatnonzero(np.diff(sorted_positions) != 1) + 1
+        run_starts = np.concatenate([[0], breaks])
+        run_ends = np.concatenate([breaks, [len(sorted_positions)]])
+
+        lines = []
+        with open(self.filename, 'rb') as f:
+            for run_start, run_end in zip(run_starts, run_ends):
+                first = sorted_positions[run_start]
+                last = sorted_positions[run_end - 1]
+                for block_first in range(first, last + 1, BLOCK_LINES):
+                    block_last = min(block_first + BLOCK_LINES, last + 1) - 1
+                    f.seek(self.offsets[block_first])
+                    block = f.read(self._end_offset(block_last) - self.offsets[block_first]).split('\n')
+                    lines += [line + '\n' for line in block[:-1]]
+                    if block[-1]:  # Last line of a file without a trailing newline
+                        lines.append(block[-1])
+
+        if (np.diff(order) == 1).all():
+            return lines
+        ordered_lines = [None] * len(lines)
+        for k, o in enumerate(order):
+            ordered_lines[o] = lines[k]
+        return ordered_lines
+
+    def get_line(self, i):
+        return self.get_lines([i])[0]
@@ -0,0 +1,217 @@
+import logging
+import os
+import resource
+import thread
+import threading
+
+from utils.corpus_io import compression_extension, open_corpus, resolve_corpus
+
+# Approximate memory of each line held in a Python list (str object header + list pointer)
+LINE_OVERHEAD_BYTES = 48
+# Approximate size ratio of the decompressed and compressed corpora
+COMPRESSION_RATIO = 4
+
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+
+def rss_mb():
+    """
+        Current resident set size of this process in MB (the peak one where /proc is not available).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024. ** 2
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def private_memory_mb(pid='self'):
+    """
+        Memory of a process that is not shared with other processes (e.g. pages copied after a fork), in MB. None
+        where /proc/<pid>/smaps_rollup is not available (or the process has exited).
+    """
+    try:
+        private_kb = 0
+        with open('/proc/%s/smaps_rollup' % pid) as f:
+            for line in f:
+                if line.startswith('Private_Clean:') or line.startswith('Private_Dirty:'):
+                    private_kb += int(line.split()[1])
+        return private_kb / 1024.
+    except (IOError, OSError):
+        return None
+
+
+def available_mb():
+    """
+        Memory available for new allocations on the host in MB (MemAvailable), or None if it is unknown.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def corpus_memory_mb(filenames, n_lines=None):
+    """
+        Estimated memory needed for holding the lines of (aligned) corpora in Python lists.
+
+        :param filenames: corpus files, possibly compressed (see resolve_corpus)
+        :param n_lines: number of lines of each file. Counted from the first file if None
+    """
+    if n_lines is None:
+        with open_corpus(filenames[0]) as f:
+            n_lines = sum(1 for _ in f)
+    total_bytes = 0
+    for filename in filenames:
+        filename = resolve_corpus(filename)
+        size = os.path.getsize(filename)
+        if compression_extension(filename):
+            size *= COMPRESSION_RATIO
+        total_bytes += size + n_lines * LINE_OVERHEAD_BYTES
+    return total_bytes / 1024. ** 2
+
+
+class MemoryBudget(object):
+    def __init__(self, budget_mb, check_interval=1., warning_fraction=0.8):
+        """
+            Memory budget of a run. The stages size their chunks and buffers with chunk_size and fits, and check it at
+            their boundaries with check, which fails with a clear message once the RSS exceeds the budget. The RSS
+            includes the private memory of the child processes given to watch.
+
+            With start(), a monitor thread also samples the RSS every check_interval seconds: above
+            warning_fraction of the budget, the chunks given by chunk_size are halved and a warning is logged; above
+            the budget, the error is logged and the main thread is interrupted (KeyboardInterrupt, with the message in
+            exceeded, which the caller re-raises as MemoryBudgetExceeded), before the kernel has to step in.
+
+            :param budget_mb: budget in MB. 0 disables it (chunk_size returns the default sizes, fits is always True)
+        """
+        self.budget_mb = budget_mb
+        self.check_interval = check_interval
+        self.warning_fraction = warning_fraction
+        self.peak_mb = 0.
+        self.under_pressure = False
+        self.exceeded = None  # Error message, once the budget has been exceeded
+        self.children = []  # Pids of the child processes whose private memory counts in the budget (see watch)
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.budget_mb > 0
+
+    def watch(self, pids):
+        """
+            Counts the private memory of these child processes (e.g. forked workers, which share the rest with this
+            one) in the memory used by the run, until watch is called again.
+        """
+        self.children = list(pids)
+
+    def used_mb(self):
+        """
+            RSS of this process plus the private memory of the watched child processes.
+        """
+        return rss_mb() + sum(private_memory_mb(pid) or 0. for pid in self.children)
+
+    def headroom_mb(self):
+        """
+            MB that can still be allocated: the rest of the budget, bounded by the memory available on the host.
+        """
+        headroom = self.budget_mb - self.used_mb()
+        available = available_mb()
+        return min(headroom, available) if available is not None else headroom
+
+    def chunk_size(self, default, bytes_per_item, fraction=0.25, minimum=1):
+        """
+            Number of items of a chunk or buffer that fit in a fraction of the headroom, at most default.
+
+            :param default: configured size (used as is if the budget is disabled)
+            :param bytes_per_item: memory needed for each item of the chunk
+            :param fraction: fraction of the headroom the chunk may take
+            :param minimum: smallest size returned
+        """
+        if not self.enabled:
+            return default
+        size = int(fraction * max(self.headroom_mb(), 0.) * 1024 ** 2 / bytes_per_item)
+        if self.under_pressure:
+            size //= 2
+        if size < default:
+            logging.debug('Memory budget: chunk of %d items instead of %d' % (max(size, minimum), default))
+        return max(minimum, min(default, size))
+
+    def fits(self, needed_mb, what, fraction=0.5):
+        """
+            Whether needed_mb fit in a fraction of the headroom. Logs it when they do not.
+        """
+        if not self.enabled:
+            return True
+        headroom = self.headroom_mb()
+        if needed_mb <= fraction * headroom:
+            return True
+        logging.info('Memory budget: %s would take ~%.0f MB, with %.0f MB of headroom' % (what, needed_mb, headroom))
+        return False
+
+    def check(self, stage, verbose=True):
+        """
+            Fails if the budget has been exceeded. Otherwise, logs the headroom before the stage (if verbose).
+        """
+        if not self.enabled:
+            return
+        rss = self.used_mb()
+        self.peak_mb = max(self.peak_mb, rss)
+        if self.exceeded is None and rss > self.budget_mb:
+            self.exceeded = self._message(rss, stage)
+        if self.exceeded is not None:
+            raise MemoryBudgetExceeded, self.exceeded
+        if verbose:
+            logging.info('Memory before %s: RSS %.0f MB, headroom %.0f MB (MEMORY_BUDGET %d MB)' %
+                         (stage, rss, self.headroom_mb(), self.budget_mb))
+
+    def _message(self, rss, stage):
+        return 'RSS of %.0f MB exceeds the MEMORY_BUDGET of %d MB (%s). Raise MEMORY_BUDGET, or lower the memory ' \
+               'used by the run: PIPELINED_SCORING, smaller PREDICTION_BATCH_SIZE, MAX_TRAINING_INSTANCES_PER_CLASS, ' \
+               'DEDUP_POOL...' % (rss, self.budget_mb, stage)
+
+    def start(self):
+        if not self.enabled:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._monitor)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            logging.info('Memory budget: peak RSS %.0f MB of %d MB' % (self.peak_mb, self.budget_mb))
+
+    def _monitor(self):
+        while not self._stop.wait(self.check_interval):
+            rss = self.used_mb()
+            self.peak_mb = max(self.peak_mb, rss)
+            under_pressure = rss > self.warning_fraction * self.budget_mb
+            if under_pressure and not self.under_pressure:
+                logging.warning('Memory budget: RSS %.0f MB above %d%% of MEMORY_BUDGET (%d MB). Shrinking the '
+                                'chunks' % (rss, 100 * self.warning_fraction, self.budget_mb))
+            self.under_pressure = under_pressure
+            if rss > self.budget_mb and self.exceeded is None:
+                self.exceeded = self._message(rss, 'monitor')
+                logging.error(self.exceeded)
+                thread.interrupt_main()
+                return
+
+
+def memory_budget(params):
+    """
+        MemoryBudget configured with the MEMORY_* parameters.
+    """
+    return MemoryBudget(params['MEMORY_BUDGET'],
+                        check_interval=params['MEMORY_CHECK_INTERVAL'],
+                        warning_fraction=params['MEMORY_WARNING_FRACTION'])
@@ -0,0 +1,50 @@
+import numpy as np
+
+
+class _StackedKerasModels(object):
+    def __init__(self, wrappers, ids_inputs):
+        self.wrappers = wrappers
+        self.ids_inputs = ids_inputs
+
+    def _make_predict_function(self):
+        for wrapper in self.wrappers:
+            if hasattr(wrapper.model, '_make_predict_function'):
+                wrapper.model._make_predict_function()
+
+    def predict_on_batch(self, x):
+        inputs = [x[id_in] for id_in in self.ids_inputs]
+        return np.stack([np.asarray(wrapper.model.predict_on_batch(dict(zip(wrapper.ids_inputs, inputs))))[:, 1]
+                         for wrapper in self.wrappers], axis=1).astype('float32')
+
+
+class StackedModels(object):
+    def __init__(self, models):
+        """
+            Several trained classifiers (e.g. one per domain) scored as a single model: each encoded batch is
+            predicted with every model, and the prediction holds one column per model with its in-domain (positive
+            class) probability. It can be given to pipelined_scoring or forked_scoring in place of a Model_Wrapper, so
+            that the corpus is read and tokenized once for all the models.
+
+            :param models: trained Model_Wrappers. They must share the vocabularies of their inputs
+        """
+        check_shared_vocabularies(models)
+        self.models = models
+        self.ids_inputs = models[0].ids_inputs
+        self.vocabularies = models[0].vocabularies
+        self.model = _StackedKerasModels(models, self.ids_inputs)
+
+
+def check_shared_vocabularies(models):
+    """
+        Raises an exception unless all the models have the same inputs and vocabularies, so that a sentence is encoded
+        in the same way for all of them.
+    """
+    first = models[0]
+    for k, model in enumerate(models[1:], 1):
+        if len(model.ids_inputs) != len(first.ids_inputs):
+            raise Exception, 'Model %d has %d inputs, model 0 has %d' % (k, len(model.ids_inputs),
+                                                                        len(first.ids_inputs))
+        for id_first, id_in in zip(first.ids_inputs, model.ids_inputs):
+            if model.vocabularies[id_in]['words2idx'] != first.vocabularies[id_first]['words2idx']:
+                raise Exception, 'The vocabulary of the input %s of model %d differs from that of model 0. The ' \
+                                 'models scored together must share their vocabularies' % (id_in, k)
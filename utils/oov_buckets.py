@@ -0,0 +1,57 @@
+import zlib
+from collections import Counter
+
+# Token of each bucket: prefix + bucket number. Lowercase alphanumeric, so that the tokenization methods keep it
+OOV_BUCKET_PREFIX = 'oovbucket'
+
+
+def oov_bucket_index(word, n_buckets):
+    """
+        Bucket of an out-of-vocabulary word: a stable hash (CRC32) of the word modulo the number of buckets.
+    """
+    if isinstance(word, unicode):
+        word = word.encode('utf-8')
+    return (zlib.crc32(word) & 0xffffffff) % n_buckets
+
+
+def oov_bucket(word, n_buckets):
+    return OOV_BUCKET_PREFIX + str(oov_bucket_index(word, n_buckets))
+
+
+def n_oov_buckets(vocabulary):
+    """
+        Number of OOV buckets of a vocabulary (0 for regular vocabularies).
+    """
+    words2idx = vocabulary['words2idx']
+    n_buckets = 0
+    while OOV_BUCKET_PREFIX + str(n_buckets) in words2idx:
+        n_buckets += 1
+    return n_buckets
+
+
+def bucketed_vocabulary(tokenized_sentences, max_words, min_occurrences, n_buckets):
+    """
+        Vocabulary with the max_words most frequent words (all the words if 0) occurring at least min_occurrences
+        times, followed by n_buckets tokens that stand for the rest of the words (see map_oov). It has the format of the
+        vocabularies of the Dataset ('<pad>' and '<unk>' first).
+
+        :param tokenized_sentences: iterable of lists of tokens
+        :return: dict with 'words2idx' and 'idx2words'
+    """
+    counts = Counter()
+    for tokens in tokenized_sentences:
+        counts.update(tokens)
+    words = [word for word, count in counts.most_common(max_words if max_words > 0 else None)
+             if count >= min_occurrences]
+    words2idx = {'<pad>': 0, '<unk>': 1}
+    for word in words + [OOV_BUCKET_PREFIX + str(k) for k in range(n_buckets)]:
+        if word not in words2idx:
+            words2idx[word] = len(words2idx)
+    return {'words2idx': words2idx, 'idx2words': dict((index, word) for word, index in words2idx.iteritems())}
+
+
+def map_oov(tokens, words2idx, n_buckets):
+    """
+        Replaces the tokens that are not in the vocabulary by their bucket tokens.
+    """
+    return [token if token in words2idx else oov_bucket(token, n_buckets) for token in tokens]
@@ -0,0 +1,250 @@
+import logging
+import multiprocessing
+import traceback
+from Queue import Empty
+from timeit import default_timer as timer
+
+import numpy as np
+
+
+def flat_weights(keras_model):
+    """
+        All the weights of a Keras model as a single float32 vector.
+    """
+    return np.concatenate([w.ravel() for w in keras_model.get_weights()]).astype('float32')
+
+
+def set_flat_weights(keras_model, flat, shapes):
+    """
+        Loads a vector built by flat_weights into a Keras model whose weights have the given shapes.
+    """
+    weights = []
+    position = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        weights.append(flat[position:position + size].reshape(shape))
+        position += size
+    keras_model.set_weights(weights)
+
+
+def _first(data):
+    # Dataset inputs/outputs may come with their mask
+    return data[0] if isinstance(data, tuple) else data
+
+
+def mapped_batch(model, dataset, split, indices):
+    """
+        Samples of a Dataset split as the (inputs, outputs) dicts of the Keras model of a Model_Wrapper, following its
+        inputs/outputs mappings.
+    """
+    X, Y = dataset.getXY_FromIndices(split, list(indices))
+    x = dict((id_model, _first(X[pos])) for id_model, pos in model.inputsMapping.iteritems())
+    y = dict((id_model, _first(Y[pos])) for id_model, pos in model.outputsMapping.iteritems())
+    return x, y
+
+
+class DataParallelTrainer(object):
+    def __init__(self, model, dataset, params, n_workers):
+        """
+            Trains a Model_Wrapper with n_workers processes on disjoint streams of mini-batches of the 'train' split.
+            The weights are kept in shared memory and the workers synchronize with them every TRAINING_SYNC_EVERY
+            batches:
+                'average': each worker adds 1/n_workers of its local update and reloads the shared weights. When the
+                           workers advance in lockstep this is equivalent to periodically averaging their models.
+                'hogwild': each worker adds its whole local update, without locking (Hogwild!).
+            The optimizer state (e.g. Adam moments) is local to each worker.
+
+            Workers are forked, so they inherit the model and the dataset. Set OMP_NUM_THREADS (or the BLAS threads)
+            so that n_workers * threads does not exceed the number of cores.
+
+            :param model: Model_Wrapper with its inputs/outputs mappings set
+            :param dataset: Dataset with a 'train' split
+            :param params: configuration parameters
+            :param n_workers: number of worker processes
+        """
+        self.model = model
+        self.dataset = dataset
+        self.params = params
+        self.n_workers = n_workers
+        self.shapes = [w.shape for w in model.model.get_weights()]
+        initial_weights = flat_weights(model.model)
+        self._shared = multiprocessing.RawArray('f', initial_weights.size)
+        self.shared_weights()[:] = initial_weights
+        self._lock = multiprocessing.Lock()
+        self._results = multiprocessing.Queue()
+        self._commands = [multiprocessing.Queue() for _ in range(n_workers)]
+        self._processes = []
+
+    def shared_weights(self):
+        return np.frombuffer(self._shared, dtype='float32')
+
+    def start(self):
+        for worker in range(self.n_workers):
+            process = multiprocessing.Process(target=self._work, args=(worker,))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+
+    def stop(self):
+        for commands in self._commands:
+            commands.put(None)
+        for process in self._processes:
+            process.join(10)
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
+
+    def _batches(self, epoch, worker, max_batches=None):
+        """
+            Mini-batches (sample indices) of a worker. Every worker computes the same shuffling of the epoch and takes
+            every n_workers-th batch, so the streams are disjoint.
+        """
+        n_samples = self.dataset.len_train
+        order = np.random.RandomState(epoch).permutation(n_samples)
+        batch_size = self.params['BATCH_SIZE']
+        batches = [order[start:start + batch_size] for start in range(0, n_samples, batch_size)]
+        if max_batches is not None:
+            batches = batches[:max_batches]
+        return batches[worker::self.n_workers]
+
+    def _synchronize(self, base_weights):
+        keras_model = self.model.model
+        update = flat_weights(keras_model) - base_weights
+        shared = self.shared_weights()
+        if self.params['TRAINING_SYNC'] == 'hogwild':
+            shared += update
+            new_weights = shared.copy()
+        else:
+            update /= self.n_workers
+            with self._lock:
+                shared += update
+                new_weights = shared.copy()
+        set_flat_weights(keras_model, new_weights, self.shapes)
+        return new_weights
+
+    def _work(self, worker):
+        keras_model = self.model.model
+        sync_every = self.params['TRAINING_SYNC_EVERY']
+        try:
+            while True:
+                command = self._commands[worker].get()
+                if command is None:
+                    return
+                epoch, max_batches = command
+                start_time = timer()
+                base_weights = self.shared_weights().copy()
+                set_flat_weights(keras_model, base_weights, self.shapes)
+                n_samples = 0
+                for b, indices in enumerate(self._batches(epoch, worker, max_batches)):
+                    x, y = mapped_batch(self.model, self.dataset, 'train', indices)
+                    keras_model.train_on_batch(x, y)
+                    n_samples += len(indices)
+                    if (b + 1) % sync_every == 0:
+                        base_weights = self._synchronize(base_weights)
+                self._synchronize(base_weights)
+                self._results.put((worker, n_samples, timer() - start_time, None))
+        except Exception:
+            self._results.put((worker, 0, 0., traceback.format_exc()))
+
+    def train_epoch(self, epoch, max_batches=None):
+        """
+            Runs an epoch on all the workers and waits for them.
+
+            :param epoch: epoch number (seeds the shuffling)
+            :param max_batches: if given, only the first max_batches batches of the epoch are used
+            :return: (number of trained samples, seconds)
+        """
+        start_time = timer()
+        for commands in self._commands:
+            commands.put((epoch, max_batches))
+        n_samples = 0
+        for _ in range(self.n_workers):
+            while True:
+                try:
+                    worker, worker_samples, _, error = self._results.get(timeout=5)
+                    break
+                except Empty:
+                    if not all(process.is_alive() for process in self._processes):
+                        raise Exception, 'A training worker died'
+            if error is not None:
+                raise Exception, 'Training worker %d failed:\n%s' % (worker, error)
+            n_samples += worker_samples
+        return n_samples, timer() - start_time
+
+    def load_weights(self):
+        """
+            Loads the shared weights into the model of the calling process.
+        """
+        set_flat_weights(self.model.model, self.shared_weights().copy(), self.shapes)
+
+
+def parallel_train(model, dataset, params, callbacks=None):
+    """
+        Data-parallel counterpart of model.trainNet (see DataParallelTrainer). After each epoch the shared weights are
+        loaded into the model, the callbacks are run (their on_epoch_end; on_train_begin/end are called too) and the
+        model is stored every EPOCHS_FOR_SAVE epochs. Training stops after MAX_EPOCH epochs or when a callback sets stop_training.
+
+        :return: list with the training throughput (samples/s) of each epoch
+    """
+    from keras_wrapper.cnn_model import saveModel
+
+    callbacks = callbacks or []
+    keras_model = model.model
+    keras_model.stop_training = False
+    for callback in callbacks:
+        callback.set_model(keras_model)
+
+    trainer = DataParallelTrainer(model, dataset, params, params['TRAINING_WORKERS'])
+    trainer.start()
+    for callback in callbacks:
+        callback.on_train_begin()
+    throughput = []
+    try:
+        for epoch in range(params['RELOAD'], params['MAX_EPOCH']):
+            n_samples, elapsed = trainer.train_epoch(epoch)
+            throughput.append(n_samples / elapsed)
+            logging.info('Epoch %d: %d samples in %.2fs (%.1f samples/s, %d workers)' %
+                         (epoch + 1, n_samples, elapsed, throughput[-1], trainer.n_workers))
+            trainer.load_weights()
+            for callback in callbacks:
+                callback.on_epoch_end(epoch, logs={})
+            if (epoch + 1) % params['EPOCHS_FOR_SAVE'] == 0:
+                saveModel(model, epoch + 1)
+            if keras_model.stop_training:
+                break
+    finally:
+        trainer.stop()
+    for callback in callbacks:
+        callback.on_train_end()
+    return throughput
+
+
+def scaling_report(model, dataset, params):
+    """
+        Measures the training throughput with 1, 2, 4, ... TRAINING_WORKERS workers on the first
+        TRAINING_SCALING_BATCHES batches of an epoch. The weights of the model are not modified.
+
+        :return: list of (workers, samples/s, speedup, efficiency)
+    """
+    worker_counts = []
+    n_workers = 1
+    while n_workers < params['TRAINING_WORKERS']:
+        worker_counts.append(n_workers)
+        n_workers *= 2
+    worker_counts.append(params['TRAINING_WORKERS'])
+
+    report = []
+    for n_workers in worker_counts:
+        trainer = DataParallelTrainer(model, dataset, params, n_workers)
+        trainer.start()
+        try:
+            trainer.train_epoch(0, max_batches=n_workers)  # Warm-up (function compilation)
+            n_samples, elapsed = trainer.train_epoch(1, max_batches=params['TRAINING_SCALING_BATCHES'])
+        finally:
+            trainer.stop()
+        throughput = n_samples / elapsed
+        speedup = throughput / report[0][1] if report else 1.
+        report.append((n_workers, throughput, speedup, speedup / n_workers))
+        logging.info('Training scaling: %2d workers: %.1f samples/s, speedup %.2f, efficiency %.1f%%' %
+                     (n_workers, throughput, speedup, 100. * speedup / n_workers))
+    return report
@@ -0,0 +1,209 @@
+import logging
+import multiprocessing
+import threading
+from Queue import Queue
+from itertools import izip
+from timeit import default_timer as timer
+
+import numpy as np
+
+from utils.corpus_io import open_corpus
+from utils.oov_buckets import map_oov, n_oov_buckets
+
+_ENCODER = dict()  # Sentence encoder of the current process (set by init_encoder)
+LINE_BYTES = 256  # Approximate memory of a read line, for sizing the queues with a MemoryBudget
+
+
+def init_encoder(vocabularies, params):
+    """
+        Initializes the sentence encoder of the current process (e.g. a tokenization worker). Sentences are tokenized
+        and indexed with the methods of the Dataset, so that they are encoded exactly as in Dataset.getX.
+    """
+    from keras_wrapper.dataset import Dataset
+    dataset = Dataset('pipelined_scoring', '', silence=True)
+    _ENCODER['dataset'] = dataset
+    _ENCODER['tokenize'] = getattr(dataset, params['TOKENIZATION_METHOD'])
+    _ENCODER['vocabularies'] = vocabularies
+    _ENCODER['oov_buckets'] = [n_oov_buckets(vocabulary) for vocabulary in vocabularies]
+    _ENCODER['max_len'] = params['MAX_INPUT_TEXT_LEN']
+    _ENCODER['fill'] = params['FILL']
+    _ENCODER['pad_on_batch'] = params['PAD_ON_BATCH']
+
+
+def encode_batch(batch):
+    """
+        Tokenizes and indexes a batch of sentences, one list of sentences per input.
+
+        :return: (list of int32 arrays, one per input; seconds spent)
+    """
+    start_time = timer()
+    encoded = []
+    for sentences, vocabulary, n_buckets in zip(batch, _ENCODER['vocabularies'], _ENCODER['oov_buckets']):
+        tokenized = [_ENCODER['tokenize'](sentence) for sentence in sentences]
+        if n_buckets > 0:  # Words out of the vocabulary are mapped to their hashed buckets, as in build_dataset
+            tokenized = [' '.join(map_oov(tokens.split(), vocabulary['words2idx'], n_buckets)) for tokens in tokenized]
+        X = _ENCODER['dataset'].loadText(tokenized,
+                                         vocabulary, _ENCODER['max_len'], 0, _ENCODER['fill'],
+                                         _ENCODER['pad_on_batch'], False)
+        encoded.append(X[0] if isinstance(X, tuple) else X)
+    return encoded, timer() - start_time
+
+
+class StageStats(object):
+    def __init__(self, name):
+        """
+            Time spent by a pipeline stage working, waiting for its input (starved) and waiting for room in its output
+            queue (blocked by the next stage).
+        """
+        self.name = name
+        self.busy = 0.
+        self.starved = 0.
+        self.blocked = 0.
+        self.items = 0
+
+    def report(self, wall_time, workers=1):
+        occupancy = self.busy / (wall_time * workers) if wall_time > 0 else 0.
+        return '%-10s %8d batches  occupancy %5.1f%%  busy %8.2fs  starved %8.2fs  blocked %8.2fs' % \
+               (self.name, self.items, 100. * occupancy, self.busy, self.starved, self.blocked)
+
+
+class _Sentinel(object):
+    pass
+
+
+_END = _Sentinel()
+
+
+def pipelined_scoring(model, vocabularies, filenames, params, dest_filename=None, budget=None, sketch=None):
+    """
+        Scores a corpus with a 4-stage pipeline, so that reading, tokenization, prediction and writing overlap:
+            reader thread -> tokenization process pool -> prediction (calling thread) -> writer thread.
+        Stages are connected through bounded queues (SCORING_QUEUE_SIZE batches), so a slow stage makes the previous
+        ones wait instead of buffering the whole corpus. Batches are consumed in the order they are read, hence the
+        scores keep the order of the corpus.
+
+        :param model: trained Model_Wrapper
+        :param vocabularies: vocabulary of each input of the model (e.g. [dataset.vocabulary[id] for each input id])
+        :param filenames: (possibly compressed) text files, one per input of the model. They must be aligned
+        :param params: configuration parameters
+        :param dest_filename: if given, the class probabilities of each sentence are written to this file (one line per
+                              sentence)
+        :param budget: MemoryBudget. If given, the queues are shortened to fit in it and it is checked at each batch
+        :param sketch: QuantileSketch. If given, it is updated with the in-domain (positive class) probability of each
+                       sentence as the batches are predicted
+        :return: (class probabilities array, dict of StageStats)
+    """
+    batch_size = params['PREDICTION_BATCH_SIZE']
+    n_workers = params['SCORING_WORKERS']
+    queue_size = params['SCORING_QUEUE_SIZE']
+    if budget is not None:
+        # Both queues full of batches of raw lines and encoded inputs
+        batch_bytes = batch_size * len(filenames) * (LINE_BYTES + 4 * params['MAX_INPUT_TEXT_LEN'])
+        queue_size = budget.chunk_size(queue_size, 2 * batch_bytes, fraction=0.1, minimum=2)
+    stats = dict((name, StageStats(name)) for name in ['read', 'tokenize', 'predict', 'write'])
+
+    pool = multiprocessing.Pool(n_workers, initializer=init_encoder, initargs=(vocabularies, params))
+    encoded_queue = Queue(maxsize=queue_size)
+    write_queue = Queue(maxsize=queue_size)
+    errors = []
+    stop = threading.Event()
+
+    def read():
+        files = [open_corpus(filename) for filename in filenames]
+        try:
+            lines = izip(*files)
+            while not stop.is_set():
+                start_time = timer()
+                batch = [line for _, line in izip(xrange(batch_size), lines)]
+                stats['read'].busy += timer() - start_time
+                if not batch:
+                    break
+                start_time = timer()
+                sentences = [[line.rstrip('\n') for line in input_lines] for input_lines in zip(*batch)]
+                encoded_queue.put(pool.apply_async(encode_batch, (sentences,)))
+                stats['read'].blocked += timer() - start_time
+                stats['read'].items += 1
+        except Exception as e:
+            errors.append(e)
+        finally:
+            for f in files:
+                f.close()
+            encoded_queue.put(_END)
+
+    def write():
+        dest_file = open_corpus(dest_filename, 'w')
+        try:
+            while True:
+                start_time = timer()
+                probs = write_queue.get()
+                stats['write'].starved += timer() - start_time
+                if probs is _END:
+                    break
+                start_time = timer()
+                dest_file.write(''.join(' '.join('%.6f' % p for p in row) + '\n' for row in probs))
+                stats['write'].busy += timer() - start_time
+                stats['write'].items += 1
+        except Exception as e:
+            errors.append(e)
+            while write_queue.get() is not _END:  # Do not block the prediction stage
+                pass
+        finally:
+            dest_file.close()
+
+    start_time = timer()
+    threads = [threading.Thread(target=read)]
+    if dest_filename is not None:
+        threads.append(threading.Thread(target=write))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    predictions = []
+    read_finished = False
+    try:
+        while True:
+            wait_time = timer()
+            result = encoded_queue.get()
+            if result is _END:
+                read_finished = True
+                break
+            encoded, tokenize_time = result.get()
+            stats['predict'].starved += timer() - wait_time
+            stats['tokenize'].busy += tokenize_time
+            stats['tokenize'].items += 1
+
+            if budget is not None:
+                budget.check('scoring batch %d' % stats['predict'].items, verbose=False)
+            predict_time = timer()
+            probs = model.model.predict_on_batch(dict((id_in, X) for id_in, X in zip(model.ids_inputs, encoded)))
+            stats['predict'].busy += timer() - predict_time
+            stats['predict'].items += 1
+            predictions.append(probs)
+            if sketch is not None:
+                sketch.update(np.asarray(probs)[:, 1])
+
+            if dest_filename is not None:
+                put_time = timer()
+                write_queue.put(probs)
+                stats['predict'].blocked += timer() - put_time
+    finally:
+        if not read_finished:  # Prediction failed: unblock the reader
+            stop.set()
+            while encoded_queue.get() is not _END:
+                pass
+        if dest_filename is not None:
+            write_queue.put(_END)
+        pool.terminate()
+        for thread in threads:
+            thread.join()
+    wall_time = timer() - start_time
+
+    if errors:
+        raise errors[0]
+    if params['VERBOSE'] > 0:
+        logging.info('Pipelined scoring: %d batches in %.2fs' % (stats['predict'].items, wall_time))
+        for name in ['read', 'tokenize', 'predict', 'write']:
+            if stats[name].items > 0:
+                logging.info(stats[name].report(wall_time, workers=n_workers if name == 'tokenize' else 1))
+    predictions = np.concatenate(predictions) if predictions else np.zeros((0, params['N_CLASSES']), dtype='float32')
+    return predictions, stats
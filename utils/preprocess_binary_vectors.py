@@ -1,5 +1,11 @@
+import os
+import sys
+
 import numpy as np
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.embeddings import quantize_word_vectors
+
 # Parameters
 ROOT_PATH = '/media/HDD_2TB/DATASETS/'
 base_path = ROOT_PATH + 'cnn_polarity/DATA/'
@@ -8,7 +14,7 @@ vectors_path = base_path + 'word2vec_bin.' + language
 dest_file = 'word2vec.' + language
 
 
-def word2vec2npy(v_path, base_path_save, dest_filename):
+def word2vec2npy(v_path, base_path_save, dest_filename, quantization=''):
     word_vecs = dict()
     print "Loading vectors from %s" % v_path
 
@@ -33,6 +39,9 @@ def word2vec2npy(v_path, base_path_save, dest_filename):
                 print "Processed %d vectors (%.2f %%)\r" % (i, 100 * float(i) / vocab_size),
 
     # Store dict
+    if quantization:
+        print "Quantizing vectors (%s)" % quantization
+        word_vecs = quantize_word_vectors(word_vecs, quantization)
     print "Saving word vectors in %s" % (base_path_save + '/' + dest_filename + '.npy')
     np.save(base_path_save + '/' + dest_filename + '.npy', word_vecs)
     print
@@ -1,5 +1,11 @@
+import os
+import sys
+
 import numpy as np
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.embeddings import quantize_word_vectors
+
 # Parameters
 ROOT_PATH = '/media/HDD_2TB/DATASETS/'
 base_path = ROOT_PATH + 'cnn_polarity/DATA/fasttext_embeddings/'
@@ -7,7 +13,7 @@ vectors_path = base_path + 'wiki.en.vec'
 dest_file = 'fasttext.en'
 
 
-def glove2npy(glove_path, base_path_save, dest_file):
+def glove2npy(glove_path, base_path_save, dest_file, quantization=''):
     vecs_dict = dict()
     print "Loading vectors from %s" % (glove_path)
 
@@ -25,6 +31,9 @@ def glove2npy(glove_path, base_path_save, dest_file):
             print "Processed", i, "vectors (", 100 * float(i) / n_vecs, "%)\r",
     print
     # Store dict
+    if quantization:
+        print "Quantizing vectors (%s)" % quantization
+        vecs_dict = quantize_word_vectors(vecs_dict, quantization)
     print "Saving word vectors in %s" % (base_path_save + '/' + dest_file + '.npy')
     np.save(base_path_save + '/' + dest_file + '.npy', vecs_dict)
     print
@@ -0,0 +1,97 @@
+import numpy as np
+
+
+class QuantileSketch(object):
+    def __init__(self, k=200, seed=None):
+        """
+            Mergeable streaming quantile sketch (KLL compactors). Memory is O(k log(n / k)) and the rank error is
+            roughly O(1 / k), independently of the number of values n.
+
+            :param k: size of the largest compactor. Controls the accuracy/memory trade-off
+            :param seed: random seed for the compactions
+        """
+        self.k = k
+        self.n = 0
+        self.levels = [np.zeros(0, dtype='float32')]
+        self.rng = np.random.RandomState(seed)
+
+    def __len__(self):
+        return self.n
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(int(np.ceil(self.k * (2. / 3.) ** depth)), 2)
+
+    def _compress(self):
+        while sum(len(items) for items in self.levels) > sum(self._capacity(h) for h in range(len(self.levels))):
+            for h, items in enumerate(self.levels):
+                if len(items) >= self._capacity(h):
+                    if h + 1 == len(self.levels):
+                        self.levels.append(np.zeros(0, dtype='float32'))
+                    items = np.sort(items)
+                    # Keep an odd item at this level so that the compacted part has even length
+                    kept = items[:len(items) % 2]
+                    compacted = items[len(items) % 2:]
+                    promoted = compacted[self.rng.randint(2)::2]
+                    self.levels[h] = kept
+                    self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+                    break
+
+    def update(self, values):
+        """
+            Adds a chunk of values to the sketch.
+        """
+        values = np.asarray(values, dtype='float32').ravel()
+        self.n += len(values)
+        # Feed large chunks by pieces, so that the level 0 buffer stays bounded
+        for start in range(0, len(values), self.k):
+            self.levels[0] = np.concatenate([self.levels[0], values[start:start + self.k]])
+            self._compress()
+
+    def merge(self, other):
+        """
+            Merges another sketch (e.g. computed by another worker over a different shard) into this one.
+        """
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.zeros(0, dtype='float32'))
+        for h, items in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], items])
+        self.n += other.n
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """
+            Approximate q-quantile (0 <= q <= 1) of the values seen so far.
+        """
+        if self.n == 0:
+            raise ValueError('Cannot compute quantiles of an empty sketch')
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.ones(len(level_items)) * 2 ** h for h, level_items in enumerate(self.levels)])
+        order = np.argsort(items, kind='mergesort')
+        cumulative_weights = np.cumsum(weights[order])
+        position = np.searchsorted(cumulative_weights, q * cumulative_weights[-1])
+        return float(items[order][min(position, len(items) - 1)])
+
+    def to_dict(self):
+        """
+            Serializable representation, for sending the sketch between processes or storing it with np.savez.
+        """
+        return {'k': self.k, 'n': self.n, 'levels': [np.array(items) for items in self.levels]}
+
+    @classmethod
+    def from_dict(cls, sketch_dict):
+        sketch = cls(k=sketch_dict['k'])
+        sketch.n = sketch_dict['n']
+        sketch.levels = [np.asarray(items, dtype='float32') for items in sketch_dict['levels']]
+        return sketch
+
+
+def sketch_scores(scores, chunk_size=1000000, k=200):
+    """
+        Builds a quantile sketch over an array (or memmap) of scores, reading it by chunks.
+    """
+    sketch = QuantileSketch(k=k)
+    for start in range(0, len(scores), chunk_size):
+        sketch.update(scores[start:start + chunk_size])
+    return sketch
@@ -0,0 +1,145 @@
+import copy
+import logging
+
+import numpy as np
+from keras import backend as K
+from keras.engine.topology import Layer
+from keras.models import Model
+
+from utils.convergence import jaccard
+from utils.embeddings import quantize
+
+
+class QuantizedEmbedding(Layer):
+    def __init__(self, input_dim, output_dim, quantization='int8', mask_zero=False, input_length=None, **kwargs):
+        """
+            Inference-only counterpart of the Embedding layer whose matrix is stored in float16, or in int8 with a
+            float32 scale per row (see utils.embeddings.quantize). Only the rows of the tokens of each batch are
+            dequantized.
+        """
+        if 'input_shape' not in kwargs and input_length is not None:
+            kwargs['input_shape'] = (input_length,)
+        kwargs['trainable'] = False
+        super(QuantizedEmbedding, self).__init__(**kwargs)
+        self.input_dim = input_dim
+        self.output_dim = output_dim
+        self.quantization = quantization
+        self.mask_zero = mask_zero
+        self.input_length = input_length
+
+    def build(self, input_shape):
+        self.quantized_embeddings = self.add_weight(shape=(self.input_dim, self.output_dim),
+                                                    initializer='zeros',
+                                                    name='quantized_embeddings',
+                                                    dtype=self.quantization,
+                                                    trainable=False)
+        self.scales = self.add_weight(shape=(self.input_dim,),
+                                      initializer='ones',
+                                      name='scales',
+                                      trainable=False) if self.quantization == 'int8' else None
+        self.built = True
+
+    def compute_mask(self, inputs, mask=None):
+        if not self.mask_zero:
+            return None
+        return K.not_equal(inputs, 0)
+
+    def compute_output_shape(self, input_shape):
+        return tuple(input_shape) + (self.output_dim,)
+
+    def call(self, inputs):
+        if K.dtype(inputs) != 'int32':
+            inputs = K.cast(inputs, 'int32')
+        outputs = K.cast(K.gather(self.quantized_embeddings, inputs), K.floatx())
+        if self.scales is not None:
+            outputs *= K.expand_dims(K.gather(self.scales, inputs))
+        return outputs
+
+    def get_config(self):
+        config = {'input_dim': self.input_dim,
+                  'output_dim': self.output_dim,
+                  'quantization': self.quantization,
+                  'mask_zero': self.mask_zero,
+                  'input_length': self.input_length}
+        base_config = super(QuantizedEmbedding, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+def quantize_model(model, quantization):
+    """
+        Copy of a Model_Wrapper whose Embedding layers are replaced by QuantizedEmbedding layers, for scoring.
+
+        :param model: Model_Wrapper with a Keras functional model
+        :param quantization: 'float16' or 'int8'
+        :return: (quantized Model_Wrapper, bytes of the embeddings before, bytes after)
+    """
+    keras_model = model.model
+    config = keras_model.get_config()
+    embeddings = dict()
+    for layer_config in config['layers']:
+        if layer_config['class_name'] != 'Embedding':
+            continue
+        layer = keras_model.get_layer(layer_config['config']['name'])
+        embeddings[layer.name] = quantize(layer.get_weights()[0], quantization)
+        layer_config['class_name'] = 'QuantizedEmbedding'
+        layer_config['config'] = {'name': layer.name,
+                                  'input_dim': layer.input_dim,
+                                  'output_dim': layer.output_dim,
+                                  'quantization': quantization,
+                                  'mask_zero': layer.mask_zero,
+                                  'input_length': layer.input_length}
+    if not embeddings:
+        raise Exception, 'The model has no Embedding layers'
+
+    quantized_keras_model = Model.from_config(config, custom_objects={'QuantizedEmbedding': QuantizedEmbedding})
+    original_bytes = 0
+    quantized_bytes = 0
+    for layer in quantized_keras_model.layers:
+        if layer.name in embeddings:
+            quantized, scales = embeddings[layer.name]
+            layer.set_weights([quantized] + ([scales] if scales is not None else []))
+            original_bytes += keras_model.get_layer(layer.name).get_weights()[0].nbytes
+            quantized_bytes += quantized.nbytes + (scales.nbytes if scales is not None else 0)
+        else:
+            layer.set_weights(keras_model.get_layer(layer.name).get_weights())
+
+    quantized_model = copy.copy(model)
+    quantized_model.model = quantized_keras_model
+    return quantized_model, original_bytes, quantized_bytes
+
+
+def selection_overlap(scores, quantized_scores, n_selected):
+    """
+        Agreement between the selections made with the scores of the original and of the quantized model.
+
+        :return: dict with the Jaccard overlap of the top and bottom n_selected sentences and the score differences
+    """
+    scores = np.asarray(scores, dtype='float32')
+    quantized_scores = np.asarray(quantized_scores, dtype='float32')
+    n_selected = max(1, min(n_selected, len(scores)))
+    top = np.argpartition(-scores, n_selected - 1)[:n_selected]
+    quantized_top = np.argpartition(-quantized_scores, n_selected - 1)[:n_selected]
+    bottom = np.argpartition(scores, n_selected - 1)[:n_selected]
+    quantized_bottom = np.argpartition(quantized_scores, n_selected - 1)[:n_selected]
+    differences = np.abs(scores - quantized_scores)
+    return {'top_jaccard': jaccard(top, quantized_top),
+            'bottom_jaccard': jaccard(bottom, quantized_bottom),
+            'mean_score_difference': float(differences.mean()),
+            'max_score_difference': float(differences.max())}
+
+
+def quantization_report(model, quantized_model, vocabularies, filenames, params, n_selected):
+    """
+        Scores the sentences of filenames with both models and compares the selections they would make.
+    """
+    from utils.pipelined_scoring import pipelined_scoring
+
+    probs, _ = pipelined_scoring(model, vocabularies, filenames, params)
+    quantized_probs, _ = pipelined_scoring(quantized_model, vocabularies, filenames, params)
+    report = selection_overlap(np.asarray(probs).reshape(-1, 2)[:, 1],
+                               np.asarray(quantized_probs).reshape(-1, 2)[:, 1], n_selected)
+    logging.info('Quantized embeddings (%s), %d sentences: top-%d overlap %.4f, bottom-%d overlap %.4f, '
+                 'mean score difference %.5f, max %.5f' %
+                 (params['EMBEDDING_QUANTIZATION'], len(probs), n_selected, report['top_jaccard'], n_selected,
+                  report['bottom_jaccard'], report['mean_score_difference'], report['max_score_difference']))
+    return report
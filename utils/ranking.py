@@ -0,0 +1,103 @@
+import heapq
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# Entries read at once from each sorted run while merging
+MERGE_BLOCK_SIZE = 65536
+# Memory used for each entry of a chunk sorted in memory (scores, sort order and positions)
+SORT_BYTES = 24
+
+
+def write_full_ranking(scores, dest_prefix, sort_chunk_size=10000000):
+    """
+        Writes the complete ranking of a pool: dest_prefix.scores holds the in-domain score (float32) of each pool
+        line and dest_prefix.ranking the pool line numbers (int64) sorted by decreasing score.
+
+        In the semisupervised selection, the ranking of iteration i scores the pool read by that iteration
+        (POOL_FILENAME for the first one, <POOL_FILENAME>_<i - 1> in DEST_ROOT_PATH afterwards), and dest_prefix is
+        DEST_ROOT_PATH/<name of that pool>_ranking: e.g. pool_ranking.* and pool_0_ranking.* index the lines of
+        pool.* and pool_0.*.
+
+        :param scores: in-domain (positive class) probability of each pool line
+        :param dest_prefix: prefix of the output files
+        :param sort_chunk_size: maximum number of entries sorted in memory. Larger pools are sorted with an external
+                                merge sort
+        :return: (scores_filename, ranking_filename)
+    """
+    scores_filename = dest_prefix + '.scores'
+    ranking_filename = dest_prefix + '.ranking'
+    np.asarray(scores, dtype='float32').tofile(scores_filename)
+    sort_scores_file(scores_filename, ranking_filename, sort_chunk_size=sort_chunk_size)
+    logging.info('Full ranking of %d sentences written to %s' % (len(scores), ranking_filename))
+    return scores_filename, ranking_filename
+
+
+def sort_scores_file(scores_filename, ranking_filename, sort_chunk_size=10000000):
+    """
+        Sorts a binary float32 score file by decreasing score (ties by line number) and writes the sorted line
+        numbers as int64 to ranking_filename.
+    """
+    scores = np.memmap(scores_filename, dtype='float32', mode='r')
+    n_scores = len(scores)
+    if n_scores <= sort_chunk_size:
+        _sorted_positions(scores, 0).tofile(ranking_filename)
+        return
+
+    # External merge sort: sort chunks into runs on disk, then merge them in a single streaming pass
+    runs_dir = tempfile.mkdtemp(prefix='ranking_runs_', dir=os.path.dirname(os.path.abspath(ranking_filename)))
+    try:
+        runs = []
+        for start in range(0, n_scores, sort_chunk_size):
+            chunk = np.array(scores[start:start + sort_chunk_size])
+            positions = _sorted_positions(chunk, start)
+            run_prefix = os.path.join(runs_dir, 'run_%d' % len(runs))
+            chunk[positions - start].tofile(run_prefix + '.scores')
+            positions.tofile(run_prefix + '.positions')
+            runs.append(run_prefix)
+        logging.info('Merging %d sorted runs of %d scores' % (len(runs), n_scores))
+
+        with open(ranking_filename, 'wb') as ranking_file:
+            buffer_ = []
+            for _, position in heapq.merge(*[_read_run(run_prefix) for run_prefix in runs]):
+                buffer_.append(position)
+                if len(buffer_) == MERGE_BLOCK_SIZE:
+                    np.array(buffer_, dtype='int64').tofile(ranking_file)
+                    buffer_ = []
+            np.array(buffer_, dtype='int64').tofile(ranking_file)
+    finally:
+        shutil.rmtree(runs_dir)
+
+
+def _sorted_positions(scores, offset):
+    positions = np.arange(offset, offset + len(scores), dtype='int64')
+    return positions[np.lexsort((positions, -scores))]
+
+
+def _read_run(run_prefix):
+    """
+        Yields the (-score, position) entries of a sorted run, reading it by blocks.
+    """
+    scores = np.memmap(run_prefix + '.scores', dtype='float32', mode='r')
+    positions = np.memmap(run_prefix + '.positions', dtype='int64', mode='r')
+    for start in range(0, len(scores), MERGE_BLOCK_SIZE):
+        for score, position in zip((-scores[start:start + MERGE_BLOCK_SIZE]).tolist(),
+                                   positions[start:start + MERGE_BLOCK_SIZE].tolist()):
+            yield score, position
+
+
+def ranking_selection_mask(scores_filename, ranking_filename, top_k=None, min_score=None):
+    """
+        Boolean mask over the pool lines selected either by the top_k first entries of the ranking or by having a
+        score >= min_score.
+    """
+    scores = np.memmap(scores_filename, dtype='float32', mode='r')
+    if top_k is not None:
+        ranking = np.memmap(ranking_filename, dtype='int64', mode='r')
+        selected = np.zeros(len(scores), dtype='bool')
+        selected[ranking[:top_k]] = True
+        return selected
+    return np.asarray(scores >= min_score)
@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+
+
+class ScoreStore(object):
+    def __init__(self, filename=None):
+        """
+            Persistent store of the last classifier scores of the pool sentences, keyed by sentence-pair hash
+            (see utils.deduplication.hash_pair).
+
+            :param filename: .npz file where the store is kept. If it exists, the store is loaded from it.
+        """
+        self.filename = filename
+        self.keys = np.zeros(0, dtype='int64')  # Sorted pair hashes
+        self.scores = np.zeros((0, 2), dtype='float32')  # Last class probabilities of each pair
+        self.iterations = np.zeros(0, dtype='int32')  # Iteration in which each score was computed
+        if filename is not None and os.path.isfile(filename):
+            self.load()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def load(self):
+        stored = np.load(self.filename)
+        self.keys = stored['keys']
+        self.scores = stored['scores']
+        self.iterations = stored['iterations']
+
+    def save(self):
+        with open(self.filename, 'wb') as f:
+            np.savez(f, keys=self.keys, scores=self.scores, iterations=self.iterations)
+
+    def lookup(self, keys):
+        """
+            Retrieves the stored scores of a set of pairs.
+
+            :param keys: pair hashes
+            :return: (scores, iterations, found). Rows of pairs not found in the store are zeroed and their iteration
+                     is set to -1.
+        """
+        keys = np.asarray(keys, dtype='int64')
+        positions = np.searchsorted(self.keys, keys)
+        positions[positions == len(self.keys)] = 0
+        found = self.keys[positions] == keys if len(self.keys) > 0 else np.zeros(len(keys), dtype='bool')
+        scores = np.zeros((len(keys), 2), dtype='float32')
+        iterations = np.empty(len(keys), dtype='int32')
+        iterations.fill(-1)
+        scores[found] = self.scores[positions[found]]
+        iterations[found] = self.iterations[positions[found]]
+        return scores, iterations, found
+
+    def update(self, keys, scores, iteration):
+        """
+            Inserts or overwrites the scores of a set of pairs.
+        """
+        keys = np.asarray(keys, dtype='int64')
+        scores = np.asarray(scores, dtype='float32').reshape(-1, 2)
+        all_keys = np.concatenate([self.keys, keys])
+        all_scores = np.concatenate([self.scores, scores])
+        all_iterations = np.concatenate([self.iterations, np.empty(len(keys), dtype='int32')])
+        all_iterations[len(self.keys):] = iteration
+        # Stable sort: among repeated keys, the newest entry comes last and is the one kept
+        order = np.argsort(all_keys, kind='mergesort')
+        all_keys = all_keys[order]
+        last = np.append(all_keys[1:] != all_keys[:-1], True)
+        self.keys = all_keys[last]
+        self.scores = all_scores[order][last]
+        self.iterations = all_iterations[order][last]
+
+
+def select_rescoring_subset(previous_scores, n_instances_to_add, sample_size, boundary_margin, seed=None):
+    """
+        Chooses which pool sentences are rescored in an incremental iteration: a uniform random sample (used for
+        measuring the score drift) plus the sentences ranked near the top/bottom selection boundaries by their
+        previous scores (the current top-r candidates and the next boundary_margin sentences).
+
+        :param previous_scores: stored class probabilities of the pool sentences
+        :param n_instances_to_add: number of positive and negative sentences selected per iteration
+        :param sample_size: size of the random sample
+        :param boundary_margin: number of sentences beyond each selection boundary that are rescored
+        :param seed: random seed
+        :return: (rescore_positions, sample_positions), both sorted
+    """
+    n_sentences = len(previous_scores)
+    rng = np.random.RandomState(seed)
+    sample_positions = np.sort(rng.choice(n_sentences, min(sample_size, n_sentences), replace=False))
+    n_boundary = min(n_instances_to_add + boundary_margin, n_sentences)
+    top_positive_positions = previous_scores.argsort(axis=0)[:, 0][:n_boundary]
+    top_negative_positions = previous_scores.argsort(axis=0)[:, 1][:n_boundary]
+    rescore_positions = np.union1d(np.union1d(sample_positions, top_positive_positions), top_negative_positions)
+    return rescore_positions.astype('int64'), sample_positions.astype('int64')
+
+
+def score_drift(previous_scores, new_scores):
+    """
+        Mean absolute change of the positive class probability.
+    """
+    if len(previous_scores) == 0:
+        return 0.
+    return float(np.abs(np.asarray(new_scores)[:, 1] - np.asarray(previous_scores)[:, 1]).mean())
+
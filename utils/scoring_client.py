@@ -0,0 +1,130 @@
+import argparse
+import httplib
+import json
+import os
+import socket
+import sys
+import threading
+from timeit import default_timer as timer
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.corpus_io import open_corpus
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class ScoringClient(object):
+    def __init__(self, address, timeout=None):
+        """
+            Client of the scoring server (utils/scoring_server.py).
+
+            :param address: 'host:port' or the path of a Unix socket
+        """
+        self.address = address
+        self.timeout = timeout
+        self._connection = None
+
+    def _connect(self):
+        if os.path.exists(self.address):
+            return UnixHTTPConnection(self.address, timeout=self.timeout)
+        host, port = self.address.rsplit(':', 1)
+        return httplib.HTTPConnection(host, int(port), timeout=self.timeout)
+
+    def _request(self, method, path, body=None):
+        if self._connection is None:
+            self._connection = self._connect()
+        try:
+            self._connection.request(method, path, body, {'Content-Type': 'application/json'})
+            response = self._connection.getresponse()
+            content = json.loads(response.read())
+        except (httplib.HTTPException, socket.error):
+            self._connection.close()
+            self._connection = None
+            raise
+        if response.status != 200:
+            raise IOError('Scoring server error %d: %s' % (response.status, content.get('error')))
+        return content
+
+    def score(self, pairs):
+        """
+            :param pairs: list of items with one sentence per model input (e.g. [source, target] pairs)
+            :return: in-domain score of each item
+        """
+        return self._request('POST', '/score', json.dumps({'sentences': pairs}))['scores']
+
+    def stats(self):
+        return self._request('GET', '/stats')
+
+
+def load_test(address, pairs, n_clients, request_size, n_requests):
+    """
+        Sends n_requests requests of request_size items from n_clients concurrent clients.
+
+        :return: dict with the throughput and the latency percentiles observed by the clients
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def run(client_id):
+        client = ScoringClient(address)
+        for r in range(client_id, n_requests, n_clients):
+            start = (r * request_size) % len(pairs)
+            request = (pairs[start:] + pairs[:start])[:request_size]
+            start_time = timer()
+            try:
+                client.score(request)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                latencies.append(timer() - start_time)
+
+    start_time = timer()
+    threads = [threading.Thread(target=run, args=(c,)) for c in range(n_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = timer() - start_time
+    results = {'requests': len(latencies), 'errors': len(errors), 'seconds': elapsed,
+               'sentences_per_second': len(latencies) * request_size / elapsed if elapsed > 0 else 0.}
+    for percentile in [50, 90, 99]:
+        results['latency_p%d' % percentile] = float(np.percentile(latencies, percentile)) if latencies else 0.
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test of the scoring server')
+    parser.add_argument('address', help='host:port or Unix socket of the server')
+    parser.add_argument('files', nargs='+', help='Sentences sent to the server, one file per model input '
+                                                 '(e.g. pool.de pool.en)')
+    parser.add_argument('-c', '--clients', type=int, default=8, help='Concurrent clients')
+    parser.add_argument('-s', '--request-size', type=int, default=1, help='Sentences per request')
+    parser.add_argument('-n', '--requests', type=int, default=1000, help='Total number of requests')
+    parser.add_argument('-m', '--max-sentences', type=int, default=100000, help='Sentences read from the files')
+    args = parser.parse_args()
+
+    files = [open_corpus(filename) for filename in args.files]
+    pairs = []
+    for lines in zip(*files):
+        pairs.append([line.rstrip('\n') for line in lines])
+        if len(pairs) >= args.max_sentences:
+            break
+    for f in files:
+        f.close()
+
+    results = load_test(args.address, pairs, args.clients, args.request_size, args.requests)
+    print "Client side:", json.dumps(results, sort_keys=True)
+    print "Server side:", json.dumps(ScoringClient(args.address).stats(), sort_keys=True)
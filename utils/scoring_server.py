@@ -0,0 +1,228 @@
+import json
+import logging
+import os
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from Queue import Queue, Empty
+from SocketServer import ThreadingMixIn, UnixStreamServer
+from collections import deque
+from timeit import default_timer as timer
+
+import numpy as np
+
+from utils.pipelined_scoring import init_encoder, encode_batch
+
+LATENCY_WINDOW = 10000  # Latencies kept for computing the percentiles reported by /stats
+
+
+class _Request(object):
+    def __init__(self, inputs):
+        """
+            Sentences of a scoring request (one list per model input) waiting to be scored.
+        """
+        self.inputs = inputs
+        self.size = len(inputs[0])
+        self.arrival = timer()
+        self.done = threading.Event()
+        self.scores = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    def __init__(self, model, vocabularies, params):
+        """
+            Scores the concurrent requests in micro-batches. A single thread runs the model: it waits for the first
+            pending request, then keeps merging requests until the batch reaches max_batch_size sentences or
+            the oldest request has waited max_latency seconds.
+
+            :param model: trained Model_Wrapper
+            :param vocabularies: vocabulary of each input of the model
+            :param params: configuration parameters (PREDICTION_BATCH_SIZE is the largest micro-batch,
+                           SERVER_MAX_LATENCY the longest time a request waits for others to join its batch)
+        """
+        self.model = model
+        self.max_batch_size = params['PREDICTION_BATCH_SIZE']
+        self.max_latency = params['SERVER_MAX_LATENCY']
+        self.n_inputs = len(vocabularies)
+        init_encoder(vocabularies, params)
+
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self.start_time = timer()
+        self.counters = {'requests': 0, 'sentences': 0, 'batches': 0, 'errors': 0, 'busy_time': 0.}
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def score(self, inputs):
+        """
+            Scores a list of sentences per model input, blocking until their micro-batch is processed.
+
+            :return: in-domain score (probability of the positive class) of each sentence
+        """
+        request = _Request(inputs)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.scores
+
+    def _next_batch(self):
+        requests = [self._queue.get()]
+        size = requests[0].size
+        deadline = requests[0].arrival + self.max_latency
+        while size < self.max_batch_size:
+            try:
+                request = self._queue.get(timeout=max(deadline - timer(), 0.))
+            except Empty:
+                break
+            requests.append(request)
+            size += request.size
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._next_batch()
+            start_time = timer()
+            try:
+                batch = [sum([request.inputs[k] for request in requests], []) for k in range(self.n_inputs)]
+                encoded, _ = encode_batch(batch)
+                probs = self.model.model.predict_on_batch(dict((id_in, X) for id_in, X in
+                                                               zip(self.model.ids_inputs, encoded)))
+                scores = np.asarray(probs)[:, 1].tolist()
+                position = 0
+                for request in requests:
+                    request.scores = scores[position:position + request.size]
+                    position += request.size
+            except Exception as e:
+                logging.error('Error scoring a batch of %d requests: %s' % (len(requests), str(e)))
+                for request in requests:
+                    request.error = e
+            end_time = timer()
+
+            with self._lock:
+                self.counters['batches'] += 1
+                self.counters['busy_time'] += end_time - start_time
+                for request in requests:
+                    if request.error is None:
+                        self.counters['requests'] += 1
+                        self.counters['sentences'] += request.size
+                        self._latencies.append(end_time - request.arrival)
+                    else:
+                        self.counters['errors'] += 1
+            for request in requests:
+                request.done.set()
+
+    def stats(self):
+        """
+            Throughput and latency counters since the server started.
+        """
+        with self._lock:
+            stats = dict(self.counters)
+            latencies = np.array(self._latencies)
+        elapsed = timer() - self.start_time
+        stats['uptime'] = elapsed
+        stats['sentences_per_second'] = stats['sentences'] / elapsed if elapsed > 0 else 0.
+        stats['mean_batch_size'] = float(stats['sentences']) / stats['batches'] if stats['batches'] else 0.
+        stats['occupancy'] = stats['busy_time'] / elapsed if elapsed > 0 else 0.
+        for percentile in [50, 90, 99]:
+            stats['latency_p%d' % percentile] = float(np.percentile(latencies, percentile)) if len(latencies) else 0.
+        return stats
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    """
+        POST /score with {"sentences": [[src, trg], ...]} (one sentence per model input) returns {"scores": [...]}.
+        GET /stats returns the counters of the server.
+    """
+    protocol_version = 'HTTP/1.1'  # Keep-alive connections
+    wbufsize = -1  # Send each response at once (flushed by handle_one_request)
+
+    def _reply(self, code, content):
+        body = json.dumps(content)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.server.batcher.stats())
+        else:
+            self._reply(404, {'error': 'Unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self._reply(404, {'error': 'Unknown path %s' % self.path})
+            return
+        try:
+            pairs = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))['sentences']
+            if any(len(pair) != self.server.batcher.n_inputs for pair in pairs):
+                raise ValueError('Each item must have %d sentences' % self.server.batcher.n_inputs)
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': str(e)})
+            return
+        if not pairs:
+            self._reply(200, {'scores': []})
+            return
+        inputs = [[sentence.encode('utf-8') if isinstance(sentence, unicode) else sentence for sentence in input_]
+                  for input_ in zip(*pairs)]
+        try:
+            self._reply(200, {'scores': self.server.batcher.score(inputs)})
+        except Exception as e:
+            self._reply(500, {'error': str(e)})
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else self.server.server_address
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        UnixStreamServer.server_bind(self)
+        self.server_name = self.server_address
+        self.server_port = 0
+
+
+def serve(model, vocabularies, params):
+    """
+        Runs the scoring server until it is interrupted. It listens on the Unix socket SERVER_SOCKET if it is set, or on
+        SERVER_HOST:SERVER_PORT otherwise.
+
+        :param model: trained Model_Wrapper, loaded only once
+        :param vocabularies: vocabulary of each input of the model
+        :param params: configuration parameters
+    """
+    if params['SERVER_SOCKET']:
+        if os.path.exists(params['SERVER_SOCKET']):
+            os.remove(params['SERVER_SOCKET'])
+        server = ThreadingUnixHTTPServer(params['SERVER_SOCKET'], ScoringRequestHandler)
+        address = params['SERVER_SOCKET']
+    else:
+        server = ThreadingHTTPServer((params['SERVER_HOST'], params['SERVER_PORT']), ScoringRequestHandler)
+        address = 'http://%s:%d' % (params['SERVER_HOST'], params['SERVER_PORT'])
+    server.batcher = MicroBatcher(model, vocabularies, params)
+    logging.info('Scoring server listening on %s' % address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if params['SERVER_SOCKET']:
+            try:
+                os.remove(params['SERVER_SOCKET'])
+            except OSError:
+                pass
+    logging.info('Scoring server stopped. %s' % json.dumps(server.batcher.stats()))
@@ -0,0 +1,53 @@
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.corpus_io import compression_extension, open_corpus
+from utils.ranking import ranking_selection_mask
+
+
+def select_from_ranking(pool_filenames, scores_filename, ranking_filename, dest_prefix, top_k=None, min_score=None):
+    """
+        Materializes a subset of a ranked pool in a single streaming pass, without touching the model.
+
+        :param pool_filenames: files of the pool (e.g. its source and target sides), aligned with the ranking
+        :param scores_filename: binary float32 score file written by utils.ranking.write_full_ranking
+        :param ranking_filename: binary int64 ranking file written by utils.ranking.write_full_ranking
+        :param dest_prefix: the selection of each pool file is written to dest_prefix + its extension (language and
+                            compression)
+        :param top_k: select the top_k best-scored sentences
+        :param min_score: select the sentences whose score is >= min_score
+        :return: number of selected sentences
+    """
+    selected = ranking_selection_mask(scores_filename, ranking_filename, top_k=top_k, min_score=min_score)
+    pool_files = [open_corpus(filename) for filename in pool_filenames]
+    dest_files = []
+    for filename in pool_filenames:
+        compression = compression_extension(filename)
+        language = os.path.splitext(filename[:len(filename) - len(compression)])[1]
+        dest_files.append(open_corpus(dest_prefix + language + compression, 'w'))
+    n_selected = 0
+    for i, lines in enumerate(zip(*pool_files)):
+        if selected[i]:
+            for dest_file, line in zip(dest_files, lines):
+                dest_file.write(line)
+            n_selected += 1
+    for f in pool_files + dest_files:
+        f.close()
+    return n_selected
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Selects a top-k or score-threshold subset from a full pool ranking')
+    parser.add_argument('ranking_prefix', help='Prefix of the .scores and .ranking files')
+    parser.add_argument('dest_prefix', help='Prefix of the selected files (the pool file extensions are appended)')
+    parser.add_argument('pool', nargs='+', help='Pool files (e.g. pool.de pool.en)')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-k', '--top-k', type=int, help='Number of best-scored sentences to select')
+    group.add_argument('-t', '--threshold', type=float, help='Minimum in-domain score of the selected sentences')
+    args = parser.parse_args()
+
+    n = select_from_ranking(args.pool, args.ranking_prefix + '.scores', args.ranking_prefix + '.ranking',
+                            args.dest_prefix, top_k=args.top_k, min_score=args.threshold)
+    print "Selected %d sentences" % n
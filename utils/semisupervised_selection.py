@@ -1,11 +1,121 @@
+import logging
+
 import numpy as np
 
+from data_engine.labeled_sources import LabeledSources
+from utils.corpus_io import open_corpus
+from utils.line_index import corpus_line_index
+from utils.quantile_sketch import QuantileSketch, sketch_scores
+
+# Selection decisions, matching the labels written to the class files
+POSITIVE = 1
+NEGATIVE = 0
+NEUTRAL = -1
+DISCARDED = -2
+
+RESERVOIR_BYTES_PER_LINE = 56  # Memory used by reservoir_sample_lines for each line of a chunk
+SCORE_BYTES = 16  # Memory used by the selection for each score of a chunk
+
+
+def score_sketch(params):
+    """
+        Empty QuantileSketch for the thresholds of the 'quantile' selection policy, to be fed while scoring the pool
+        (see main.score_files). None for the other policies.
+    """
+    return QuantileSketch(k=params['SKETCH_SIZE']) if params['SELECTION_POLICY'] == 'quantile' else None
+
+
+def selection_thresholds(scores, params, sketch=None):
+    """
+        Computes the (positive, negative) score thresholds of the 'threshold' and 'quantile' selection policies.
+        Sentences scoring >= the positive threshold are selected as positive and those scoring <= the negative
+        threshold as negative. Quantiles are estimated with a streaming sketch: the one fed while scoring (merged from
+        the sketches of the scoring processes) if given, or else one built over chunks of the scores.
+
+        :param scores: in-domain (positive class) probability of each scored sentence
+        :param params: configuration parameters
+        :param sketch: QuantileSketch of all the scores, if it was built while scoring
+        :return: (positive_threshold, negative_threshold)
+    """
+    if params['SELECTION_POLICY'] == 'threshold':
+        return params['POSITIVE_THRESHOLD'], params['NEGATIVE_THRESHOLD']
+    elif params['SELECTION_POLICY'] == 'quantile':
+        if sketch is None or len(sketch) != len(scores):
+            sketch = sketch_scores(scores, chunk_size=params['SCORE_CHUNK_SIZE'], k=params['SKETCH_SIZE'])
+        return sketch.quantile(params['POSITIVE_QUANTILE']), sketch.quantile(params['NEGATIVE_QUANTILE'])
+    raise AttributeError('Unknown SELECTION_POLICY "%s"' % params['SELECTION_POLICY'])
+
+
+def selection_decisions(prediction_probs, n_intances_to_add, dedup_index=None, keep_duplicates=True,
+                        thresholds=None, chunk_size=1000000):
+    """
+        Decides the partition (POSITIVE, NEGATIVE, NEUTRAL or DISCARDED) of each pool sentence according to the
+        classifier probabilities. See process_prediction_probs for the parameters.
 
-def process_prediction_probs(prediction_probs, n_intances_to_add, pool_src, pool_trg, verbose=0):
+        :return: int8 array with the decision of each line of the pool
+    """
     probs = np.array(prediction_probs, dtype="float32")
     probs = probs.reshape(-1, 2)
-    top_positive_positions = probs.argsort(axis=0)[:, 0][:n_intances_to_add]
-    top_negative_positions = probs.argsort(axis=0)[:, 1][:n_intances_to_add]
+
+    selection = np.empty(len(probs), dtype='int8')
+    selection.fill(NEUTRAL)
+    if thresholds is None:
+        n_intances_to_add = min(n_intances_to_add, len(probs))
+        if n_intances_to_add > 0:
+            top_positive_positions = np.argpartition(probs[:, 0], n_intances_to_add - 1)[:n_intances_to_add]
+            top_negative_positions = np.argpartition(probs[:, 1], n_intances_to_add - 1)[:n_intances_to_add]
+            selection[top_positive_positions] = POSITIVE
+            selection[top_negative_positions] = NEGATIVE
+    else:
+        positive_threshold, negative_threshold = thresholds
+        for start in range(0, len(probs), chunk_size):
+            scores = probs[start:start + chunk_size, 1]
+            chunk_selection = selection[start:start + chunk_size]
+            chunk_selection[scores >= positive_threshold] = POSITIVE
+            chunk_selection[scores <= negative_threshold] = NEGATIVE
+    if dedup_index is not None:
+        selection = dedup_index.expand(selection)
+        if not keep_duplicates:
+            selection[~dedup_index.is_first_occurrence()] = DISCARDED
+    return selection
+
+
+def process_prediction_probs(prediction_probs, n_intances_to_add, pool_src, pool_trg, verbose=0,
+                             dedup_index=None, keep_duplicates=True, thresholds=None, chunk_size=1000000,
+                             line_indexes=None, selection=None):
+    """
+        Splits the pool into positive, negative and neutral sentences according to the classifier probabilities.
+
+        :param prediction_probs: class probabilities of the scored sentences
+        :param n_intances_to_add: number of positive and negative sentences to select
+        :param pool_src: path to the source side of the pool
+        :param pool_trg: path to the target side of the pool
+        :param verbose: print progress information
+        :param dedup_index: DedupIndex of the pool. If given, prediction_probs hold one row per unique pair and the
+                            decisions are mapped back to every occurrence
+        :param keep_duplicates: if False, only the first occurrence of each pair is kept in the output corpora
+        :param thresholds: (positive, negative) score thresholds (see selection_thresholds). If None, the
+                           n_intances_to_add top/bottom sentences are selected
+        :param chunk_size: number of scores compared at once against the thresholds
+        :param line_indexes: (source, target) LineIndex of the pool. If given, the lines of each partition are
+                             fetched through the indexes instead of scanning the pool
+        :param selection: decisions already computed by selection_decisions (the previous parameters are then only
+                          used for reading the pool)
+    """
+    if selection is None:
+        selection = selection_decisions(prediction_probs, n_intances_to_add, dedup_index=dedup_index,
+                                        keep_duplicates=keep_duplicates, thresholds=thresholds,
+                                        chunk_size=chunk_size)
+
+    if line_indexes is not None:
+        index_src, index_trg = line_indexes
+        positive_positions = np.flatnonzero(selection == POSITIVE)
+        negative_positions = np.flatnonzero(selection == NEGATIVE)
+        neutral_positions = np.flatnonzero(selection == NEUTRAL)
+        return index_src.get_lines(positive_positions), index_trg.get_lines(positive_positions), \
+            index_src.get_lines(negative_positions), index_trg.get_lines(negative_positions), \
+            index_src.get_lines(neutral_positions), index_trg.get_lines(neutral_positions)
+
     positive_lines_src = []
     positive_lines_trg = []
     negative_lines_src = []
@@ -13,20 +123,20 @@ def process_prediction_probs(prediction_probs, n_intances_to_add, pool_src, pool
     neutral_lines_src = []
     neutral_lines_trg = []
 
-    pool_file_src = open(pool_src)
-    pool_file_trg = open(pool_trg)
+    pool_file_src = open_corpus(pool_src)
+    pool_file_trg = open_corpus(pool_trg)
 
     for i, (line_src, line_trg) in enumerate(zip(pool_file_src, pool_file_trg)):
         if verbose:
             if i % 1000 == 0:
                 print "Classified %d sentences \r" % i,
-        if i in top_negative_positions:
+        if selection[i] == NEGATIVE:
             negative_lines_src.append(line_src)
             negative_lines_trg.append(line_trg)
-        elif i in top_positive_positions:
+        elif selection[i] == POSITIVE:
             positive_lines_src.append(line_src)
             positive_lines_trg.append(line_trg)
-        else:
+        elif selection[i] == NEUTRAL:
             neutral_lines_src.append(line_src)
             neutral_lines_trg.append(line_trg)
 
@@ -36,6 +146,35 @@ def process_prediction_probs(prediction_probs, n_intances_to_add, pool_src, pool
     return positive_lines_src, positive_lines_trg, negative_lines_src, negative_lines_trg, neutral_lines_src, neutral_lines_trg
 
 
+def write_partitions(selection, pool_src, pool_trg, outputs):
+    """
+        Streaming version of process_prediction_probs: writes the lines of each partition of the pool to their files
+        as the pool is read, instead of holding them in lists.
+
+        :param selection: decisions of selection_decisions
+        :param pool_src: path to the source side of the pool
+        :param pool_trg: path to the target side of the pool
+        :param outputs: dict mapping decisions (POSITIVE, NEGATIVE, NEUTRAL) to their (source, target) open files
+        :return: (dict with the number of lines written for each decision, dict with the first pair of each decision)
+    """
+    counts = dict((decision, 0) for decision in outputs)
+    samples = dict()
+    pool_file_src = open_corpus(pool_src)
+    pool_file_trg = open_corpus(pool_trg)
+    for decision, line_src, line_trg in zip(selection, pool_file_src, pool_file_trg):
+        files = outputs.get(decision)
+        if files is None:
+            continue
+        files[0].write(line_src)
+        files[1].write(line_trg)
+        counts[decision] += 1
+        if decision not in samples:
+            samples[decision] = (line_src, line_trg)
+    pool_file_src.close()
+    pool_file_trg.close()
+    return counts, samples
+
+
 def update_config_params(params,
                          pos_filename,
                          neg_filename,
@@ -47,7 +186,120 @@ def update_config_params(params,
     return params
 
 
-def process_files_binary_classification(params, i=0):
+def pool_input_files(params, pool_filename):
+    """
+        Files of a pool that are fed to the classifier, one per input of the dataset.
+    """
+    return [pool_filename + '.' + params['SRC_LAN'],
+            pool_filename + '.' + params['TRG_LAN']] if params['BILINGUAL_SELECTION'] \
+        else [pool_filename + '.' + params['TRG_LAN']]
+
+
+def selected_lines(f, positions=None):
+    """
+        Yields the lines of the file object f whose (0-based) numbers are in the sorted array positions
+        (all of them if positions is None).
+    """
+    if positions is None:
+        for line in f:
+            yield line
+        return
+    selected = np.zeros(positions[-1] + 1 if len(positions) > 0 else 0, dtype='bool')
+    selected[positions] = True
+    for i, line in enumerate(f):
+        if i >= len(selected):
+            break
+        if selected[i]:
+            yield line
+
+
+def extract_lines(filename, dest_filename, positions, line_index=None):
+    """
+        Writes the lines of filename whose (0-based) numbers are in the sorted array positions. If the LineIndex of
+        the file is given, the lines are fetched through it instead of scanning the file.
+    """
+    with open(dest_filename, 'w') as dest_file:
+        if line_index is not None:
+            dest_file.writelines(line_index.get_lines(positions))
+            return
+        with open_corpus(filename) as f:
+            for line in selected_lines(f, positions):
+                dest_file.write(line)
+
+
+def reservoir_sample_lines(filename, n_samples, new_range=None, new_weight=1., chunk_size=1000000, seed=None,
+                           n_lines=None):
+    """
+        Weighted reservoir sampling (Efraimidis-Spirakis) of the lines of a file, in a single pass with memory bounded
+        by n_samples + chunk_size.
+
+        :param filename: file to sample from
+        :param n_samples: number of lines to keep
+        :param new_range: (start, end) line numbers of the newly selected sentences
+        :param new_weight: sampling weight of the lines in new_range (the rest have weight 1)
+        :param chunk_size: number of sampling keys generated at once
+        :param seed: random seed
+        :param n_lines: number of lines of the file, if known (e.g. from its LineIndex)
+        :return: sorted array with the numbers of the sampled lines
+    """
+    rng = np.random.RandomState(seed)
+    if n_lines is None:
+        n_lines = 0
+        with open_corpus(filename) as f:
+            for n_lines, _ in enumerate(f, 1):
+                pass
+    reservoir_keys = np.zeros(0, dtype='float64')
+    reservoir_positions = np.zeros(0, dtype='int64')
+    for start in range(0, n_lines, chunk_size):
+        positions = np.arange(start, min(start + chunk_size, n_lines), dtype='int64')
+        weights = np.ones(len(positions))
+        if new_range is not None:
+            weights[(positions >= new_range[0]) & (positions < new_range[1])] = new_weight
+        keys = np.concatenate([reservoir_keys, rng.random_sample(len(positions)) ** (1. / weights)])
+        positions = np.concatenate([reservoir_positions, positions])
+        if len(keys) > n_samples:
+            kept = np.argpartition(-keys, n_samples - 1)[:n_samples]
+            keys = keys[kept]
+            positions = positions[kept]
+        reservoir_keys = keys
+        reservoir_positions = positions
+    return np.sort(reservoir_positions)
+
+
+def _n_lines(filename, params):
+    """
+        Number of lines of a corpus given by its line index, or None if it has no index.
+    """
+    line_index = corpus_line_index(filename, enabled=params['USE_LINE_INDEX'])
+    return len(line_index) if line_index is not None else None
+
+
+def sample_sources(prefixes, extension, n_samples, params, new_range=None, chunk_size=1000000, seed=None):
+    """
+        Reservoir sampling (see reservoir_sample_lines) over the lines of several corpora read one after the other.
+
+        :param prefixes: corpora (their files are prefix + '.' + extension)
+        :param new_range: (start, end) line numbers of the newly selected sentences, within the concatenated corpora
+        :return: sorted array with the sampled line numbers of each corpus
+    """
+    filenames = [prefix + '.' + extension for prefix in prefixes]
+    counts = []
+    for filename in filenames:
+        n_lines = _n_lines(filename, params)
+        if n_lines is None:
+            with open_corpus(filename) as f:
+                n_lines = sum(1 for _ in f)
+        counts.append(n_lines)
+    positions = reservoir_sample_lines(filenames[0], n_samples, new_range=new_range,
+                                       new_weight=params['NEW_INSTANCES_WEIGHT'], chunk_size=chunk_size, seed=seed,
+                                       n_lines=sum(counts))
+    offsets = np.cumsum([0] + counts)
+    return [positions[(positions >= offsets[k]) & (positions < offsets[k + 1])] - offsets[k]
+            for k in range(len(prefixes))]
+
+
+def process_files_binary_classification(params, i=0, budget=None):
+    reservoir_chunk_size = budget.chunk_size(1000000, RESERVOIR_BYTES_PER_LINE) if budget is not None else 1000000
     if i == 0:
         for (split, filename) in params['TEXT_FILES'].iteritems():
             params['TEXT_FILES'][split] = params['DATA_ROOT_PATH'] + '/' + filename + '.' + params['SRC_LAN']
@@ -56,7 +308,36 @@ def process_files_binary_classification(params, i=0):
         for (split, filename) in params['CLASS_FILES'].iteritems():
             params['CLASS_FILES'][split] = params['DATA_ROOT_PATH'] + '/' + filename
 
-    if params['BINARY_SELECTION']:
+    if params['BINARY_SELECTION'] and params['VIRTUAL_TRAINING_SET']:
+        # Present the positive and negative corpora as a single labeled split, without writing temporary files.
+        # POSITIVE_FILENAME may be a list of corpora (e.g. the selected sentences and the in-domain corpus)
+        pos_prefixes = params['POSITIVE_FILENAME'] if isinstance(params['POSITIVE_FILENAME'], list) \
+            else [params['POSITIVE_FILENAME']]
+        positive_positions = [None] * len(pos_prefixes)
+        negative_positions = [None]
+        if params['MAX_TRAINING_INSTANCES_PER_CLASS'] > 0:
+            new_ranges = params.get('NEW_INSTANCES_RANGES', dict())
+            positive_positions = sample_sources(pos_prefixes, params['SRC_LAN'],
+                                                params['MAX_TRAINING_INSTANCES_PER_CLASS'], params,
+                                                new_range=new_ranges.get('positive'),
+                                                chunk_size=reservoir_chunk_size, seed=i)
+            negative_positions = sample_sources([params['NEGATIVE_FILENAME']], params['SRC_LAN'],
+                                                params['MAX_TRAINING_INSTANCES_PER_CLASS'], params,
+                                                new_range=new_ranges.get('negative'),
+                                                chunk_size=reservoir_chunk_size, seed=i)
+            logging.info('Training on %d positive and %d negative sampled sentences' %
+                         (sum(len(positions) for positions in positive_positions), len(negative_positions[0])))
+        training_sources = LabeledSources([(prefix, 1, positions)
+                                           for prefix, positions in zip(pos_prefixes, positive_positions)] +
+                                          [(params['NEGATIVE_FILENAME'], 0, negative_positions[0])],
+                                          [params['SRC_LAN'], params['TRG_LAN']] if params['BILINGUAL_SELECTION']
+                                          else [params['SRC_LAN']],
+                                          persistent_index=params['USE_LINE_INDEX'])
+        params['POOL_FILENAME'] = pool_input_files(params, params['POOL_FILENAME'])
+        params['TEXT_FILES']['train'] = training_sources
+        params['CLASS_FILES']['train'] = training_sources
+
+    elif params['BINARY_SELECTION']:
         pos_filename_src = params['POSITIVE_FILENAME'] + '.' + params['SRC_LAN']
         neg_filename_src = params['NEGATIVE_FILENAME'] + '.' + params['SRC_LAN']
 
@@ -64,6 +345,28 @@ def process_files_binary_classification(params, i=0):
             pos_filename_trg = params['POSITIVE_FILENAME'] + '.' + params['TRG_LAN']
             neg_filename_trg = params['NEGATIVE_FILENAME'] + '.' + params['TRG_LAN']
 
+        # Bound the size of each class by (weighted) reservoir sampling over the accumulated data
+        positive_positions = None
+        negative_positions = None
+        if params['MAX_TRAINING_INSTANCES_PER_CLASS'] > 0:
+            new_ranges = params.get('NEW_INSTANCES_RANGES', dict())
+            positive_positions = reservoir_sample_lines(pos_filename_src,
+                                                        params['MAX_TRAINING_INSTANCES_PER_CLASS'],
+                                                        new_range=new_ranges.get('positive'),
+                                                        new_weight=params['NEW_INSTANCES_WEIGHT'],
+                                                        chunk_size=reservoir_chunk_size,
+                                                        seed=i,
+                                                        n_lines=_n_lines(pos_filename_src, params))
+            negative_positions = reservoir_sample_lines(neg_filename_src,
+                                                        params['MAX_TRAINING_INSTANCES_PER_CLASS'],
+                                                        new_range=new_ranges.get('negative'),
+                                                        new_weight=params['NEW_INSTANCES_WEIGHT'],
+                                                        chunk_size=reservoir_chunk_size,
+                                                        seed=i,
+                                                        n_lines=_n_lines(neg_filename_src, params))
+            logging.info('Training on %d positive and %d negative sampled sentences' %
+                         (len(positive_positions), len(negative_positions)))
+
         dest_sentences_src_filename = params['DEST_ROOT_PATH'] + '/training_pos_neg_' + str(i) + '_tmp' + '.' + params[
             'SRC_LAN']
         dest_sentences_file_src = open(dest_sentences_src_filename, 'w')
@@ -76,21 +379,21 @@ def process_files_binary_classification(params, i=0):
         dest_classes_filename = params['DEST_ROOT_PATH'] + '/training_pos_neg_%d_tmp.class' % i
 
         dest_classes_file = open(dest_classes_filename, 'w')
-        positive_file_src = open(pos_filename_src, 'r')
-        for line in positive_file_src:
+        positive_file_src = open_corpus(pos_filename_src, 'r')
+        for line in selected_lines(positive_file_src, positive_positions):
             dest_sentences_file_src.write(line)
             dest_classes_file.write('1\n')
-        negative_file_src = open(neg_filename_src, 'r')
-        for line in negative_file_src:
+        negative_file_src = open_corpus(neg_filename_src, 'r')
+        for line in selected_lines(negative_file_src, negative_positions):
             dest_sentences_file_src.write(line)
             dest_classes_file.write('0\n')
 
         if params['BILINGUAL_SELECTION']:
-            positive_file_trg = open(pos_filename_trg, 'r')
-            for line in positive_file_trg:
+            positive_file_trg = open_corpus(pos_filename_trg, 'r')
+            for line in selected_lines(positive_file_trg, positive_positions):
                 dest_sentences_trg_file.write(line)
-            negative_file_trg = open(neg_filename_trg, 'r')
-            for line in negative_file_trg:
+            negative_file_trg = open_corpus(neg_filename_trg, 'r')
+            for line in selected_lines(negative_file_trg, negative_positions):
                 dest_sentences_trg_file.write(line)
             dest_sentences_trg_file.close()
             positive_file_trg.close()
@@ -100,9 +403,7 @@ def process_files_binary_classification(params, i=0):
         negative_file_src.close()
         dest_sentences_file_src.close()
         dest_classes_file.close()
-        params['POOL_FILENAME'] = [params['POOL_FILENAME'] + '.' + params['SRC_LAN'],
-                                   params['POOL_FILENAME'] + '.' + params['TRG_LAN']] if params['BILINGUAL_SELECTION'] \
-            else [params['POOL_FILENAME'] + '.' + params['TRG_LAN']]
+        params['POOL_FILENAME'] = pool_input_files(params, params['POOL_FILENAME'])
         params['TEXT_FILES']['train'] = [dest_sentences_src_filename,
                                          dest_sentences_trg_filename] if params['BILINGUAL_SELECTION'] \
             else [dest_sentences_src_filename]
@@ -0,0 +1,261 @@
+import gc
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+from Queue import Empty, Full
+from itertools import izip
+from timeit import default_timer as timer
+
+import numpy as np
+
+from utils.corpus_io import is_compressed, open_corpus, resolve_corpus
+from utils.line_index import LineIndex
+from utils.memory_budget import private_memory_mb
+from utils.pipelined_scoring import LINE_BYTES, init_encoder, encode_batch
+from utils.quantile_sketch import QuantileSketch
+
+# Model and corpus of the current forked scoring, inherited by the workers (see forked_scoring)
+_SHARED = dict()
+
+
+def corpus_shards(filenames, n_shards, persistent_index=False):
+    """
+        Splits an (uncompressed) corpus into contiguous shards of (almost) the same number of lines.
+
+        :param filenames: aligned text files
+        :param n_shards: number of shards
+        :param persistent_index: store the line indexes of the files (see LineIndex)
+        :return: list of (first line, end line, byte offset of the first line in each file)
+    """
+    indexes = [LineIndex(resolve_corpus(filename), persistent=persistent_index) for filename in filenames]
+    n_lines = min(len(index) for index in indexes)
+    shards = []
+    for k in range(n_shards):
+        start, end = k * n_lines // n_shards, (k + 1) * n_lines // n_shards
+        shards.append((start, end, [int(index.offsets[start]) if start < end else 0 for index in indexes]))
+    return shards
+
+
+def _shard_batches(filenames, shard, batch_size):
+    """
+        Batches of a shard of the corpus (see corpus_shards).
+
+        :return: generator of (first line, list of tuples of aligned lines)
+    """
+    start, end, offsets = shard
+    if start == end:
+        return
+    files = [open(resolve_corpus(filename), 'rb') for filename in filenames]
+    try:
+        for f, offset in zip(files, offsets):
+            f.seek(offset)
+        lines = izip(*files)
+        for first in xrange(start, end, batch_size):
+            yield first, [line for _, line in izip(xrange(min(batch_size, end - first)), lines)]
+    finally:
+        for f in files:
+            f.close()
+
+
+def _queued_batches(tasks):
+    """
+        Batches sent by the parent through the tasks queue, until it sends None.
+
+        :return: generator of (first line, list of tuples of aligned lines)
+    """
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        yield task
+
+
+def _score_batches(k, tmp_dir, results, tasks, sketch_size):
+    """
+        Worker k of forked_scoring: scores its batches of the corpus with the model inherited from the parent, and
+        saves their probabilities to tmp_dir/<k>.npy and the (first corpus line, number of sentences) of each batch
+        to tmp_dir/<k>.batches.npy. The batches are those of the k-th contiguous shard of the corpus, or those received
+        through the tasks queue (if given). If sketch_size > 0, it also sends back a QuantileSketch of the in-domain
+        probabilities of its batches.
+    """
+    # The collector would touch (and copy) every object inherited from the parent
+    gc.disable()
+    try:
+        model, vocabularies, params = _SHARED['model'], _SHARED['vocabularies'], _SHARED['params']
+        batch_size = params['PREDICTION_BATCH_SIZE']
+        init_encoder(vocabularies, params)
+        batches = _queued_batches(tasks) if tasks is not None else \
+            _shard_batches(_SHARED['filenames'], _SHARED['shards'][k], batch_size)
+        predictions = []
+        scored_batches = []
+        sketch = QuantileSketch(k=sketch_size) if sketch_size > 0 else None
+        for first, batch in batches:
+            encoded, _ = encode_batch([[line.rstrip('\n') for line in input_lines] for input_lines in zip(*batch)])
+            predictions.append(model.model.predict_on_batch(dict((id_in, X) for id_in, X in
+                                                                 zip(model.ids_inputs, encoded))))
+            scored_batches.append((first, len(batch)))
+            if sketch is not None:
+                sketch.update(np.asarray(predictions[-1])[:, 1])
+        predictions = np.concatenate(predictions) if predictions else \
+            np.zeros((0, params['N_CLASSES']), dtype='float32')
+        np.save(os.path.join(tmp_dir, '%d.npy' % k), predictions.astype('float32'))
+        np.save(os.path.join(tmp_dir, '%d.batches.npy' % k), np.array(scored_batches, dtype='int64').reshape(-1, 2))
+        results.put((k, len(predictions), private_memory_mb(), sketch.to_dict() if sketch is not None else None, None))
+    except Exception as e:
+        results.put((k, 0, None, None, '%s: %s' % (type(e).__name__, str(e))))
+
+
+def _poll_results(results, workers, outcomes, timeout):
+    """
+        Next result sent by the scoring workers, or None if there is none after timeout seconds. Raises an exception
+        if a worker exited without sending its result (e.g. killed by the OOM killer), as it would never answer.
+    """
+    try:
+        return results.get(timeout=timeout)
+    except Empty:
+        pass
+    # The workers flush their results before exiting, so those of the workers that had exited are in the queue
+    dead = [k for k, worker in enumerate(workers) if k not in outcomes and not worker.is_alive()]
+    if not dead:
+        return None
+    try:
+        return results.get(timeout=1)
+    except Empty:
+        exitcode = workers[dead[0]].exitcode
+        raise Exception, 'Scoring worker %d exited without a result (exit code %s%s)' % \
+                         (dead[0], exitcode, ', killed by signal %d' % -exitcode if exitcode < 0 else '')
+
+
+def forked_scoring(model, vocabularies, filenames, params, dest_filename=None, budget=None, sketch=None):
+    """
+        Scores a corpus with SCORING_PROCESSES worker processes forked from this one, which holds the model: the
+        weights are loaded (and the prediction function compiled) once, and the workers share them copy-on-write
+        instead of loading their own copies. The memory added by each worker is mostly that of its batches and
+        activations (reported as its private memory).
+
+        Each worker reads and scores a contiguous shard of the corpus, found with its line offsets (see LineIndex).
+        Compressed corpora cannot be split this way: this process decompresses them once and sends batches of
+        PREDICTION_BATCH_SIZE sentences to the workers through a queue. The scores keep the order of the corpus.
+
+        :param model: trained Model_Wrapper
+        :param vocabularies: vocabulary of each input of the model
+        :param filenames: (possibly compressed) text files, one per input of the model. They must be aligned
+        :param params: configuration parameters
+        :param dest_filename: if given, the class probabilities of each sentence are written to this file (one line per
+                              sentence)
+        :param budget: MemoryBudget. If given, the private memory of the workers counts in it, it is checked while
+                       waiting for them (they are terminated if it is exceeded), and the queue of batches of a
+                       compressed corpus is shortened to fit in it
+        :param sketch: QuantileSketch. If given, each worker sketches the in-domain (positive class) probabilities of
+                       its batches, and their sketches are merged into this one
+        :return: (class probabilities array, dict of statistics)
+    """
+    n_workers = params['SCORING_PROCESSES']
+    batch_size = params['PREDICTION_BATCH_SIZE']
+    if hasattr(model.model, '_make_predict_function'):
+        model.model._make_predict_function()  # Compiled once, before forking
+    compressed = any(is_compressed(filename) for filename in filenames)
+    shards = None if compressed else corpus_shards(filenames, n_workers, persistent_index=params['USE_LINE_INDEX'])
+    gc.collect()
+    _SHARED.update(model=model, vocabularies=vocabularies, filenames=filenames, shards=shards, params=params)
+
+    start_time = timer()
+    tmp_dir = tempfile.mkdtemp()
+    results = multiprocessing.Queue()
+    queue_size = 2 * n_workers
+    if compressed and budget is not None:
+        queue_size = budget.chunk_size(queue_size, batch_size * len(filenames) * LINE_BYTES, fraction=0.1,
+                                       minimum=n_workers)
+    tasks = multiprocessing.Queue(maxsize=queue_size) if compressed else None
+    workers = []
+    outcomes = dict()
+
+    def collect(result):
+        if budget is not None:
+            budget.check('forked scoring', verbose=False)
+        if result is None:
+            return
+        k, n_sentences, private_mb, worker_sketch, error = result
+        outcomes[k] = (n_sentences, private_mb)
+        if error is not None:
+            raise Exception, 'Scoring worker %d failed: %s' % (k, error)
+        if sketch is not None:
+            sketch.merge(QuantileSketch.from_dict(worker_sketch))
+
+    def feed(task):
+        # A worker that stops (failing) while the queue is full would block it
+        if budget is not None:
+            budget.check('forked scoring', verbose=False)
+        while True:
+            try:
+                tasks.put(task, timeout=5)
+                return
+            except Full:
+                collect(_poll_results(results, workers, outcomes, 0))
+
+    try:
+        workers = [multiprocessing.Process(target=_score_batches,
+                                           args=(k, tmp_dir, results, tasks, sketch.k if sketch is not None else 0))
+                   for k in range(n_workers)]
+        for worker in workers:
+            worker.start()
+        if budget is not None:
+            budget.watch([worker.pid for worker in workers])
+        if compressed:
+            files = [open_corpus(filename) for filename in filenames]
+            try:
+                lines = izip(*files)
+                first = 0
+                while True:
+                    batch = [line for _, line in izip(xrange(batch_size), lines)]
+                    if not batch:
+                        break
+                    feed((first, batch))
+                    first += len(batch)
+            finally:
+                for f in files:
+                    f.close()
+            for _ in range(n_workers):
+                feed(None)
+        while len(outcomes) < n_workers:
+            collect(_poll_results(results, workers, outcomes, 5))
+        for worker in workers:
+            worker.join()
+
+        # Each worker stores its batches in the order it scored them
+        predictions = np.zeros((sum(n_sentences for n_sentences, _ in outcomes.values()), params['N_CLASSES']),
+                               dtype='float32')
+        for k in range(n_workers):
+            shard = np.load(os.path.join(tmp_dir, '%d.npy' % k))
+            offset = 0
+            for first, n_sentences in np.load(os.path.join(tmp_dir, '%d.batches.npy' % k)):
+                predictions[first:first + n_sentences] = shard[offset:offset + n_sentences]
+                offset += n_sentences
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        if budget is not None:
+            budget.watch([])
+        _SHARED.clear()
+        shutil.rmtree(tmp_dir)
+    wall_time = timer() - start_time
+
+    if dest_filename is not None:
+        with open_corpus(dest_filename, 'w') as dest_file:
+            for start in range(0, len(predictions), batch_size):
+                dest_file.write(''.join(' '.join('%.6f' % p for p in row) + '\n'
+                                        for row in predictions[start:start + batch_size]))
+
+    stats = {'sentences': len(predictions), 'seconds': wall_time,
+             'worker_private_mb': [outcomes[k][1] for k in range(n_workers)]}
+    if params['VERBOSE'] > 0:
+        logging.info('Forked scoring: %d sentences in %.2fs with %d workers' % (len(predictions), wall_time, n_workers))
+        for k in range(n_workers):
+            if outcomes[k][1] is not None:
+                logging.info('Worker %d: %d sentences, %.1f MB of private memory' % (k, outcomes[k][0],
+                                                                                       outcomes[k][1]))
+    return predictions, stats